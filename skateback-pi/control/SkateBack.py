@@ -1,12 +1,28 @@
-import serial
+import argparse
+import base64
+import json
+import math
+import queue
 import socket
 import sys
 import time
 import threading
-import pyvesc
 from pyvesc.VESC.messages import SetDutyCycle, SetCurrent, GetValues
-import keyboard  # Assuming you have this for keyboard control
-import SkateBackGPS
+import clocks
+import launch
+import logs
+import odometry
+import profiler
+import recorder
+import speed
+import telemetry
+import tracing
+import track
+import trip
+import vesc
+
+log = logs.get('skateback')
+socket_log = logs.get('socket')
 
 # Socket server config
 HOST = 'localhost' 
@@ -20,6 +36,20 @@ DEC_STEP = 0.007     # Make deceleration match acceleration
 BRK_STEP = 0.02     # Make braking smoother
 MIN_DUTY_CYCLE = 0.05  # Minimum duty cycle to start movement
 MAX_DUTY_CYCLE = 0.6   # Max duty cycle
+TICK_PERIOD = 0.05     # Motor update period in seconds (50ms)
+
+# Closed-loop turns
+TURN_DUTY = 0.1             # Pivot duty cycle magnitude
+TURN_ANGLE = 90.0           # Default turn_left/turn_right angle (degrees)
+TURN_ACC_STEP = ACC_STEP    # Pivot ramp step, applied every TICK_PERIOD
+TURN_STOP_LEAD = 0.07       # How far the board coasts after the stop, in seconds of yaw rate, as learned by bench_turns
+TURN_LEAD_GAIN = 0.5        # How quickly the coast estimate follows what turns actually measured
+TURN_SETTLE_TIME = 0.25     # The board counts as stopped once the heading has not moved for this long (s)
+TURN_TIMEOUT = 5.0          # Stop a turn that has not reached its angle after this long (s)
+
+# Closed-loop speed control, see speed.py and set_speed()
+SPEED_STEP = 0.25           # Change in target speed per accelerate/decelerate in speed mode (m/s)
+MAX_SPEED = 4.0             # Largest target speed magnitude (m/s)
 
 # Notes on turning:
 # Turn duty cycle magnitude should be 0.1 for both wheels. Positive wheel is side turned towards. 
@@ -32,32 +62,126 @@ MAX_DUTY_CYCLE = 0.6   # Max duty cycle
 CONTROL_ACC_STEP = 0.02      # Control acceleration step
 CONTROL_DEC_STEP = 0.02      # Control deceleration step
 
+# Commands the socket server runs as soon as they are read, ahead of anything queued
+PRIORITY_COMMANDS = ('estop', 'estop clear')
+# Commands that queue up behind each other are folded into one setpoint change
+SPEED_COMMANDS = ('accelerate', 'decelerate')
+
+
+class RampCancelled(Exception):
+    """
+    Raised inside a ramp when an emergency stop or a new stop preempts it.
+    """
+
+
+class EmergencyStopLatched(RuntimeError):
+    """
+    Raised when a non-zero duty cycle is requested while the emergency stop is latched.
+    """
+
+
+def _accelerated(duty_cycle):
+    """
+    Duty cycle after one 'accelerate': up by ACC_STEP, starting at MIN_DUTY_CYCLE
+    if currently below it, capped at MAX_DUTY_CYCLE.
+    """
+    return min(max(MIN_DUTY_CYCLE, duty_cycle + ACC_STEP), MAX_DUTY_CYCLE)
+
+
+def _decelerated(duty_cycle):
+    """
+    Duty cycle after one 'decelerate': down by DEC_STEP into reverse, capped at
+    -MAX_DUTY_CYCLE. A reverse duty cycle below MIN_DUTY_CYCLE in magnitude jumps
+    to -MIN_DUTY_CYCLE.
+    """
+    duty_cycle = max(-MAX_DUTY_CYCLE, duty_cycle - DEC_STEP)
+    if 0 > duty_cycle > -MIN_DUTY_CYCLE:
+        duty_cycle = -MIN_DUTY_CYCLE
+    return duty_cycle
+
+
 class SkateBack:
-    def __init__(self):
+    def __init__(self, port_left=SERIAL_L, port_right=SERIAL_R, clock=None, flight_recorder=None,
+                 transports=None, capture=None):
         """
         Initialize the SkateBack controller.
 
-        Sets up duty cycles and opens serial connections for the left and right wheels.
+        Sets up duty cycles and opens VESC connections for the left and right wheels.
+
+        Args:
+            port_left (str): Serial port of the left VESC.
+            port_right (str): Serial port of the right VESC. Pass the ports of a
+                              vesc_sim.SimulatedBoard to run without hardware.
+            clock: Time source and scheduler for all waits and the motor ticks.
+                   Defaults to clocks.RealClock(); pass a clocks.SimClock to run
+                   manoeuvres in virtual time.
+            flight_recorder (recorder.Recorder): Records every tick, command and
+                   emergency stop, see recorder.py. Closed by close().
+            transports (tuple): (left, right) objects to use instead of opening
+                   the ports, with the VescTransport interface, e.g.
+                   session.ReplayTransport. Released by close().
+            capture (session.Capture): Records every command and VESC reply
+                   for replay, see session.py. Not closed by close().
         """
-        self.left_duty_cycle = 0.0
+        self.left_duty_cycle = 0.0     # Commanded duty cycles; the wire value is negated
         self.right_duty_cycle = 0.0
         self.running = True  
-
-        # Initialize serial connections for left and right wheels
-        self.serial_left = serial.Serial(SERIAL_L, baudrate=115200, timeout=0.05)
-        self.serial_right = serial.Serial(SERIAL_R, baudrate=115200, timeout=0.05)
+        self.clock = clock or clocks.RealClock()
+        self.tracer = tracing.Tracer()
+        self.profiler = profiler.Profiler()     # Off until 'profile start'
+
+        # Initialize VESC connections for left and right wheels, both ports opening at once
+        if transports is None:
+            transports = vesc.connect_all([port_left, port_right])
+        self.vesc_left, self.vesc_right = transports
+        self.vesc_left.add_reconnect_listener(self._resend_setpoint)
+        self.vesc_right.add_reconnect_listener(self._resend_setpoint)
+        self.capture = capture
+        if capture is not None:
+            self.vesc_left.add_values_listener(self._capture_values)
+            self.vesc_right.add_values_listener(self._capture_values)
 
         # Locks for thread safety when accessing serial ports
         self.lock_left = threading.Lock()
         self.lock_right = threading.Lock()
 
-        # motor control threads
-        self.left_thread = threading.Thread(target=self._motor_control_loop, args=("L",))
-        self.right_thread = threading.Thread(target=self._motor_control_loop, args=("R",))
-        self.left_thread.daemon = True
-        self.right_thread.daemon = True
-        self.left_thread.start()
-        self.right_thread.start()
+        # Emergency stop latch, and the event every running ramp watches.
+        # preempt() sets the event and swaps in a fresh one for later ramps.
+        self.estop = threading.Event()
+        self._preempt = threading.Event()
+        self._preempt_lock = threading.Lock()
+
+        # Wheel odometry, the default heading source for turns
+        self.odometry = odometry.Odometry(self.vesc_left, self.vesc_right)
+        self.turn_stop_lead = TURN_STOP_LEAD   # Updated after every turn, see turn()
+
+        # Speed mode: while speed_targets is set the motor tick drives the duty cycles
+        self.speed = speed.DriveSpeed(MAX_DUTY_CYCLE)
+        self.speed_targets = None       # (left, right) in m/s, positive forward
+        self._speed_counts = (0, 0)     # VESC values_count seen by the last speed tick
+
+        # Launch mode: starts from standstill run on motor current until handover, see launch.py
+        self.launch_settings = None     # Launch() arguments while launch mode is on
+        self.launch = None              # The launch in progress
+        self.last_launch = None         # stats() of the latest launch that ended
+
+        # Trip statistics and the flight recorder, fed from the motor tick with
+        # the VESC values the telemetry tick polls for
+        self.trip = trip.TripStats()
+        self.recorder = flight_recorder
+
+        # Path ridden, for the app's map; fed with GPS fixes when there is a GPS (see --gps)
+        self.track = track.Track()
+
+        # Motor control tick, one frame to each wheel from the same snapshot
+        self.motor_task = self.clock.call_every(TICK_PERIOD, self._motor_tick, name="motor")
+
+        # Telemetry for 'subscribe' clients, on its own tick so a slow serialization never delays the motors
+        self.telemetry = telemetry.Telemetry(self, TICK_PERIOD)
+        self.telemetry_task = self.clock.call_every(TICK_PERIOD, self.telemetry.publish, name="telemetry")
+        # Command traces are only timestamped on the command and motor threads; bucket them here
+        self.trace_task = self.clock.call_every(tracing.FLUSH_PERIOD, self.tracer.flush, name="trace")
+        self.telemetry.start_polling(always=True)
 
     def __enter__(self):
         """
@@ -77,24 +201,225 @@ class SkateBack:
         """
         return f"L: {self.left_duty_cycle}; R: {self.right_duty_cycle}"
 
-    def _motor_control_loop(self, wheel):
+    def _motor_tick(self):
         """
-        Continuous motor control loop that runs in a separate thread.
+        Send the current duty cycles to both wheels. Runs every TICK_PERIOD on the clock;
+        a failed write is retried on the next tick.
+
+        Both locks are held for the whole tick, so the two frames always come
+        from the same pair of setpoints (see set_wheels) and nothing written
+        by emergency_stop can be overtaken by a stale duty cycle.
+
+        A wheel whose VESC is disconnected is skipped until its transport has
+        reopened it (see _resend_setpoint); the other wheel carries on.
         """
-        while self.running:
+        with self.lock_left, self.lock_right:
+            currents = None
+            if not self.estop.is_set():
+                if self.launch is not None:
+                    try:
+                        currents = self._launch_tick()
+                    except Exception as e:
+                        # Fall back to the duty cycles rather than hold a current nothing updates
+                        log.error("Error in launch, ending it: %r", e)
+                        self._end_launch()
+                if self.speed_targets is not None and currents is None:
+                    try:
+                        self._speed_tick()
+                    except Exception as e:
+                        log.error("Error in speed control, keeping the last duty cycles: %r", e)
+            left, right = self.left_duty_cycle, self.right_duty_cycle
+            self._send_setpoint("L", self.vesc_left, left, None if currents is None else currents[0])
+            self._send_setpoint("R", self.vesc_right, right, None if currents is None else currents[1])
+        self.tracer.frame()
+        try:
+            self.trip.add(self.clock.time(), self.vesc_left.values, self.vesc_right.values)
+        except Exception as e:
+            log.error("Error updating trip statistics: %s", e)
+        if self.recorder is not None:
+            self._record_tick(left, right)
+
+    def _speed_tick(self):
+        """
+        Set both duty cycles from the speed controllers and the latest ERPM
+        the telemetry tick polled for. Called with both locks held.
+        """
+        left_values, right_values = self.vesc_left.values, self.vesc_right.values
+        counts = (self.vesc_left.values_count, self.vesc_right.values_count)
+        fresh = (counts[0] != self._speed_counts[0], counts[1] != self._speed_counts[1])
+        self._speed_counts = counts
+        # The wheels turn forward for a negative duty cycle on the wire
+        erpms = (None if left_values is None else -left_values.rpm,
+                 None if right_values is None else -right_values.rpm)
+        targets = (self.speed_targets[0] * speed.ERPM_PER_MPS, self.speed_targets[1] * speed.ERPM_PER_MPS)
+        self.left_duty_cycle, self.right_duty_cycle = self.speed.update(targets, erpms, TICK_PERIOD, fresh)
+
+    def _launch_targets(self):
+        # Target ERPM of the launch: the target speeds in speed mode, otherwise
+        # the no-load speed of the duty cycles it hands over to
+        if self.speed_targets is not None:
+            return (self.speed_targets[0] * speed.ERPM_PER_MPS, self.speed_targets[1] * speed.ERPM_PER_MPS)
+        return (self.left_duty_cycle * speed.ERPM_PER_DUTY, self.right_duty_cycle * speed.ERPM_PER_DUTY)
+
+    def _launch_tick(self):
+        """
+        Motor currents for the launch in progress, or None once it has handed
+        over to the speed controller or the duty cycles. Called with both locks held.
+        """
+        left_values, right_values = self.vesc_left.values, self.vesc_right.values
+        targets = self._launch_targets()
+        if targets[0] * targets[1] <= 0:
+            # Stopped, or turned into a pivot: no launch to finish
+            self._end_launch()
+            return None
+        # The wheels turn forward for a negative current on the wire
+        erpms = (None if left_values is None else -left_values.rpm,
+                 None if right_values is None else -right_values.rpm)
+        v_in = (None if left_values is None else left_values.v_in,
+                None if right_values is None else right_values.v_in)
+        duties = None if self.speed_targets is not None else (self.left_duty_cycle, self.right_duty_cycle)
+        currents = self.launch.update(targets, erpms, v_in, TICK_PERIOD, duties)
+        if not self.launch.done:
+            return currents
+        if self.speed_targets is not None and self.launch.reason != 'feedback':
+            duties = [max(-MAX_DUTY_CYCLE, min(MAX_DUTY_CYCLE, duty)) for duty in self.launch.handover_duties(v_in)]
+            self.speed.reset(*duties)
+            self.left_duty_cycle, self.right_duty_cycle = duties
+        self._end_launch()
+        return None
+
+    def _start_launch(self):
+        """
+        Start a launch towards the new setpoint if launch mode is on and the
+        board is standing still. Called with both locks held.
+        """
+        if self.launch_settings is None or self.launch is not None or self.estop.is_set():
+            return
+        left_values, right_values = self.vesc_left.values, self.vesc_right.values
+        if left_values is None or right_values is None:
+            return
+        if max(abs(left_values.rpm), abs(right_values.rpm)) >= launch.STANDSTILL_ERPM:
+            return
+        targets = self._launch_targets()
+        if targets[0] * targets[1] <= 0:
+            return
+        self.launch = launch.Launch(**self.launch_settings)
+        self.record(recorder.EVENT, 'launch')
+        log.info("Launching towards %.0f, %.0f ERPM", *targets)
+
+    def _end_launch(self):
+        # Called with a wheel lock held, which keeps the motor tick out
+        if self.launch is None:
+            return
+        self.last_launch = self.launch.stats()
+        self.launch = None
+        log.info("Launch ended: %s", self.last_launch)
+
+    def _cancel_launch(self):
+        """
+        End a launch in progress with duty cycles that keep the wheels' present
+        current, so a stop ramps down from where the wheels are rather than
+        from the targets.
+        """
+        with self.lock_left, self.lock_right:
+            if self.launch is None:
+                return
+            left_values, right_values = self.vesc_left.values, self.vesc_right.values
+            if left_values is not None and right_values is not None:
+                self.left_duty_cycle = max(-MAX_DUTY_CYCLE, min(MAX_DUTY_CYCLE, launch.handover_duty(
+                    -left_values.rpm, self.launch.currents[0], left_values.v_in)))
+                self.right_duty_cycle = max(-MAX_DUTY_CYCLE, min(MAX_DUTY_CYCLE, launch.handover_duty(
+                    -right_values.rpm, self.launch.currents[1], right_values.v_in)))
+            self.speed_targets = None
+            self._end_launch()
+
+    def enable_launch(self, max_current=launch.MAX_CURRENT, current_rate=launch.CURRENT_RATE, detect_slip=True):
+        """
+        Turn launch mode on: from now on set_speed() and accelerate from
+        standstill start on motor current, ramped by at most current_rate,
+        and hand over to the speed controller or the duty cycles near the
+        target (see launch.py).
+
+        Args:
+            max_current (float): Largest motor current per wheel (A).
+            current_rate (float): Largest change in current per second (A/s).
+            detect_slip (bool): Back off a wheel that breaks traction.
+
+        Raises:
+            ValueError: For a current or rate out of range.
+        """
+        settings = {"max_current": max_current, "current_rate": current_rate, "detect_slip": detect_slip}
+        launch.Launch(**settings)   # Check the settings now rather than at the next start
+        self.launch_settings = settings
+        self.telemetry.start_polling(always=True)
+
+    def disable_launch(self):
+        """
+        Turn launch mode off. A launch in progress hands over as if stopped by a duty cycle command.
+        """
+        self.launch_settings = None
+        self._cancel_launch()
+
+    def _record_tick(self, left, right):
+        flags = ((recorder.FLAG_ESTOP if self.estop.is_set() else 0)
+                 | (recorder.FLAG_LEFT_CONNECTED if self.vesc_left.connected else 0)
+                 | (recorder.FLAG_RIGHT_CONNECTED if self.vesc_right.connected else 0))
+        left_values, right_values = self.vesc_left.values, self.vesc_right.values
+        try:
+            self.recorder.tick(self.clock.time(), flags, left, right, left_values, right_values,
+                               self.odometry.heading_from(left_values, right_values))
+        except Exception as e:
+            log.error("Error recording tick: %s", e)
+
+    def record(self, kind, text):
+        """
+        Put a command or event in the flight recorder, if there is one.
+
+        Args:
+            kind (int): recorder.COMMAND or recorder.EVENT.
+            text (str): What happened, e.g. the command line.
+        """
+        if self.recorder is not None:
             try:
-                if wheel == "L":
-                    with self.lock_left:
-                        duty_cycle = self.left_duty_cycle
-                        self.serial_left.write(pyvesc.encode(SetDutyCycle(duty_cycle)))
-                else:
-                    with self.lock_right:
-                        duty_cycle = self.right_duty_cycle
-                        self.serial_right.write(pyvesc.encode(SetDutyCycle(duty_cycle)))
-                time.sleep(0.05)  # 50ms update rate
+                self.recorder.event(kind, text, self.clock.time())
             except Exception as e:
-                print(f"Error in motor control loop for {wheel}: {e}")
-                time.sleep(0.1)  # Wait before retrying
+                log.error("Error recording %s: %s", text, e)
+
+    def _capture_values(self, transport, values):
+        self.capture.vesc("L" if transport is self.vesc_left else "R", values)
+
+    def _send_setpoint(self, wheel, transport, duty_cycle, current=None):
+        # Called with the wheel's lock held. During a launch current is the motor
+        # current in amps, positive forward, and is sent instead of the duty cycle.
+        if not transport.connected:
+            return
+        try:
+            # While the emergency stop is latched the wheels get zero current, not a duty cycle
+            if self.estop.is_set():
+                transport.send(SetCurrent(0))
+            elif current is not None:
+                transport.send(SetCurrent(-current))
+            else:
+                transport.send(SetDutyCycle(-duty_cycle))
+        except Exception as e:
+            log.error("Error in motor control loop for %s: %s", wheel, e)
+
+    def _resend_setpoint(self, transport):
+        """
+        Reconnect listener: send the current setpoint as soon as a VESC is back
+        instead of waiting for the next tick.
+        """
+        self.record(recorder.EVENT, f"reconnect {'L' if transport is self.vesc_left else 'R'}")
+        if transport is self.vesc_left:
+            with self.lock_left:
+                launching = self.launch
+                self._send_setpoint("L", transport, self.left_duty_cycle,
+                                    None if launching is None else launching.currents[0])
+        if transport is self.vesc_right:
+            with self.lock_right:
+                launching = self.launch
+                self._send_setpoint("R", transport, self.right_duty_cycle,
+                                    None if launching is None else launching.currents[1])
 
     def close(self):
         """
@@ -103,18 +428,29 @@ class SkateBack:
         try:
             # Stop the motor control loops
             self.running = False
-            time.sleep(0.1)  # Give threads time to stop
+            self.motor_task.cancel()
+            self.telemetry_task.cancel()
+            self.trace_task.cancel()
+            self.profiler.stop()
+            self.clock.sleep(0.1)  # Give a tick in progress time to finish
             
             # Emergency stop both motors
             self.emergency_stop()
             
-            # Close serial connections
-            if self.serial_left.is_open:
-                self.serial_left.close()
-            if self.serial_right.is_open:
-                self.serial_right.close()
+            # Release VESC connections
+            self.vesc_left.remove_reconnect_listener(self._resend_setpoint)
+            self.vesc_right.remove_reconnect_listener(self._resend_setpoint)
+            if self.capture is not None:
+                self.vesc_left.remove_values_listener(self._capture_values)
+                self.vesc_right.remove_values_listener(self._capture_values)
+            self.vesc_left.release()
+            self.vesc_right.release()
+
+            if self.recorder is not None:
+                self.record(recorder.EVENT, 'close')
+                self.recorder.close()
         except Exception as e:
-            print(f"An error occurred while closing: {e}")
+            log.error("An error occurred while closing: %s", e)
 
     def create_timer(self, duration):
         """
@@ -126,39 +462,166 @@ class SkateBack:
         Returns:
             function: A function that returns True until the duration has elapsed.
         """
-        start_time = time.time()
+        start_time = self.clock.time()
 
         def time_check():
-            return (time.time() - start_time) < duration
+            return (self.clock.time() - start_time) < duration
 
         return time_check
 
-    def set_duty_cycle(self, wheel, duty_cycle, duration=None):
+    def _check_setpoint(self, duty_cycle, preempt):
+        # Called with the wheel's lock held, so an emergency stop cannot slip in between
+        if preempt is not None and preempt.is_set():
+            raise RampCancelled()
+        if duty_cycle != 0 and self.estop.is_set():
+            raise EmergencyStopLatched("Emergency stop is latched; send 'estop clear' first")
+
+    def set_duty_cycle(self, wheel, duty_cycle, duration=None, preempt=None):
         """
-        Set a motor to a given duty cycle.
+        Set a motor to a given duty cycle. Leaves speed mode and ends a launch.
+
+        Args:
+            wheel (str): 'L' for left, 'R' for right.
+            duty_cycle (float): Positive moves the board forward.
+            duration (float): Optional time to hold before returning.
+            preempt (threading.Event): Ramp cancellation event from preempt_event().
+                                       If set, the setpoint is not applied and the
+                                       hold ends early; both raise RampCancelled.
+
+        Raises:
+            EmergencyStopLatched: If duty_cycle is non-zero while the emergency stop is latched.
         """
         if not -MAX_DUTY_CYCLE <= duty_cycle <= MAX_DUTY_CYCLE:
             raise ValueError(f"Duty cycle must be between {-MAX_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
 
-        duty_cycle = -duty_cycle
-
         try:
             if wheel == "L":
                 with self.lock_left:
+                    self._check_setpoint(duty_cycle, preempt)
+                    self.speed_targets = None
+                    self._end_launch()
                     self.left_duty_cycle = duty_cycle
             elif wheel == "R":
                 with self.lock_right:
+                    self._check_setpoint(duty_cycle, preempt)
+                    self.speed_targets = None
+                    self._end_launch()
                     self.right_duty_cycle = duty_cycle
             else:
                 raise ValueError("Please specify 'L' or 'R' for wheel")
+            self.tracer.setpoint()
 
             if duration is not None:
-                time.sleep(duration)
+                if preempt is None:
+                    self.clock.sleep(duration)
+                elif self.clock.wait(preempt, duration):
+                    raise RampCancelled()
 
+        except (RampCancelled, EmergencyStopLatched):
+            raise
         except Exception as e:
-            print(f"An error occurred in set_duty_cycle: {e}")
+            log.error("An error occurred in set_duty_cycle: %s", e)
             raise
 
+    def set_wheels(self, left, right, preempt=None):
+        """
+        Set both wheels' duty cycles together. The next motor tick sends both,
+        so the wheels change in the same frame. Leaves speed mode and ends a launch.
+
+        Args:
+            left (float): Left duty cycle, positive moves the board forward.
+            right (float): Right duty cycle.
+            preempt (threading.Event): Ramp cancellation event, as for set_duty_cycle.
+
+        Raises:
+            RampCancelled: If preempt is set.
+            EmergencyStopLatched: If either duty cycle is non-zero while the emergency stop is latched.
+        """
+        for duty_cycle in (left, right):
+            if not -MAX_DUTY_CYCLE <= duty_cycle <= MAX_DUTY_CYCLE:
+                raise ValueError(f"Duty cycle must be between {-MAX_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
+
+        with self.lock_left, self.lock_right:
+            self._check_setpoint(left or right, preempt)
+            self.speed_targets = None
+            self._end_launch()
+            self.left_duty_cycle = left
+            self.right_duty_cycle = right
+        self.tracer.setpoint()
+
+    def set_speed(self, left, right=None):
+        """
+        Switch to speed mode: from the next motor tick, a speed controller on
+        each wheel sets its duty cycle to hold the target speed against battery
+        voltage, slope and load (see speed.py). Accelerate and decelerate then
+        step the target speed. Any duty cycle command, including stop(), turns
+        and emergency_stop(), leaves speed mode. With launch mode on, a start
+        from standstill runs on motor current until near the target speed
+        (see enable_launch()).
+
+        Args:
+            left (float): Left wheel target speed in m/s, positive forward.
+            right (float): Right wheel target speed, or None for the same as left.
+
+        Raises:
+            ValueError: If a target is faster than MAX_SPEED.
+            EmergencyStopLatched: If a target is non-zero while the emergency stop is latched.
+        """
+        right = left if right is None else right
+        for target in (left, right):
+            if not -MAX_SPEED <= target <= MAX_SPEED:
+                raise ValueError(f"Speed must be between {-MAX_SPEED} and {MAX_SPEED} m/s")
+
+        self.telemetry.start_polling(always=True)
+        with self.lock_left, self.lock_right:
+            self._check_setpoint(left or right, None)
+            if self.speed_targets is None:
+                # Carry on from the current duty cycles rather than jumping
+                self.speed.reset(self.left_duty_cycle, self.right_duty_cycle)
+            self.speed_targets = (left, right)
+            self._start_launch()
+        self.tracer.setpoint()
+
+    def ramp_wheels(self, left, right, step=ACC_STEP, period=TICK_PERIOD, preempt=None):
+        """
+        Ramp both wheels to their targets together, one step per period.
+        Each wheel's step is scaled so both arrive on the same tick.
+
+        Args:
+            left (float): Left target duty cycle.
+            right (float): Right target duty cycle.
+            step (float): Largest change of either wheel per period.
+            period (float): Seconds between steps.
+            preempt (threading.Event): Ramp cancellation event; defaults to the current one.
+
+        Raises:
+            RampCancelled: If the ramp is preempted.
+        """
+        if preempt is None:
+            preempt = self.preempt_event()
+        start_left, start_right = self.get_duty_cycle("L"), self.get_duty_cycle("R")
+        steps = max(1, math.ceil(max(abs(left - start_left), abs(right - start_right)) / step - 1e-9))
+        for i in range(1, steps + 1):
+            self.set_wheels(start_left + (left - start_left) * i / steps,
+                            start_right + (right - start_right) * i / steps, preempt=preempt)
+            if self.clock.wait(preempt, period):
+                raise RampCancelled()
+
+    def preempt_event(self):
+        """
+        Event that a ramp starting now should watch for cancellation.
+        """
+        with self._preempt_lock:
+            return self._preempt
+
+    def preempt(self):
+        """
+        Cancel every ramp in progress. Ramps started afterwards are unaffected.
+        """
+        with self._preempt_lock:
+            self._preempt.set()
+            self._preempt = threading.Event()
+
 
     def get_duty_cycle(self, wheel):
         """
@@ -194,6 +657,7 @@ class SkateBack:
             raise ValueError(f"Target duty cycle must be between {-MAX_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
 
         current_duty_cycle = self.get_duty_cycle(wheel)
+        preempt = self.preempt_event()
 
         # Determine the direction of acceleration
         if target_duty_cycle > current_duty_cycle:
@@ -217,7 +681,10 @@ class SkateBack:
             # Ensure duty cycle does not exceed MAX_DUTY_CYCLE in magnitude
             if abs(current_duty_cycle) > MAX_DUTY_CYCLE:
                 current_duty_cycle = MAX_DUTY_CYCLE if current_duty_cycle > 0 else -MAX_DUTY_CYCLE
-            self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1)
+            try:
+                self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1, preempt=preempt)
+            except RampCancelled:
+                return
 
     def decelerate_to(self, wheel, target_duty_cycle):
         """
@@ -234,6 +701,7 @@ class SkateBack:
             raise ValueError(f"Target duty cycle must be between {-MAX_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
 
         current_duty_cycle = self.get_duty_cycle(wheel)
+        preempt = self.preempt_event()
 
         # Determine the direction of deceleration
         if current_duty_cycle > target_duty_cycle:
@@ -257,7 +725,10 @@ class SkateBack:
             # Ensure duty cycle does not exceed MAX_DUTY_CYCLE in magnitude
             if abs(current_duty_cycle) > MAX_DUTY_CYCLE:
                 current_duty_cycle = MAX_DUTY_CYCLE if current_duty_cycle > 0 else -MAX_DUTY_CYCLE
-            self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1)
+            try:
+                self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1, preempt=preempt)
+            except RampCancelled:
+                return
 
     def brake(self, wheel):
         """
@@ -268,6 +739,7 @@ class SkateBack:
         """
         current_duty_cycle = self.get_duty_cycle(wheel)
         target_duty_cycle = 0.0  # Since we're braking to zero
+        preempt = self.preempt_event()
 
         # Determine the direction of braking
         if current_duty_cycle > 0:
@@ -285,78 +757,138 @@ class SkateBack:
             if (step < 0 and current_duty_cycle < target_duty_cycle) or \
                     (step > 0 and current_duty_cycle > target_duty_cycle):
                 current_duty_cycle = target_duty_cycle
-            self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1)
+            try:
+                self.set_duty_cycle(wheel, current_duty_cycle, duration=0.1, preempt=preempt)
+            except RampCancelled:
+                return
 
-    def emergency_stop(self):
+    def emergency_stop(self, latch=False):
         """
         Immediately stop both wheels by setting current to zero.
+
+        Every ramp in progress is cancelled first so none of them can write a
+        non-zero duty cycle over the stop.
+
+        Args:
+            latch (bool): Keep the wheels at zero current, refusing any non-zero
+                          duty cycle, until clear_emergency_stop() is called.
         """
-        try:
-            with self.lock_left:
-                self.serial_left.write(pyvesc.encode(SetCurrent(0)))
-                self.left_duty_cycle = 0.0
-            with self.lock_right:
-                self.serial_right.write(pyvesc.encode(SetCurrent(0)))
-                self.right_duty_cycle = 0.0
-        except Exception as e:
-            print(f"An error occurred during emergency_stop: {e}")
-            raise
+        if latch:
+            self.estop.set()
+        self.record(recorder.EVENT, 'estop latched' if latch else 'estop')
+        self.preempt()
+        error = None
+        with self.lock_left, self.lock_right:
+            self.speed_targets = None
+            self._end_launch()
+            self.left_duty_cycle = 0.0
+            self.right_duty_cycle = 0.0
+            # A disconnected VESC times out on its own, and gets zero as soon as it is back
+            for transport in (self.vesc_left, self.vesc_right):
+                if not transport.connected:
+                    continue
+                try:
+                    transport.send(SetCurrent(0))
+                except Exception as e:
+                    log.error("An error occurred during emergency_stop: %s", e)
+                    error = error or e
+        if error is not None:
+            raise error
+
+    def clear_emergency_stop(self):
+        """
+        Release a latched emergency stop. The wheels stay at zero until commanded.
+        """
+        self.estop.clear()
+        self.record(recorder.EVENT, 'estop clear')
 
     def accelerate(self):
         """
         Accelerate both wheels by increasing the duty cycle.
-        """
-        try:
-            # Start at MIN_DUTY_CYCLE if currently below it
-            new_left_duty = max(MIN_DUTY_CYCLE, self.left_duty_cycle + ACC_STEP)
-            new_right_duty = max(MIN_DUTY_CYCLE, self.right_duty_cycle + ACC_STEP)
-            
-            # Cap at MAX_DUTY_CYCLE
-            new_left_duty = min(new_left_duty, MAX_DUTY_CYCLE)
-            new_right_duty = min(new_right_duty, MAX_DUTY_CYCLE)
-            
-            self.set_duty_cycle("L", new_left_duty)
-            self.set_duty_cycle("R", new_right_duty)
-            
-            print(f"New duty cycles - Left: {new_left_duty:.3f}, Right: {new_right_duty:.3f}")
-        except Exception as e:
-            print(f"Error in accelerate: {e}")
-            self.emergency_stop()
 
+        Returns:
+            tuple: New (left, right) duty cycles.
+        """
+        return self.change_speed(('accelerate',))
 
     def decelerate(self):
         """
         Decelerate both wheels by decreasing the duty cycle. 
         Goes into negative duty cycle for reverse motion.
+
+        Returns:
+            tuple: New (left, right) duty cycles.
+        """
+        return self.change_speed(('decelerate',))
+
+    def change_speed(self, commands):
+        """
+        Apply a run of 'accelerate'/'decelerate' commands as a single setpoint
+        change. Each command steps the duty cycles exactly as it would on its
+        own, but both wheels are only set once, to the final values. In speed
+        mode the commands step the target speeds by SPEED_STEP instead.
+
+        Args:
+            commands (iterable): 'accelerate' or 'decelerate' strings, in order.
+
+        Returns:
+            tuple: New (left, right) duty cycles, or target speeds in speed mode.
         """
         try:
-            # Decrease by DEC_STEP, allowing negative values
-            new_left_duty = self.left_duty_cycle - DEC_STEP
-            new_right_duty = self.right_duty_cycle - DEC_STEP
-            
-            # Don't exceed negative MAX_DUTY_CYCLE
-            new_left_duty = max(-MAX_DUTY_CYCLE, new_left_duty)
-            new_right_duty = max(-MAX_DUTY_CYCLE, new_right_duty)
-            
-            # If magnitude is below MIN_DUTY_CYCLE but not zero, jump to next significant value
-            if 0 > new_left_duty > -MIN_DUTY_CYCLE:
-                new_left_duty = -MIN_DUTY_CYCLE
-            if 0 > new_right_duty > -MIN_DUTY_CYCLE:
-                new_right_duty = -MIN_DUTY_CYCLE
-                
-            self.set_duty_cycle("L", new_left_duty)
-            self.set_duty_cycle("R", new_right_duty)
-            
-            print(f"New duty cycles - Left: {new_left_duty:.3f}, Right: {new_right_duty:.3f}")
+            with self.lock_left, self.lock_right:
+                if self.speed_targets is not None:
+                    return self._change_target_speed(commands)
+                new_left_duty, new_right_duty = self.left_duty_cycle, self.right_duty_cycle
+                for command in commands:
+                    if command == 'accelerate':
+                        new_left_duty = _accelerated(new_left_duty)
+                        new_right_duty = _accelerated(new_right_duty)
+                    elif command == 'decelerate':
+                        new_left_duty = _decelerated(new_left_duty)
+                        new_right_duty = _decelerated(new_right_duty)
+                    else:
+                        raise ValueError(f"Not a speed command: {command}")
+                self._check_setpoint(new_left_duty or new_right_duty, None)
+                self.left_duty_cycle = new_left_duty
+                self.right_duty_cycle = new_right_duty
+                self._start_launch()
+            self.tracer.setpoint()
+
+            log.info("New duty cycles - Left: %.3f, Right: %.3f", new_left_duty, new_right_duty)
+            return new_left_duty, new_right_duty
+        except EmergencyStopLatched:
+            raise
         except Exception as e:
-            print(f"Error in decelerate: {e}")
+            log.error("Error in change_speed: %s", e)
             self.emergency_stop()
+            raise
+
+    def _change_target_speed(self, commands):
+        # Called from change_speed() with both locks held
+        left, right = self.speed_targets
+        for command in commands:
+            if command == 'accelerate':
+                step = SPEED_STEP
+            elif command == 'decelerate':
+                step = -SPEED_STEP
+            else:
+                raise ValueError(f"Not a speed command: {command}")
+            left = max(-MAX_SPEED, min(MAX_SPEED, left + step))
+            right = max(-MAX_SPEED, min(MAX_SPEED, right + step))
+        self._check_setpoint(left or right, None)
+        self.speed_targets = (left, right)
+        self._start_launch()
+        self.tracer.setpoint()
+        log.info("New target speeds - Left: %.2f m/s, Right: %.2f m/s", left, right)
+        return left, right
 
     def stop(self):
         """
         Smoothly stop both wheels by gradually reducing duty cycle to zero.
         Handles both positive and negative duty cycles.
         """
+        preempt = self.preempt_event()
+        self._cancel_launch()
         try:
             while abs(self.left_duty_cycle) > 0 or abs(self.right_duty_cycle) > 0:
                 # Calculate new duty cycles
@@ -376,16 +908,18 @@ class SkateBack:
                 if abs(new_right_duty) < MIN_DUTY_CYCLE:
                     new_right_duty = 0
                 
-                # Set new duty cycles
-                self.set_duty_cycle("L", new_left_duty)
-                self.set_duty_cycle("R", new_right_duty)
+                # Set new duty cycles, both in the same motor tick
+                self.set_wheels(new_left_duty, new_right_duty, preempt=preempt)
                 
-                print(f"Stopping - Left: {new_left_duty:.3f}, Right: {new_right_duty:.3f}")
-                time.sleep(0.05)  # Small delay for smooth deceleration
+                log.debug("Stopping - Left: %.3f, Right: %.3f", new_left_duty, new_right_duty)
+                if self.clock.wait(preempt, 0.05):  # Small delay for smooth deceleration
+                    raise RampCancelled()
                 
-            print("Both wheels stopped smoothly.")
+            log.info("Both wheels stopped smoothly.")
+        except RampCancelled:
+            log.info("Stop preempted.")
         except Exception as e:
-            print(f"Error in stop: {e}")
+            log.error("Error in stop: %s", e)
             # If smooth stop fails, use emergency stop as fallback
             self.emergency_stop()
 
@@ -409,6 +943,9 @@ class SkateBack:
             raise ValueError("Please specify 'L' or 'R' for wheel")
 
         try:
+            # Only keyboard control needs this, so the socket service does not pay for the import
+            import keyboard
+
             # Start listening for key presses in the background
             keyboard.on_press(self._make_on_press(wheel, key_increase, key_decrease))
 
@@ -417,10 +954,10 @@ class SkateBack:
                 time.sleep(1)
         except KeyboardInterrupt:
             self.emergency_stop()
-            print(f"Emergency stop initiated due to KeyboardInterrupt in wheel {wheel}.")
+            log.warning("Emergency stop initiated due to KeyboardInterrupt in wheel %s.", wheel)
         except Exception as e:
             self.emergency_stop()
-            print(f"An error occurred in keyboard_control: {e}")
+            log.error("An error occurred in keyboard_control: %s", e)
 
     def _make_on_press(self, wheel, key_increase, key_decrease):
         def on_press(event):
@@ -439,43 +976,141 @@ class SkateBack:
                         target_duty_cycle = -MAX_DUTY_CYCLE
                     self.decelerate_to(wheel, target_duty_cycle)
             except Exception as e:
-                print(f"Error in on_press handler: {e}")
+                log.error("Error in on_press handler: %s", e)
         return on_press
     
-    def turn_left(self, target_duty_cycle=0.1):
+    def turn(self, angle, target_duty_cycle=TURN_DUTY, heading=None, timeout=TURN_TIMEOUT):
         """
-        Pivot the skateboard to the left by setting the left wheel to move backward
-        and the right wheel to move forward simultaneously.
+        Pivot in place until the heading has changed by the given angle.
+
+        Both wheels ramp up together in opposite directions, and the heading is
+        sampled every tick. The turn so far plus the distance the board will
+        coast at the current yaw rate, taken from the wheel speeds, predicts
+        where it would end; the wheels stop on the tick where that lands
+        closest to the target. The heading is then followed until the board
+        stops, and the coast estimate is corrected by what was measured, so
+        repeated turns converge on the requested angle.
 
         Args:
-            target_duty_cycle (float): The duty cycle magnitude for turning.
-                                       Default is 0.1, must be between MIN_DUTY_CYCLE and MAX_DUTY_CYCLE.
+            angle (float): Heading change in degrees, positive clockwise (right).
+            target_duty_cycle (float): Pivot duty cycle magnitude, between MIN_DUTY_CYCLE and MAX_DUTY_CYCLE.
+            heading (function): Returns the current heading in degrees clockwise,
+                                or None if no reading is available, e.g. a
+                                SkateBackGPS's read_heading. Defaults to wheel odometry.
+            timeout (float): Stop anyway after this many seconds.
+
+        Returns:
+            float: Heading change measured once the board stopped, in degrees.
         """
         if not MIN_DUTY_CYCLE <= abs(target_duty_cycle) <= MAX_DUTY_CYCLE:
             raise ValueError(f"Target duty cycle must be between {MIN_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
 
-        print("Turning left...")
-
-        # Left wheel moves backward, right wheel moves forward
-        duty_cycle_L = -abs(target_duty_cycle)
-        duty_cycle_R = abs(target_duty_cycle)
-
-        # Create threads for simultaneous wheel control
-        left_thread = threading.Thread(target=self.accelerate_to, args=("L", duty_cycle_L))
-        right_thread = threading.Thread(target=self.accelerate_to, args=("R", duty_cycle_R))
-
-        # Start both threads
-        left_thread.start()
-        right_thread.start()
-
-        # Wait for both threads to complete
-        left_thread.join()
-        right_thread.join()
+        heading = heading or self.odometry.heading
+        preempt = self.preempt_event()
+        direction = 1 if angle >= 0 else -1
+        duty = abs(target_duty_cycle)
+        target_left, target_right = direction * duty, -direction * duty
+
+        previous = heading()
+        if previous is None:
+            raise RuntimeError("No heading available to turn by")
+        turned = 0.0
+        rate = last_rate = 0.0
+        last_predicted = None
+        now = sampled = start = self.clock.time()
+        try:
+            while True:
+                # One ramp step towards the pivot duty cycle, both wheels in the same frame
+                left = self.get_duty_cycle("L")
+                right = self.get_duty_cycle("R")
+                left += max(-TURN_ACC_STEP, min(TURN_ACC_STEP, target_left - left))
+                right += max(-TURN_ACC_STEP, min(TURN_ACC_STEP, target_right - right))
+                self.set_wheels(left, right, preempt=preempt)
+                if self.clock.wait(preempt, TICK_PERIOD):
+                    raise RampCancelled()
+
+                sample = heading()
+                now = self.clock.time()
+                if sample is not None and now > sampled:
+                    change = (sample - previous + 180) % 360 - 180     # Compass headings wrap at 360
+                    previous = sample
+                    turned += direction * change
+                    # One tick of heading is only a few tachometer steps, too coarse
+                    # for a rate; the wheel speeds give it directly when they are known
+                    wheel_rate = self._yaw_rate()
+                    last_rate = rate
+                    rate = direction * (wheel_rate if wheel_rate is not None else change / (now - sampled))
+                    sampled = now
+                # The stop reaches the wheels on the next tick, by when a board
+                # that is still speeding up turns faster than it does now
+                stop_rate = max(rate + max(rate - last_rate, 0.0), 0.0)
+                predicted = turned + stop_rate * self.turn_stop_lead
+                # Stopping a tick later would add about what the last tick added, and
+                # more while the board is still speeding up; stop now if that would
+                # land further past the angle than stopping now falls short of it
+                step = 0.0 if last_predicted is None else max(predicted - last_predicted, 0.0)
+                if predicted + step / 2 >= abs(angle):
+                    break
+                last_predicted = predicted
+                if now - start > timeout:
+                    log.warning("Turn timed out after %.1f of %.1f degrees", turned, abs(angle))
+                    break
+
+            self.set_wheels(0.0, 0.0, preempt=preempt)   # Stay in place until next instruction
+            stop_turned = turned
+
+            # Follow the board until it stops to see how far it coasted
+            moved = now
+            settled = False
+            while now - start < timeout + TURN_SETTLE_TIME:
+                if self.clock.wait(preempt, TICK_PERIOD):
+                    raise RampCancelled()
+                sample = heading()
+                now = self.clock.time()
+                if sample is not None and sample != previous:
+                    turned += direction * ((sample - previous + 180) % 360 - 180)
+                    previous = sample
+                    moved = now
+                elif now - moved >= TURN_SETTLE_TIME:
+                    settled = True
+                    break
+        except RampCancelled:
+            log.info("Turn preempted.")
+            return direction * turned
+
+        if settled and stop_rate > 0:
+            coast = (turned - stop_turned) / stop_rate
+            lead = self.turn_stop_lead + TURN_LEAD_GAIN * (coast - self.turn_stop_lead)
+            self.turn_stop_lead = min(1.0, max(0.0, lead))
+        return direction * turned
+
+    def _yaw_rate(self):
+        """
+        Yaw rate from the latest polled wheel speeds, in degrees per second
+        clockwise, or None if either wheel has not reported.
+        """
+        left_values, right_values = self.vesc_left.values, self.vesc_right.values
+        if left_values is None or right_values is None:
+            return None
+        # The wheels turn forward for a negative ERPM on the wire
+        difference = (right_values.rpm - left_values.rpm) / speed.ERPM_PER_MPS
+        return math.degrees(difference / self.odometry.track_width)
+
+    def turn_left(self, target_duty_cycle=TURN_DUTY, angle=TURN_ANGLE, heading=None):
+        """
+        Pivot the skateboard to the left by setting the left wheel to move backward
+        and the right wheel to move forward simultaneously.
 
-        time.sleep(2)           # Let the skateboard pivot for 2 seconds
-        self.emergency_stop()   # Stay in place until next instruction
+        Args:
+            target_duty_cycle (float): The duty cycle magnitude for turning.
+                                       Default is 0.1, must be between MIN_DUTY_CYCLE and MAX_DUTY_CYCLE.
+            angle (float): Degrees to turn.
+            heading (function): Heading source, see turn().
+        """
+        log.info("Turning left...")
+        return self.turn(-abs(angle), target_duty_cycle, heading)
 
-    def turn_right(self, target_duty_cycle=0.1):
+    def turn_right(self, target_duty_cycle=TURN_DUTY, angle=TURN_ANGLE, heading=None):
         """
         Pivot the skateboard to the right by setting the left wheel to move forward
         and the right wheel to move backward simultaneously.
@@ -483,113 +1118,448 @@ class SkateBack:
         Args:
             target_duty_cycle (float): The duty cycle magnitude for turning.
                                        Default is 0.1, must be between MIN_DUTY_CYCLE and MAX_DUTY_CYCLE.
+            angle (float): Degrees to turn.
+            heading (function): Heading source, see turn().
         """
-        if not MIN_DUTY_CYCLE <= abs(target_duty_cycle) <= MAX_DUTY_CYCLE:
-            raise ValueError(f"Target duty cycle must be between {MIN_DUTY_CYCLE} and {MAX_DUTY_CYCLE}")
-        
-        print("Turning right...")
+        log.info("Turning right...")
+        return self.turn(abs(angle), target_duty_cycle, heading)
 
-        # Left wheel moves forward, right wheel moves backward
-        duty_cycle_L = abs(target_duty_cycle)
-        duty_cycle_R = -abs(target_duty_cycle)
-
-        # Create threads for simultaneous wheel control
-        left_thread = threading.Thread(target=self.accelerate_to, args=("L", duty_cycle_L))
-        right_thread = threading.Thread(target=self.accelerate_to, args=("R", duty_cycle_R))
-
-        # Start both threads
-        left_thread.start()
-        right_thread.start()
-
-        # Wait for both threads to complete
-        left_thread.join()
-        right_thread.join()
+class Connection:
+    def __init__(self, conn, addr):
+        """
+        One control socket client. Command acks and telemetry lines share the
+        socket, so whole lines are written under a lock.
+        """
+        self.conn = conn
+        self.addr = addr
+        self.send_lock = threading.Lock()
+        self.subscriber = None      # telemetry.Subscriber, see 'subscribe'
 
-        time.sleep(2)           # Let the skateboard pivot for 2 seconds
-        self.emergency_stop()   # Stay in place until next instruction
+    def send(self, message):
+        with self.send_lock:
+            self.conn.sendall(message.encode('utf-8'))
 
-def socket_server(skateback):
+def socket_server(skateback, host=HOST, port=PORT):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
+        s.bind((host, port))
         s.listen()
-        print(f'Socket server listening on {HOST}:{PORT}')
+        socket_log.info('Socket server listening on %s:%s', host, port)
 
+        # Each client gets its own thread, so e.g. the app's stats screen can
+        # stream telemetry while the remote is connected
         while True:
             conn, addr = s.accept()
-            conn.settimeout(None)  # Make sure connection doesn't timeout
-            print(f'Connected by {addr}')
-            
+            threading.Thread(target=_serve_connection, args=(skateback, conn, addr),
+                             name=f"client {addr}", daemon=True).start()
+
+def _serve_connection(skateback, conn, addr):
+    conn.settimeout(None)  # Make sure connection doesn't timeout
+    socket_log.info('Connected by %s', addr)
+    connection = Connection(conn, addr)
+
+    # Commands run in order on a worker thread, so a long ramp does not
+    # hold up reading the socket. Priority commands skip the queue and
+    # run here as soon as they are read; 'stop' also cancels the ramp
+    # in progress straight away and then runs behind it.
+    commands = queue.Queue()
+    worker = threading.Thread(target=_command_worker, args=(skateback, connection, commands),
+                              name="commands", daemon=True)
+    worker.start()
+    try:
+        buffer = ""
+        while True:
             try:
-                buffer = ""
-                while True:
-                    try:
-                        data = conn.recv(1024).decode('utf-8')
-                        if not data:
-                            print("Client disconnected")
-                            break
-                        
-                        buffer += data
-                        
-                        # Process any complete commands in buffer
-                        while '\n' in buffer:
-                            command, buffer = buffer.split('\n', 1)
-                            command = command.strip()
+                data = conn.recv(1024).decode('utf-8')
+                recv_ns = time.perf_counter_ns()
+                if not data:
+                    socket_log.info("Client disconnected")
+                    break
+                
+                buffer += data
+                
+                # Process any complete commands in buffer
+                while '\n' in buffer:
+                    command, buffer = buffer.split('\n', 1)
+                    command = command.strip()
+                    if not command:
+                        continue
+                    socket_log.info('Received command: %s', command)
+                    skateback.record(recorder.COMMAND, command)
+                    if skateback.capture is not None:
+                        skateback.capture.command(command)
+                    if command in PRIORITY_COMMANDS:
+                        _run_command(skateback, connection, command, recv_ns)
+                        continue
+                    if command == 'stop':
+                        skateback.preempt()
+                    commands.put((command, recv_ns))
                             
-                            if command:
-                                print(f'Received command: {command}')
-                                try:
-                                    response = handle_command(skateback, command)
-                                    print(f'Command response: {response}')
-                                    conn.sendall((response + '\n').encode('utf-8'))
-                                except Exception as e:
-                                    error_msg = f"Error executing command: {str(e)}\n"
-                                    print(error_msg)
-                                    conn.sendall(error_msg.encode('utf-8'))
-                                    
-                    except socket.error as e:
-                        print(f"Socket error while receiving data: {e}")
-                        break
-                        
-            except Exception as e:
-                print(f"Error handling connection from {addr}: {e}")
-            finally:
-                try:
-                    conn.close()
-                    print(f"Connection with {addr} closed")
-                except:
-                    pass
+            except socket.error as e:
+                socket_log.error("Socket error while receiving data: %s", e)
+                break
+                
+    except Exception as e:
+        socket_log.error("Error handling connection from %s: %s", addr, e)
+    finally:
+        commands.put(None)
+        worker.join()
+        if connection.subscriber is not None:
+            skateback.telemetry.unsubscribe(connection.subscriber)
+        try:
+            conn.close()
+            socket_log.info("Connection with %s closed", addr)
+        except:
+            pass
+
+def _command_worker(skateback, connection, commands):
+    """
+    Run one connection's queued commands in order until None is queued.
+
+    A speed command takes every speed command queued straight behind it, and
+    the run is applied as one setpoint change. Any other command ends the run
+    and is handled on its own, so a 'stop' is never folded away and nothing
+    is reordered around it.
+    """
+    held = []
+    while True:
+        item = held.pop() if held else commands.get()
+        if item is None:
+            return
+        command, recv_ns = item
+        if command not in SPEED_COMMANDS:
+            _run_command(skateback, connection, command, recv_ns)
+            continue
+
+        batch = [item]
+        while True:
+            try:
+                item = commands.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[0] in SPEED_COMMANDS:
+                batch.append(item)
+            else:
+                held.append(item)
+                break
+        _run_speed_commands(skateback, connection, batch)
+
+def _run_speed_commands(skateback, connection, batch):
+    """
+    Apply a run of queued speed commands at once and ack each of them with the
+    final target. Traced from when the first of them was received.
+    """
+    span = skateback.tracer.begin(batch[0][1])
+    verbs = [command for command, _ in batch]
+    if len(verbs) > 1:
+        socket_log.info("Coalesced %d speed commands", len(verbs))
+    try:
+        left, right = skateback.change_speed(verbs)
+        message = ''.join(_speed_ack(verb, left, right) + '\n' for verb in verbs)
+    except Exception as e:
+        message = ''.join(f"Error executing command '{verb}': {str(e)}\n" for verb in verbs)
+        socket_log.error("%s", message.rstrip())
+    skateback.tracer.end(span)
+    try:
+        connection.send(message)
+    except socket.error as e:
+        socket_log.error("Socket error while sending response: %s", e)
+
+def _speed_ack(command, left, right):
+    return f"Successfully {command}d (target L: {left:.3f}, R: {right:.3f})"
+
+def _run_command(skateback, connection, command, recv_ns):
+    """
+    Handle a command and send its response, tracing it from when it was received.
+    """
+    span = skateback.tracer.begin(recv_ns)
+    try:
+        response = handle_command(skateback, command, connection)
+        socket_log.info('Command response: %s', response)
+        message = response + '\n'
+    except Exception as e:
+        message = f"Error executing command: {str(e)}\n"
+        socket_log.error("%s", message.rstrip())
+    skateback.tracer.end(span)
+    try:
+        connection.send(message)
+    except socket.error as e:
+        socket_log.error("Socket error while sending response: %s", e)
+
+def _subscribe(skateback, connection, args):
+    """
+    'subscribe [fields|all] [rate]': stream telemetry lines to this connection,
+    replacing any earlier subscription. Fields are comma separated.
+    """
+    if connection is None:
+        return "subscribe needs a socket connection"
+    fields = None
+    rate = telemetry.DEFAULT_RATE
+    if args and args[0] != 'all':
+        fields = [field for field in args[0].split(',') if field]
+    if len(args) > 1:
+        rate = float(args[1])
+    subscriber = skateback.telemetry.subscribe(connection.send, fields, rate)
+    if connection.subscriber is not None:
+        skateback.telemetry.unsubscribe(connection.subscriber)
+    connection.subscriber = subscriber
+    return f"Subscribed to {', '.join(subscriber.fields)} at {rate:g} Hz"
+
+def _speed_command(skateback, args):
+    """
+    'speed <m/s> [<right m/s>]': hold a speed with the closed-loop controller.
+    'speed off': back to duty cycle mode at the current duty cycles.
+    'speed': the target speeds and duty cycles as JSON.
+    """
+    if not args:
+        return json.dumps({"targets": skateback.speed_targets,
+                           "duty": [skateback.left_duty_cycle, skateback.right_duty_cycle]})
+    if args[0] == 'off':
+        skateback.set_wheels(skateback.left_duty_cycle, skateback.right_duty_cycle)
+        return "Speed control off"
+    left = float(args[0])
+    right = float(args[1]) if len(args) > 1 else left
+    skateback.set_speed(left, right)
+    return f"Holding speed L: {left:.2f} m/s, R: {right:.2f} m/s"
+
+def _launch_command(skateback, args):
+    """
+    'launch on [max amps] [amps per second]': start from standstill on motor current (see launch.py).
+    'launch off': back to duty cycle starts.
+    'launch': settings, the launch in progress and the latest one as JSON.
+    """
+    if not args:
+        launching = skateback.launch
+        return json.dumps({"settings": skateback.launch_settings,
+                           "active": None if launching is None else launching.stats(),
+                           "last": skateback.last_launch})
+    if args[0] == 'on':
+        max_current = float(args[1]) if len(args) > 1 else launch.MAX_CURRENT
+        current_rate = float(args[2]) if len(args) > 2 else launch.CURRENT_RATE
+        skateback.enable_launch(max_current, current_rate)
+        return f"Launch mode on, {max_current:g} A at {current_rate:g} A/s"
+    if args[0] == 'off':
+        skateback.disable_launch()
+        return "Launch mode off"
+    return f"Unknown launch action: {args[0]}"
+
+def _track_command(skateback, args):
+    """
+    'track [cursor]': the kept track points from sequence number cursor on
+    (default 0), one page of up to track.PAGE_POINTS at a time, as JSON.
+    'points' is the base64 of track.encode()d points and 'next' the cursor
+    for the next page. The latest fix is the 'position' telemetry field.
+    """
+    cursor = int(args[0]) if args else 0
+    first, data, next_cursor = skateback.track.page(cursor)
+    return json.dumps({"first": first, "next": next_cursor, "points": base64.b64encode(data).decode('ascii')})
+
+def _follow_gps(skateback):
+    """
+    Add GPS fixes to the controller's track, and their world position to the
+    flight recorder, until the process exits. Runs on its own thread; the
+    motors do not need the GPS, so failing to open it only disables the track.
+    """
+    import SkateBackGPS     # Pulls in ublox_gps, only needed with --gps
+    try:
+        gps = SkateBackGPS.SkateBackGPS(capture=skateback.capture)
+    except Exception as e:
+        log.warning("GPS track disabled: %s", e)
+        return
+    on_fix = None
+    if skateback.recorder is not None:
+        try:
+            import world    # Pulls in utm and numpy, only needed for the recorder's pose
+            on_fix = lambda lat, lon: skateback.recorder.set_pose(*world.World.gps_to_world(lat, lon))
+        except ImportError as e:
+            log.warning("Flight recorder pose disabled: %s", e)
+    gps.follow(skateback.track, on_fix)
+
+def _follow_lidar(skateback, capture_frames):
+    """
+    Pass the range to the nearest obstacle in every L515 depth frame to the
+    flight recorder until the process exits, and add the frames to the
+    capture if capture_frames is set. Runs on its own thread; failing to open
+    the camera only loses the obstacle range.
+    """
+    import occupancy    # Pulls in numpy, only needed with --lidar
+    import session
+    camera = occupancy.Camera()
+    on_frame = None
+    if skateback.recorder is not None:
+        on_frame = lambda depth: skateback.recorder.set_obstacle(camera.nearest(depth))
+    try:
+        session.capture_depth(skateback.capture if capture_frames else None, threading.Event(), on_frame=on_frame)
+    except Exception as e:
+        log.warning("Lidar disabled: %s", e)
+
+def _stats_command(skateback, args):
+    """
+    'stats': trip statistics (see trip.py) and command tracing as JSON.
+    'stats trip' or 'stats trace': just one of them. 'stats reset': start a new trip.
+    """
+    if not args:
+        return json.dumps({"trip": skateback.trip.stats(), "trace": skateback.tracer.stats()})
+    if args[0] == 'trip':
+        return json.dumps(skateback.trip.stats())
+    if args[0] == 'trace':
+        return json.dumps(skateback.tracer.stats())
+    if args[0] == 'reset':
+        # A fresh object rather than reset(), so the motor tick never sees a half-cleared trip
+        skateback.trip = trip.TripStats()
+        return "Trip reset"
+    return f"Unknown stats action: {args[0]}"
+
+def _profile_command(skateback, args):
+    """
+    'profile': profiler state and per-thread CPU time as JSON.
+    'profile start [rate] [cpu|wall]': start sampling (see profiler.py).
+    'profile stop [name]': stop and dump collapsed stacks to ~/.skateback/name
+    (profile.folded by default).
+    'profile dump [name]': dump without stopping.
+    """
+    profile = skateback.profiler
+    if not args:
+        return json.dumps(profile.stats())
+    if args[0] == 'start':
+        rate = float(args[1]) if len(args) > 1 else profiler.RATE
+        mode = args[2] if len(args) > 2 else 'cpu'
+        profile.start(rate, mode)
+        return f"Profiling at {rate:g} Hz ({mode})"
+    if args[0] in ('stop', 'dump'):
+        path = profiler.dump_path(args[1]) if len(args) > 1 else profiler.DEFAULT_PATH
+        if args[0] == 'stop':
+            profile.stop()
+        path = profile.dump(path)
+        stats = profile.stats()
+        stats["path"] = path
+        return json.dumps(stats)
+    return f"Unknown profile action: {args[0]}"
+
+def _log_command(args):
+    """
+    'log': levels and lost lines as JSON. 'log <level> [logger]': change the
+    level of one logger, or of all of them.
+    """
+    if not args:
+        return json.dumps(logs.stats())
+    level = logs.parse_level(args[0])
+    name = args[1] if len(args) > 1 else None
+    logs.set_level(level, name)
+    return f"Log level {logs.LEVEL_NAMES.get(level, level)} for {name or 'all loggers'}"
 
 # Update the handle_command function for better error handling
-def handle_command(skateback, command):
+def handle_command(skateback, command, connection=None):
     """
     Handle the received command by executing the corresponding action on the skateboard.
+
+    Args:
+        skateback (SkateBack): The controller.
+        command (str): Command line without the newline.
+        connection (Connection): Client that sent it, for commands that stream back.
     """
     try:
-        print(f"Executing command: {command}")  # Debug print
-        if command == 'accelerate':
-            skateback.accelerate()
-            return "Successfully accelerated"
-        elif command == 'decelerate':
-            skateback.decelerate()
-            return "Successfully decelerated"
+        socket_log.debug("Executing command: %s", command)
+        if command in SPEED_COMMANDS:
+            left, right = skateback.change_speed((command,))
+            return _speed_ack(command, left, right)
         elif command == 'stop':
             skateback.stop()
             return "Successfully stopped"
+        elif command == 'estop':
+            skateback.emergency_stop(latch=True)
+            return "Emergency stop latched"
+        elif command == 'estop clear':
+            skateback.clear_emergency_stop()
+            return "Emergency stop cleared"
+        elif command == 'links':
+            return json.dumps({"L": skateback.vesc_left.link_stats(), "R": skateback.vesc_right.link_stats()})
+        elif command == 'speed' or command.startswith('speed '):
+            return _speed_command(skateback, command.split()[1:])
+        elif command == 'launch' or command.startswith('launch '):
+            return _launch_command(skateback, command.split()[1:])
+        elif command == 'log' or command.startswith('log '):
+            return _log_command(command.split()[1:])
+        elif command == 'stats' or command.startswith('stats '):
+            return _stats_command(skateback, command.split()[1:])
+        elif command == 'profile' or command.startswith('profile '):
+            return _profile_command(skateback, command.split()[1:])
+        elif command == 'track' or command.startswith('track '):
+            return _track_command(skateback, command.split()[1:])
+        elif command == 'subscribe' or command.startswith('subscribe '):
+            return _subscribe(skateback, connection, command.split()[1:])
+        elif command == 'unsubscribe':
+            if connection is not None and connection.subscriber is not None:
+                skateback.telemetry.unsubscribe(connection.subscriber)
+                connection.subscriber = None
+            return "Unsubscribed"
+        elif command.startswith('trace '):
+            action = command.split(' ', 1)[1]
+            if action == 'on':
+                skateback.tracer.enabled = True
+            elif action == 'off':
+                skateback.tracer.enabled = False
+            elif action == 'reset':
+                skateback.tracer.reset()
+            else:
+                return f"Unknown trace action: {action}"
+            return f"Tracing {action}"
         else:
             return f"Unknown command: {command}"
     except Exception as e:
         error_msg = f"Error executing command '{command}': {str(e)}"
-        print(error_msg)  # Debug print
+        socket_log.error("%s", error_msg)
         return error_msg
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SkateBack motor control socket server")
+    parser.add_argument("--simulate", action="store_true", help="Run against simulated VESCs instead of hardware")
+    parser.add_argument("--host", default=HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("--record", help=f"Flight recorder file (default {recorder.DEFAULT_PATH}; "
+                                         "none with --simulate)")
+    parser.add_argument("--no-record", action="store_true", help="Run without the flight recorder")
+    parser.add_argument("--gps", action="store_true", help="Record the GPS track for the 'track' command")
+    parser.add_argument("--lidar", action="store_true",
+                        help="Record the range to the nearest obstacle from the L515 in the flight recorder")
+    parser.add_argument("--capture", help="Capture every input into this session directory for replay (see session.py)")
+    parser.add_argument("--capture-depth", action="store_true", help="Also capture the L515 depth stream")
+    args = parser.parse_args()
+
+    flight_recorder = None
+    # A simulated board must not write into the real board's incident recording
+    if not args.no_record and (args.record or not args.simulate):
+        try:
+            flight_recorder = recorder.Recorder(args.record or recorder.DEFAULT_PATH)
+        except Exception as e:
+            # Losing the recorder must not keep the motors from starting
+            log.warning("Flight recorder disabled: %s", e)
+
+    capture = None
+    if args.capture:
+        import session
+        capture = session.Capture(args.capture)
+
     try:
-        skateback = SkateBack()
-        socket_server(skateback)
+        if args.simulate:
+            import vesc_sim
+            board = vesc_sim.SimulatedBoard()
+            skateback = SkateBack(*board.ports, flight_recorder=flight_recorder, capture=capture)
+        else:
+            skateback = SkateBack(flight_recorder=flight_recorder, capture=capture)
+        if args.gps:
+            threading.Thread(target=_follow_gps, args=(skateback,), name="gps", daemon=True).start()
+        # One thread reads the camera for both the recorder and the capture
+        capture_frames = capture is not None and args.capture_depth
+        if args.lidar or capture_frames:
+            threading.Thread(target=_follow_lidar, args=(skateback, capture_frames), name="depth",
+                             daemon=True).start()
+        socket_server(skateback, args.host, args.port)
     except KeyboardInterrupt:
-        print("\nShutting down server...")
+        log.info("Shutting down server...")
     except Exception as e:
-        print(f"Fatal error: {e}")
+        log.error("Fatal error: %s", e)
     finally:
-        print("Server stopped")
\ No newline at end of file
+        if capture is not None:
+            capture.close()
+        log.info("Server stopped")
\ No newline at end of file
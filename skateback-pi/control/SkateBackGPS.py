@@ -1,24 +1,47 @@
+import argparse
+import json
 import serial
-import world
-from ublox_gps import UbloxGps
 import threading
 import time
+import gps_fix
+import logs
+
+log = logs.get('gps')
 
 SERIAL_GPS = '/dev/gps'
 BAUD_RATE = 115200
-READS = 5
+HACC_SCALE = 1e-3   # NAV-PVT reports hAcc in millimetres
+RETRY_DELAY = 0.1       # Wait after a failed reading before the next (s)...
+MAX_RETRY_DELAY = 5.0   # ...doubling each time up to this
 
 class SkateBackGPS:
-    def __init__(self):
+    def __init__(self, receiver=None, capture=None):
+        """
+        Args:
+            receiver: Object answering geo_coords() and veh_attitude() like
+                      UbloxGps, e.g. session.ReplayReceiver. Defaults to the
+                      receiver on SERIAL_GPS.
+            capture (session.Capture): Records every reading for replay.
+        """
         self.location = None    # Last location obtained from calling self.get_location()
         self.heading = None     # Last heading obtained from calling self.get_heading()
+        self.port = None
 
-        try:
-            self.port = serial.Serial(SERIAL_GPS, baudrate=BAUD_RATE, timeout=5)
-            self.gps = UbloxGps(self.port)
-        except serial.SerialException as e:
-           print(f"Error opening serial port {SERIAL_GPS}: {e}")
-           exit(1)
+        if receiver is None:
+            # Imported here so that importing this module stays cheap
+            from ublox_gps import UbloxGps
+
+            try:
+                self.port = serial.Serial(SERIAL_GPS, baudrate=BAUD_RATE, timeout=5)
+                receiver = UbloxGps(self.port)
+            except serial.SerialException as e:
+                # Let the caller decide; the motors can run without a GPS
+                log.error("Error opening serial port %s: %s", SERIAL_GPS, e)
+                raise
+        if capture is not None:
+            import session
+            receiver = session.CapturingReceiver(receiver, capture)
+        self.gps = receiver
 
     def __enter__(self):
         """
@@ -38,70 +61,201 @@ class SkateBackGPS:
         """
         try:            
             # Close serial connections
-            if self.port.is_open:
+            if self.port is not None and self.port.is_open:
                 self.port.close()
         except Exception as e:
-            print(f"An error occurred while closing: {e}")
+            log.error("An error occurred while closing: %s", e)
      
-    def average_coordinates(self, readings):
-        """Calculate the average of a list of (lat, lon) tuples."""
-        avg_lat = sum(r[0] for r in readings) / len(readings)
-        avg_lon = sum(r[1] for r in readings) / len(readings)
-        return (avg_lat, avg_lon)
-
-    def get_location(self):           
-        print("Listening for UBX Messages")
-        readings = []
-        while len(readings) < READS:
-            try:
-                geo = self.gps.geo_coords()
-                if geo is not None:
-                    lat, lon = geo.lat, geo.lon
-                    if lat != 0 and lon != 0:
-                        readings.append((lat, lon))
-                        print(f"Reading {len(readings)}: Latitude = {lat}, Longitude = {lon}")
-                    else:
-                        print("Skipped empty reading. Waiting for position lock...")
-                else:
-                    print("No GPS data received.")
-            except (ValueError, IOError) as err:
-                print("Error in Position Reading:", err)
-        
-        avg_coords = self.average_coordinates(readings)
-        print(f"\nAverage Coordinates: Latitude = {avg_coords[0]:.6f}, Longitude = {avg_coords[1]:.6f}")
-        utm_avg_coords = world.World.gps_to_world(avg_coords[0], avg_coords[1])
-        print(f"\nAverage UTM Coordinates: Latitude = {utm_avg_coords[0]:.6f}, Longitude = {utm_avg_coords[1]:.6f}")
-        
+    def read_fix(self):
+        """
+        Take a single position reading.
+
+        Returns:
+            tuple: (latitude, longitude, horizontal accuracy in m), or None if
+            there is no position lock yet.
+        """
+        try:
+            geo = self.gps.geo_coords()
+        except (ValueError, IOError) as err:
+            log.error("Error in Position Reading: %s", err)
+            return None
+        if geo is None:
+            log.warning("No GPS data received.")
+            return None
+        if geo.lat == 0 or geo.lon == 0:
+            log.info("Skipped empty reading. Waiting for position lock...")
+            return None
+        log.debug("Reading: Latitude = %s, Longitude = %s, hAcc = %s", geo.lat, geo.lon, geo.hAcc)
+        return geo.lat, geo.lon, geo.hAcc * HACC_SCALE
+
+    def read_heading_fix(self):
+        """
+        Take a single vehicle attitude reading with its accuracy.
+
+        Returns:
+            tuple: (heading, heading accuracy) in degrees, or None if no heading
+            is available yet.
+        """
+        try:
+            veh = self.gps.veh_attitude()
+        except (ValueError, IOError) as err:
+            log.error("Error in Heading of Motion Reading: %s", err)
+            return None
+        if veh is None:
+            log.warning("No GPS data received.")
+            return None
+        if veh.heading == 0.0:
+            log.info("Skipped empty reading. Waiting for heading information...")
+            return None
+        log.debug("Reading: Heading of Motion = %s, accHeading = %s", veh.heading, veh.accHeading)
+        return veh.heading, veh.accHeading
+
+    def get_location(self, confidence=gps_fix.LOCATION_CONFIDENCE, max_reads=gps_fix.MAX_READS):
+        """
+        Average position readings, weighted by their reported accuracy, until
+        the position is known to within confidence metres (see gps_fix.py).
+
+        Args:
+            confidence (float): Uncertainty to reach (m).
+            max_reads (int): Readings before settling for what there is.
+
+        Returns:
+            dict: UTM 'latitude' (easting) and 'longitude' (northing) and the
+            'accuracy' reached in metres, or None if there was no fix at all.
+        """
+        log.debug("Listening for UBX Messages")
+        estimate = gps_fix.LocationEstimate()
+        reads = gps_fix.acquire(self.read_fix, estimate, confidence, max_reads)
+        if estimate.value is None:
+            log.warning("No position fix after %d readings", reads)
+            return None
+
+        import world    # Pulls in utm and numpy, only needed for locations
+
+        lat, lon = estimate.value
+        log.info("Average Coordinates: Latitude = %.6f, Longitude = %.6f (+/- %.2f m from %d of %d readings)",
+                 lat, lon, estimate.accuracy, estimate.count, reads)
+        utm_avg_coords = world.World.gps_to_world(lat, lon)
+        log.info("Average UTM Coordinates: Latitude = %.6f, Longitude = %.6f", utm_avg_coords[0], utm_avg_coords[1])
+
         self.location = {
             "latitude": utm_avg_coords[0],
-            "longitude": utm_avg_coords[1]
+            "longitude": utm_avg_coords[1],
+            "accuracy": estimate.accuracy,
         }
         return self.location
 
-    def get_heading(self):            
-        print("Listening for UBX Messages")
-        readings = []
-        while len(readings) < READS:
-            try:
-                veh = self.gps.veh_attitude()
-                if veh is not None:
-                    heading = veh.heading
-                    if heading != 0.0:
-                        readings.append(heading)
-                        print(f"Reading {len(readings)}: Heading of Motion = {heading}")
-                    else:
-                        print("Skipped empty reading. Waiting for heading information...")
-                else:
-                    print("No GPS data received.")
-            except (ValueError, IOError) as err:
-                print("Error in Heading of Motion Reading:", err)
-        
-        avg_reading = sum(readings)/len(readings)
-        print(f"\nAverage Reading: Heading of Motion = {avg_reading:.6f}")
-        self.heading = avg_reading
+    def get_heading(self, confidence=gps_fix.HEADING_CONFIDENCE, max_reads=gps_fix.MAX_READS):
+        """
+        Circular mean of heading readings, weighted by their reported accuracy,
+        until the heading is known to within confidence degrees.
+
+        Args:
+            confidence (float): Uncertainty to reach (degrees).
+            max_reads (int): Readings before settling for what there is.
+
+        Returns:
+            float: Heading in degrees in [0, 360), or None if there was no heading at all.
+        """
+        log.debug("Listening for UBX Messages")
+        estimate = gps_fix.HeadingEstimate()
+        reads = gps_fix.acquire(self.read_heading_fix, estimate, confidence, max_reads)
+        if estimate.value is None:
+            log.warning("No heading after %d readings", reads)
+            return None
+        log.info("Average Reading: Heading of Motion = %.6f (+/- %.2f deg from %d of %d readings)",
+                 estimate.value, estimate.accuracy, estimate.count, reads)
+        self.heading = estimate.value
         return self.heading
 
+    def record(self, path, duration):
+        """
+        Write raw position and heading readings to a JSON lines file, one
+        object per reading pair with the fields t, lat, lon, hAcc (m), heading
+        and headAcc (degrees). Missing readings are null. The benchmark replays
+        these files.
+
+        Args:
+            path (str): File to write.
+            duration (float): Seconds to record for.
+        """
+        started = time.monotonic()
+        with open(path, 'w') as f:
+            while time.monotonic() - started < duration:
+                fix = self.read_fix() or (None, None, None)
+                heading = self.read_heading_fix() or (None, None)
+                line = {"t": round(time.monotonic() - started, 3), "lat": fix[0], "lon": fix[1], "hAcc": fix[2],
+                        "heading": heading[0], "headAcc": heading[1]}
+                f.write(json.dumps(line) + "\n")
+
+    def follow(self, track, on_fix=None):
+        """
+        Add every position fix to a track (see track.py). Never returns; run it
+        on its own thread.
+
+        A reading that fails, e.g. with the receiver unplugged, or that has no
+        lock yet returns at once, so the loop waits RETRY_DELAY before the
+        next, doubling up to MAX_RETRY_DELAY while readings keep failing.
+
+        Args:
+            track (track.Track): Track to feed.
+            on_fix (function): Also called with (latitude, longitude) for every fix.
+        """
+        delay = RETRY_DELAY
+        while True:
+            fix = self.track_fix(track, time.monotonic())
+            if fix is None:
+                time.sleep(delay)
+                delay = min(2 * delay, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            if on_fix is not None:
+                try:
+                    on_fix(fix[0], fix[1])
+                except Exception as e:
+                    log.error("Error handling GPS fix: %s", e)
+
+    def track_fix(self, track, t):
+        """
+        Take a single position reading and add it to a track.
+
+        Args:
+            track (track.Track): Track to feed.
+            t (float): Time of the reading (s).
+
+        Returns:
+            tuple: The fix as from read_fix(), or None.
+        """
+        fix = self.read_fix()
+        if fix is not None:
+            track.add(fix[0], fix[1], t)
+        return fix
+
+    def read_heading(self):
+        """
+        Take a single vehicle attitude reading, for closed-loop turns (see SkateBack.turn).
+
+        Returns:
+            float: Heading in degrees, or None if no heading is available yet.
+        """
+        try:
+            veh = self.gps.veh_attitude()
+        except (ValueError, IOError) as err:
+            log.error("Error in Heading of Motion Reading: %s", err)
+            return None
+        if veh is None or veh.heading == 0.0:
+            return None
+        return veh.heading
+
 if __name__ == '__main__':
-   sk_gps = SkateBackGPS()
-   sk_gps.get_heading()
-   sk_gps.get_location()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Read the SkateBack GPS")
+    parser.add_argument("--record", help="Record raw readings to this JSON lines file instead")
+    parser.add_argument("--seconds", type=float, default=60.0, help="How long to record for")
+    args = parser.parse_args()
+
+    sk_gps = SkateBackGPS()
+    if args.record:
+        sk_gps.record(args.record, args.seconds)
+    else:
+        sk_gps.get_heading()
+        sk_gps.get_location()
\ No newline at end of file
@@ -0,0 +1,1898 @@
+"""
+Control-path benchmarks, run against simulated VESCs (vesc_sim.py).
+
+Each benchmark starts a fresh SkateBack on a SimulatedBoard, drives it the way
+the BLE bridge does (newline-terminated commands on the control socket) and
+times what the simulated VESCs actually receive. Results are written as JSON so
+runs can be compared across changes.
+
+Usage:
+    python benchmark.py                        # all benchmarks, JSON to stdout
+    python benchmark.py -o before.json         # write to a file
+    python benchmark.py --only tick_jitter     # a single benchmark
+"""
+import argparse
+import base64
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+import pyvesc
+from pyvesc.VESC.messages import GetValues, SetCurrent, SetDutyCycle
+import serial
+import SkateBack
+import clocks
+import gps_fix
+import launch
+import logs
+import odometry
+import recorder
+import speed
+import tracing
+import track
+import trip
+import vesc
+import vesc_sim
+
+HOST = '127.0.0.1'
+
+# motors/ is a package next to control/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+VERBS = ['accelerate', 'decelerate', 'stop']
+RATES = [25, 50, 100, 200, 400, 800, 1600, 3200, 6400]     # Offered command rates for the throughput sweep (cmd/s)
+GPS_NAV_RATE = 1.0      # Receiver solutions per second, the u-blox default
+OLD_GPS_READS = 5       # Fixes the old acquisition always averaged
+
+
+def summarize(samples, scale=1000.0):
+    """
+    Summarize a list of durations in seconds.
+
+    Args:
+        samples (list): Durations in seconds.
+        scale (float): Multiplier for the reported values, 1000 gives milliseconds.
+
+    Returns:
+        dict: count, mean, stdev, min, p50, p90, p99 and max.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[index] * scale
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered) * scale,
+        "stdev": statistics.pstdev(ordered) * scale,
+        "min": ordered[0] * scale,
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": ordered[-1] * scale,
+    }
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def controller(flight_recorder=None, capture=None, **sim_kwargs):
+    """
+    Start a SimulatedBoard, a SkateBack on top of it and its socket server.
+    Keyword arguments other than flight_recorder and capture go to the SimulatedBoard.
+
+    Yields:
+        tuple: (board, skateback, port)
+    """
+    with vesc_sim.SimulatedBoard(**sim_kwargs) as board:
+        skateback = SkateBack.SkateBack(*board.ports, flight_recorder=flight_recorder, capture=capture)
+        port = free_port()
+        server = threading.Thread(target=SkateBack.socket_server, args=(skateback, HOST, port), daemon=True)
+        server.start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((HOST, port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.01)
+        try:
+            yield board, skateback, port
+        finally:
+            skateback.close()
+
+
+class Client:
+    def __init__(self, port):
+        """
+        Line-oriented client for the control socket, like the BLE bridge.
+        """
+        self.sock = socket.create_connection((HOST, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('r', encoding='utf-8')
+
+    def send(self, command):
+        self.sock.sendall((command + '\n').encode('utf-8'))
+
+    def readline(self):
+        return self.file.readline().strip()
+
+    def command(self, command):
+        self.send(command)
+        return self.readline()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def duty_of(frame):
+    return getattr(frame.message, 'duty_cycle', None)
+
+
+def bench_command_latency(samples=30):
+    """
+    Socket-command-to-first-serial-frame latency for each handle_command verb.
+
+    For every sample the wheels are put in a known state, the command is sent,
+    and the latency is the time until the left VESC receives a frame whose duty
+    cycle differs from the one before the command. Commands are sent at a
+    random phase of the motor tick.
+    """
+    results = {}
+    with controller() as (board, skateback, port):
+        client = Client(port)
+        for verb in VERBS:
+            latencies = []
+            for _ in range(samples):
+                start_duty = 0.3 if verb == 'stop' else 0.0
+                skateback.set_duty_cycle("L", start_duty)
+                skateback.set_duty_cycle("R", start_duty)
+                baseline = board.left.wait_for_frame(lambda f: duty_of(f) == -start_duty)
+                if baseline is None:
+                    continue
+                # Land at a random phase of the 50 ms motor tick
+                time.sleep(random.uniform(0, 0.05))
+
+                sent = time.perf_counter()
+                client.send(verb)
+                frame = board.left.wait_for_frame(
+                    lambda f: f.time > sent and duty_of(f) is not None and duty_of(f) != -start_duty)
+                client.readline()
+                if frame is not None:
+                    latencies.append(frame.time - sent)
+            results[verb] = summarize(latencies)
+        client.close()
+    return results
+
+
+def bench_tick_jitter(duration=5.0):
+    """
+    Distribution of the period between consecutive motor frames on each wheel
+    while the controller is idle.
+    """
+    results = {}
+    with controller() as (board, skateback, port):
+        time.sleep(0.5)
+        start = time.perf_counter()
+        time.sleep(duration)
+        for name, sim in (("L", board.left), ("R", board.right)):
+            times = [f.time for f in list(sim.frames) if f.time >= start and duty_of(f) is not None]
+            periods = [b - a for a, b in zip(times, times[1:])]
+            summary = summarize(periods)
+            summary["target"] = 50.0
+            results[name] = summary
+    return results
+
+
+def _offered_load(port, rate, duration):
+    """
+    Send alternating accelerate/decelerate at a fixed rate on one connection
+    and read acks on another thread.
+    """
+    client = Client(port)
+    acked = []
+
+    def reader(expected):
+        for _ in range(expected):
+            if not client.readline():
+                break
+            acked.append(time.perf_counter())
+
+    count = int(rate * duration)
+    thread = threading.Thread(target=reader, args=(count,), daemon=True)
+    thread.start()
+
+    start = time.perf_counter()
+    for i in range(count):
+        target = start + i / rate
+        delay = target - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        client.send('accelerate' if i % 2 == 0 else 'decelerate')
+    last_sent = time.perf_counter()
+    thread.join(timeout=duration + 10)
+    client.close()
+
+    drain = (acked[-1] - last_sent) if acked else float('inf')
+    return {
+        "offered": rate,
+        "sent": count,
+        "acked": len(acked),
+        "achieved": len(acked) / (acked[-1] - start) if len(acked) > 1 else 0.0,
+        "drain_ms": max(0.0, drain) * 1000,
+    }
+
+
+def bench_throughput(duration=2.0, rates=RATES):
+    """
+    Maximum sustained command rate before the command queue backs up.
+
+    A rate is sustained when every command is acked and the last ack arrives
+    within one motor tick of the last send.
+    """
+    steps = []
+    sustained = 0
+    with controller() as (board, skateback, port):
+        for rate in rates:
+            step = _offered_load(port, rate, duration)
+            step["sustained"] = step["acked"] == step["sent"] and step["drain_ms"] <= 50.0
+            steps.append(step)
+            skateback.emergency_stop()
+            if not step["sustained"]:
+                break
+            sustained = rate
+    return {"max_sustained_rate": sustained, "steps": steps}
+
+
+def bench_multi_board(boards=2, clients=4, rate=25.0, duration=5.0):
+    """
+    Capacity baseline for the control server: several simulated boards, one
+    server process each, driven at once by concurrent clients sending the
+    remote's and the app's command mixes (see loadtest.py). Servers log at
+    their default level, as on the board.
+    """
+    import loadtest     # Imports this module for its helpers
+    report = loadtest.run(boards, clients, rate, duration, ("ride", "dashboard"))
+    return {"settings": report["settings"], "total": report["total"],
+            "per_board_p99_ms": [board["latency_ms"].get("p99") for board in report["boards"]]}
+
+
+def bench_burst(samples=10, taps=20):
+    """
+    End-to-end latency of a burst of taps sent back to back, as the BLE bridge
+    forwards them: from the last tap leaving the client until the VESC receives
+    the burst's final duty cycle, and until the last ack arrives.
+    """
+    to_frame, to_ack = [], []
+    with controller() as (board, skateback, port):
+        client = Client(port)
+        for i in range(samples):
+            verb = 'accelerate' if i % 2 == 0 else 'decelerate'
+            target = skateback.get_duty_cycle("L")
+            for _ in range(taps):
+                target = SkateBack._accelerated(target) if verb == 'accelerate' else SkateBack._decelerated(target)
+
+            acked = []
+
+            def reader():
+                for _ in range(taps):
+                    client.readline()
+                acked.append(time.perf_counter())
+
+            thread = threading.Thread(target=reader, daemon=True)
+            # Land at a random phase of the 50 ms motor tick
+            time.sleep(random.uniform(0, 0.05))
+            thread.start()
+            client.sock.sendall(''.join(verb + '\n' for _ in range(taps)).encode('utf-8'))
+            sent = time.perf_counter()
+            frame = board.left.wait_for_frame(
+                lambda f: f.time > sent and duty_of(f) is not None and abs(duty_of(f) + target) < 1e-4, timeout=10)
+            thread.join(timeout=10)
+            if frame is not None:
+                to_frame.append(frame.time - sent)
+            if acked:
+                to_ack.append(acked[0] - sent)
+        client.close()
+    return {"taps": taps, "to_final_frame": summarize(to_frame), "to_last_ack": summarize(to_ack)}
+
+
+def bench_stop_to_zero(samples=10, duty_cycle=0.3):
+    """
+    Time from sending 'stop' until the VESCs receive a zero duty cycle frame.
+    """
+    latencies = []
+    with controller() as (board, skateback, port):
+        client = Client(port)
+        for _ in range(samples):
+            skateback.set_duty_cycle("L", duty_cycle)
+            skateback.set_duty_cycle("R", duty_cycle)
+            if board.left.wait_for_frame(lambda f: duty_of(f) == -duty_cycle) is None:
+                continue
+            sent = time.perf_counter()
+            client.send('stop')
+            frame = board.left.wait_for_frame(lambda f: f.time > sent and duty_of(f) == 0, timeout=5)
+            client.readline()
+            if frame is not None:
+                latencies.append(frame.time - sent)
+        client.close()
+    return summarize(latencies)
+
+
+def bench_estop(samples=10, duty_cycle=0.4):
+    """
+    Time from sending 'estop' in the middle of a stop() ramp until both VESCs
+    receive zero current, and how many non-zero duty frames follow it.
+    """
+    latencies = []
+    leaks = 0
+    with controller() as (board, skateback, port):
+        client = Client(port)
+        for _ in range(samples):
+            skateback.set_duty_cycle("L", duty_cycle)
+            skateback.set_duty_cycle("R", duty_cycle)
+            if board.left.wait_for_frame(lambda f: duty_of(f) == -duty_cycle) is None:
+                continue
+            client.send('stop')
+            time.sleep(random.uniform(0.1, 0.5))
+
+            sent = time.perf_counter()
+            client.send('estop')
+            stopped = [sim.wait_for_frame(lambda f: f.time > sent and isinstance(f.message, SetCurrent), timeout=5)
+                       for sim in (board.left, board.right)]
+            # Let a few more ticks through to catch any ramp step written after the stop
+            time.sleep(0.2)
+            for sim, frame in zip((board.left, board.right), stopped):
+                if frame is not None:
+                    leaks += sum(1 for f in list(sim.frames) if f.time > frame.time and duty_of(f))
+            client.readline()
+            client.readline()
+            client.command('estop clear')
+            if None not in stopped:
+                latencies.append(max(frame.time for frame in stopped) - sent)
+        client.close()
+    result = summarize(latencies)
+    result["nonzero_frames_after_estop"] = leaks
+    return result
+
+
+def bench_turns(repeats=5, angles=(45, 90, 180)):
+    """
+    Closed-loop pivot turns on wheel odometry: how far each turn ends from the
+    requested angle (degrees) and how long it takes, including settling (ms).
+    The turns run in order on one controller from TURN_STOP_LEAD, so
+    errors_deg shows whether the first turns after a start are already on
+    target and the learned estimate stays there; stop_lead is where it ends.
+    """
+    results = {}
+    with controller() as (board, skateback, port):
+        for angle in angles:
+            errors, durations = [], []
+            for i in range(repeats):
+                direction = 1 if i % 2 == 0 else -1
+                start = time.perf_counter()
+                turned = skateback.turn(direction * angle)
+                durations.append(time.perf_counter() - start)
+                errors.append(direction * turned - angle)
+            results[str(angle)] = {"error_deg": summarize(errors, scale=1.0), "errors_deg": [round(e, 1) for e in errors],
+                                   "duration": summarize(durations)}
+        results["stop_lead"] = skateback.turn_stop_lead
+    return results
+
+
+def bench_telemetry(subscribers=12, iterations=2000, duration=3.0):
+    """
+    Cost of one telemetry tick with many subscribers, and a slow subscriber's
+    effect on the motor ticks.
+
+    serialize_us is the mean time to sample, serialize and hand out one tick's
+    lines with every subscriber due, spread over three field selections;
+    publish_us adds the two GetValues requests. For the slow subscriber test one
+    client takes 200 ms per line while subscribed at 20 Hz; its lines are
+    replaced rather than queued and the motor tick period should not move.
+    """
+    result = {}
+    with controller() as (board, skateback, port):
+        selections = [None, ("speed", "voltage"), ("duty_left", "duty_right", "estop")]
+        subs = [skateback.telemetry.subscribe(lambda line: None, selections[i % len(selections)], 20.0)
+                for i in range(subscribers)]
+        time.sleep(0.2)
+        for name, publish in (("serialize_us", lambda: skateback.telemetry.offer_due(subs, skateback.clock.time())),
+                              ("publish_us", skateback.telemetry.publish)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                for sub in subs:
+                    sub.next_due = 0.0
+                publish()
+            result[name] = (time.perf_counter() - start) / iterations * 1e6
+        result["subscribers"] = subscribers
+        for sub in subs:
+            skateback.telemetry.unsubscribe(sub)
+
+        slow = skateback.telemetry.subscribe(lambda line: time.sleep(0.2), None, 20.0)
+        started = time.perf_counter()
+        time.sleep(duration)
+        skateback.telemetry.unsubscribe(slow)
+        times = [f.time for f in list(board.left.frames) if f.time >= started and duty_of(f) is not None]
+        result["slow_subscriber"] = {
+            "sent": slow.sent,
+            "replaced": slow.replaced,
+            "tick_period": summarize([b - a for a, b in zip(times, times[1:])]),
+        }
+    return result
+
+
+IMPORT_PROBE = """
+import sys, time
+started = time.perf_counter()
+import SkateBack
+print(time.perf_counter() - started)
+print(','.join(name for name in ('numpy', 'utm', 'keyboard', 'ublox_gps') if name in sys.modules))
+"""
+
+
+def bench_startup(repeats=5):
+    """
+    Service startup in fresh interpreters: time to import SkateBack (and which
+    heavy optional modules it dragged in), and time from launching
+    'SkateBack.py --simulate' until the first command is answered.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports, first_command = [], []
+    loaded = ""
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=here, capture_output=True, text=True,
+                             check=True).stdout.splitlines()
+        imports.append(float(out[0]))
+        loaded = out[1] if len(out) > 1 else ""
+
+        port = free_port()
+        started = time.perf_counter()
+        server = subprocess.Popen([sys.executable, "SkateBack.py", "--simulate", "--no-record",
+                                   "--host", HOST, "--port", str(port)], cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    client = Client(port)
+                    break
+                except OSError:
+                    if time.perf_counter() - started > 30 or server.poll() is not None:
+                        raise RuntimeError("SkateBack.py --simulate did not start")
+                    time.sleep(0.002)
+            client.command('trace off')
+            first_command.append(time.perf_counter() - started)
+            client.close()
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        "import": summarize(imports),
+        "heavy_modules_loaded": [name for name in loaded.split(',') if name],
+        "time_to_first_command": summarize(first_command),
+    }
+
+
+def bench_reconnect(samples=10, duty_cycle=0.2):
+    """
+    Hot-plug recovery: the left simulated VESC disappears for 100-300 ms and
+    comes back on the same path while the wheels are running.
+
+    reopen is the transport's own metric, from noticing the loss to the port
+    being open again. back_to_setpoint is from the device reappearing until it
+    receives the current duty cycle. right_gap is the longest pause in the
+    right wheel's frames during the outages, which should stay one tick.
+    """
+    back = []
+    right_gaps = []
+    with controller() as (board, skateback, port):
+        skateback.set_wheels(duty_cycle, duty_cycle)
+        board.left.wait_for_frame(lambda f: duty_of(f) == -duty_cycle)
+        for _ in range(samples):
+            started = time.perf_counter()
+            board.left.disconnect()
+            time.sleep(random.uniform(0.1, 0.3))
+            returned = time.perf_counter()
+            board.left.reconnect()
+            frame = board.left.wait_for_frame(lambda f: f.time > returned and duty_of(f) == -duty_cycle, timeout=5)
+            if frame is not None:
+                back.append(frame.time - returned)
+            times = [f.time for f in list(board.right.frames) if f.time >= started]
+            right_gaps.append(max(b - a for a, b in zip(times, times[1:])))
+            time.sleep(0.2)
+        stats = skateback.vesc_left.link_stats()
+        reopen = list(skateback.vesc_left.reconnect_times)
+    return {
+        "disconnects": stats["disconnects"],
+        "reopen": summarize(reopen),
+        "back_to_setpoint": summarize(back),
+        "right_gap": summarize(right_gaps),
+    }
+
+
+CRASH_PROBE = """
+import os, signal, sys
+import recorder
+flight = recorder.Recorder(sys.argv[1], capacity=int(sys.argv[2]))
+for i in range(int(sys.argv[3])):
+    flight.tick(i * 0.05, 0, 0.1, 0.1, None, None, None)
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def bench_recorder(iterations=100000, crash_records=5000, duration=3.0):
+    """
+    Flight recorder: cost of one tick record on the hot path, next to the
+    print-a-line logging it replaces; records that survive the writer being
+    SIGKILLed without a flush; and a live controller's recording, whose ticks
+    should be 50 ms apart with every command in between.
+    """
+    import tempfile
+    import numpy as np
+    result = {}
+    sample = GetValues()
+    for name in ('rpm', 'v_in', 'avg_input_current', 'tachometer'):
+        setattr(sample, name, 0)
+    with tempfile.TemporaryDirectory() as directory:
+        flight = recorder.Recorder(os.path.join(directory, 'bench.rec'), capacity=4096)
+        start = time.perf_counter_ns()
+        for i in range(iterations):
+            flight.tick(i * 0.05, 0, 0.1, 0.1, sample, sample, 0.0)
+        result["tick_ns"] = (time.perf_counter_ns() - start) / iterations
+        start = time.perf_counter_ns()
+        for i in range(iterations):
+            flight.event(recorder.COMMAND, 'accelerate', i * 0.05)
+        result["event_ns"] = (time.perf_counter_ns() - start) / iterations
+        flight.close()
+
+        with open(os.path.join(directory, 'bench.log'), 'w') as log:
+            start = time.perf_counter_ns()
+            for i in range(iterations):
+                print(f"{i * 0.05:.3f} L: {0.1} R: {0.1} rpm {0} {0} v {0} i {0}", file=log)
+            result["print_line_ns"] = (time.perf_counter_ns() - start) / iterations
+
+        path = os.path.join(directory, 'crash.rec')
+        here = os.path.dirname(os.path.abspath(__file__))
+        crashed = subprocess.run([sys.executable, "-c", CRASH_PROBE, path, "8192", str(crash_records)],
+                                 cwd=here, capture_output=True)
+        records = recorder.read(path)
+        result["crash"] = {
+            "signal": -crashed.returncode,
+            "written": crash_records,
+            "recovered": int((records['kind'] == recorder.TICK).sum()),
+        }
+
+        path = os.path.join(directory, 'live.rec')
+        with controller(flight_recorder=recorder.Recorder(path)) as (board, skateback, port):
+            client = Client(port)
+            sent = 0
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                client.command(random.choice(VERBS[:2]))
+                sent += 1
+                time.sleep(0.1)
+            client.close()
+        records = recorder.read(path)
+        ticks = records[records['kind'] == recorder.TICK]
+        result["live"] = {
+            "commands_sent": sent,
+            "commands_recorded": int((records['kind'] == recorder.COMMAND).sum()),
+            "ticks": len(ticks),
+            "ticks_with_telemetry": int((~np.isnan(ticks['erpm_left'])).sum()),
+            "tick_period": summarize(list(np.diff(ticks['t']))),
+        }
+    return result
+
+
+def _hold_speed(board, start, target, duration, period=0.01):
+    """
+    Sample both simulated wheels' true speed after start() until duration has
+    passed.
+
+    Returns:
+        dict: settling time to within 5% of target (None if it never settled),
+        RMS tracking error and mean left/right speed difference over the second
+        half, both in percent of target, heading drift over the second half in
+        degrees per second, and how far the board turned over the whole run.
+    """
+    samples = []
+    start()
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        # The wheels turn forward for a negative duty cycle on the wire
+        samples.append((time.perf_counter() - started,
+                        -board.left.erpm / speed.ERPM_PER_MPS, -board.right.erpm / speed.ERPM_PER_MPS))
+        time.sleep(period)
+
+    settled = None
+    for t, left, right in reversed(samples):
+        if max(abs(left - target), abs(right - target)) > 0.05 * target:
+            break
+        settled = t
+    tail = samples[len(samples) // 2:]
+    errors = [e for _, left, right in tail for e in (left - target, right - target)]
+    return {
+        "settling_s": settled,
+        "tracking_rms_pct": 100 * math.sqrt(statistics.fmean(e * e for e in errors)) / target,
+        "left_right_pct": 100 * statistics.fmean(abs(left - right) for _, left, right in tail) / target,
+        "drift_deg_s": math.degrees(statistics.fmean(left - right for _, left, right in tail)
+                                    / odometry.TRACK_WIDTH),
+        "heading_change_deg": math.degrees(sum((a[1] - a[2]) * (b[0] - a[0]) for a, b in zip(samples, samples[1:]))
+                                           / odometry.TRACK_WIDTH),
+    }
+
+
+def bench_speed_control(target=1.5, duration=4.0):
+    """
+    Driving straight at target m/s from standstill, open loop against the
+    closed-loop speed controller, on a fresh pack, on a nearly empty pack and
+    with 3 A of extra load on the left wheel.
+
+    The open-loop duty cycle is calibrated to give the target on the fresh
+    pack with no load, so its errors elsewhere are what battery and load do to
+    a fixed duty cycle. Speeds are the simulated wheels' true speeds.
+    """
+    scenarios = {
+        "fresh": {},
+        "low_battery": {"amp_hours": 0.85 * vesc_sim.CAPACITY_AH},
+        "left_load": {"load": 3.0},
+    }
+
+    def prepare(board, scenario):
+        for vesc in (board.left, board.right):
+            vesc.amp_hours = scenario.get("amp_hours", 0.0)
+        board.left.load = scenario.get("load", 0.0)
+
+    # Steady-state ERPM per duty on a fresh pack, for the open-loop duty cycle
+    probe = 0.1
+    with controller() as (board, skateback, port):
+        skateback.set_wheels(probe, probe)
+        time.sleep(3.0)
+        open_loop_duty = probe * target * speed.ERPM_PER_MPS / -board.left.erpm
+
+    result = {"open_loop_duty": open_loop_duty}
+    for name, scenario in scenarios.items():
+        result[name] = {}
+        for mode in ("open_loop", "closed_loop"):
+            with controller() as (board, skateback, port):
+                prepare(board, scenario)
+                time.sleep(0.1)
+                if mode == "open_loop":
+                    start = lambda: skateback.ramp_wheels(open_loop_duty, open_loop_duty, step=speed.MAX_DUTY_STEP)
+                else:
+                    start = lambda: skateback.set_speed(target)
+                result[name][mode] = _hold_speed(board, start, target, duration)
+    return result
+
+
+def _gps_stream(rng, scenario, length=60):
+    """
+    A synthetic GPS recording in the SkateBackGPS.record() format, shaped like
+    the kind of sky the scenario names, and its true (lat, lon, heading).
+    """
+    lat, lon = 37.8719 + rng.uniform(-0.01, 0.01), -122.2585 + rng.uniform(-0.01, 0.01)
+    heading = rng.uniform(-2.0, 2.0) % 360.0 if scenario == "heading_wrap" else rng.uniform(20.0, 340.0)
+    lines = []
+    for i in range(length):
+        h_acc, head_acc, bias = {
+            "open_sky": (0.8, 1.5, 0.0),
+            "warm_start": (max(1.0, 15.0 * 0.75 ** i), max(1.5, 20.0 * 0.75 ** i), 0.0),
+            "urban": (3.0, 4.0, rng.uniform(15.0, 40.0) if rng.random() < 0.15 else 0.0),   # Multipath jumps
+            "heading_wrap": (0.8, 2.0, 0.0),
+        }[scenario]
+        line = {"t": i / GPS_NAV_RATE, "lat": None, "lon": None, "hAcc": None, "heading": None, "headAcc": None}
+        empty = (scenario == "warm_start" and i < 3) or (scenario == "urban" and rng.random() < 0.1)
+        if not empty:
+            angle = rng.uniform(0.0, 2 * math.pi)
+            east = rng.gauss(0.0, h_acc) + bias * math.cos(angle)
+            north = rng.gauss(0.0, h_acc) + bias * math.sin(angle)
+            line["lat"] = lat + north / gps_fix.METERS_PER_DEG_LAT
+            line["lon"] = lon + east / (gps_fix.METERS_PER_DEG_LON * math.cos(math.radians(lat)))
+            line["hAcc"] = h_acc
+            line["heading"] = (heading + rng.gauss(0.0, head_acc) + (bias * 2 if bias else 0.0)) % 360.0
+            line["headAcc"] = head_acc
+        lines.append(json.dumps(line))
+    return lines, (lat, lon, heading)
+
+
+def _gps_errors(lat, lon, heading, truth):
+    north = (lat - truth[0]) * gps_fix.METERS_PER_DEG_LAT
+    east = (lon - truth[1]) * gps_fix.METERS_PER_DEG_LON * math.cos(math.radians(truth[0]))
+    return math.hypot(north, east), abs(gps_fix._angle_difference(heading, truth[2]))
+
+
+def _replay_gps(lines):
+    """
+    Reading functions over a recording for gps_fix.acquire(), plus the same
+    readings as lists for the old fixed-count averaging.
+    """
+    readings = [json.loads(line) for line in lines]
+    fixes = [(r["lat"], r["lon"], r["hAcc"]) if r["lat"] else None for r in readings]
+    headings = [(r["heading"], r["headAcc"]) if r["heading"] else None for r in readings]
+    return fixes, headings
+
+
+def bench_gps_fix(streams=200, recordings=()):
+    """
+    Time to fix and error for the old acquisition (the unweighted mean of the
+    first OLD_GPS_READS fixes, headings averaged arithmetically) against
+    gps_fix.acquire() at its default confidences, replaying GPS recordings at
+    GPS_NAV_RATE.
+
+    The streams are seeded synthetic recordings for open sky, a warm start
+    whose accuracy improves from 15 m, urban multipath with jumps and missing
+    fixes, and a heading near north. Recordings made with
+    'SkateBackGPS.py --record' can be added; their truth is taken as the
+    accuracy-weighted mean of the whole recording.
+    """
+    rng = random.Random(42)
+    cases = {scenario: [_gps_stream(rng, scenario) for _ in range(streams)]
+             for scenario in ("open_sky", "warm_start", "urban", "heading_wrap")}
+    for path in recordings:
+        with open(path) as f:
+            lines = f.read().splitlines()
+        fixes, headings = _replay_gps(lines)
+        location, heading = gps_fix.LocationEstimate(), gps_fix.HeadingEstimate()
+        for fix in filter(None, fixes):
+            location.add(*fix)
+        for reading in filter(None, headings):
+            heading.add(*reading)
+        cases.setdefault("recorded", []).append((lines, location.value + (heading.value,)))
+
+    result = {}
+    for scenario, recorded in cases.items():
+        times = {"old": [], "adaptive": []}
+        location_errors = {"old": [], "adaptive": []}
+        heading_errors = {"old": [], "adaptive": []}
+        for lines, truth in recorded:
+            fixes, headings = _replay_gps(lines)
+
+            # Old: wait for OLD_GPS_READS fixes and headings, mean of each
+            found = [i for i, fix in enumerate(fixes) if fix][:OLD_GPS_READS]
+            found_headings = [i for i, h in enumerate(headings) if h][:OLD_GPS_READS]
+            lat = statistics.fmean(fixes[i][0] for i in found)
+            lon = statistics.fmean(fixes[i][1] for i in found)
+            mean_heading = statistics.fmean(headings[i][0] for i in found_headings)
+            times["old"].append((found[-1] + 1 + found_headings[-1] + 1) / GPS_NAV_RATE)
+            location_error, heading_error = _gps_errors(lat, lon, mean_heading, truth)
+            location_errors["old"].append(location_error)
+            heading_errors["old"].append(heading_error)
+
+            # Adaptive: stop at the requested confidence
+            location, heading = gps_fix.LocationEstimate(), gps_fix.HeadingEstimate()
+            reads = gps_fix.acquire(iter(fixes).__next__, location, gps_fix.LOCATION_CONFIDENCE)
+            heading_reads = gps_fix.acquire(iter(headings).__next__, heading, gps_fix.HEADING_CONFIDENCE)
+            times["adaptive"].append((reads + heading_reads) / GPS_NAV_RATE)
+            location_error, heading_error = _gps_errors(*location.value, heading.value, truth)
+            location_errors["adaptive"].append(location_error)
+            heading_errors["adaptive"].append(heading_error)
+
+        result[scenario] = {
+            method: {
+                "time_to_fix_s": summarize(times[method], scale=1.0),
+                "location_error_m": summarize(location_errors[method], scale=1.0),
+                "heading_error_deg": summarize(heading_errors[method], scale=1.0),
+            }
+            for method in times
+        }
+    return result
+
+
+def _geofence_zones(rng, count, extent):
+    """
+    Synthetic no-go zones: rotated rectangular buildings, a few of them with
+    courtyards, and long thin roads, scattered over extent x extent metres.
+    """
+    zones = []
+    for number in range(count):
+        cx, cy, angle = rng.uniform(0, extent), rng.uniform(0, extent), rng.uniform(0, math.pi)
+        if number % 20 == 0:
+            half_length, half_width = rng.uniform(100, 400), rng.uniform(4, 8)    # Road
+        else:
+            half_length, half_width = rng.uniform(5, 25), rng.uniform(5, 15)      # Building
+        c, s = math.cos(angle), math.sin(angle)
+
+        def rectangle(a, b):
+            return [(cx + c * x - s * y, cy + s * x + c * y) for x, y in ((-a, -b), (a, -b), (a, b), (-a, b))]
+
+        rings = [rectangle(half_length, half_width)]
+        if number % 10 == 5:
+            rings.append(rectangle(half_length / 3, half_width / 3))
+        zones.append((f"zone {number}", rings))
+    return zones
+
+
+def bench_geofence(zones=5000, extent=3000.0, queries=5000, path_points=2000, margin=2.0):
+    """
+    Geofence index build time and query latency over thousands of zones:
+    single point zone and boundary distance queries, as on every pose update,
+    and checking a whole candidate path at once. The off grid row asks for
+    distances from points 2 to 30 times extent away, as after a GPS glitch.
+    The brute force rows test every edge of every zone with numpy, for
+    comparison.
+    """
+    import numpy as np
+    import geofence
+    rng = random.Random(43)
+    started = time.perf_counter()
+    fence = geofence.Geofence(_geofence_zones(rng, zones, extent))
+    build = time.perf_counter() - started
+    points = [(rng.uniform(0, extent), rng.uniform(0, extent)) for _ in range(queries)]
+    far = []
+    for _ in range(queries // 10):
+        bearing, radius = rng.uniform(0, 2 * math.pi), rng.uniform(2, 30) * extent
+        far.append((extent / 2 + radius * math.cos(bearing), extent / 2 + radius * math.sin(bearing)))
+
+    def per_point(query, points=points):
+        samples = []
+        for x, y in points:
+            started = time.perf_counter()
+            query(x, y)
+            samples.append(time.perf_counter() - started)
+        return summarize(samples, scale=1e6)
+
+    x0, y0, x1, y1 = fence.edges.T
+
+    def brute_force(x, y):
+        crosses = ((y0 > y) != (y1 > y)) & (x < x0 + (y - y0) * (x1 - x0) / np.where(y1 != y0, y1 - y0, 1.0))
+        inside = np.bincount(fence.edge_zone, weights=crosses, minlength=len(fence.names)) % 2
+        return np.nonzero(inside)[0], geofence._segment_distance(x, y, x0, y0, x1, y1).min()
+
+    # A winding path across the area, about 0.25 m between points
+    heading = rng.uniform(0, 2 * math.pi)
+    path = [(extent / 2, extent / 2)]
+    for _ in range(path_points - 1):
+        heading += rng.gauss(0.0, 0.05)
+        path.append((path[-1][0] + 0.25 * math.cos(heading), path[-1][1] + 0.25 * math.sin(heading)))
+    path = np.array(path)
+    path_samples = []
+    for _ in range(20):
+        started = time.perf_counter()
+        fence.check_path(path, margin)
+        path_samples.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    for x, y in path[:200].tolist():
+        brute_force(x, y)
+    brute_path = (time.perf_counter() - started) / 200 * len(path)
+
+    return {
+        "zones": zones,
+        "edges": len(fence.edges),
+        "cells": fence.nx * fence.ny,
+        "build_s": build,
+        "zone_at_us": per_point(fence.zone_at),
+        "distance_us": per_point(fence.distance),
+        "distance_within_margin_us": per_point(lambda x, y: fence.distance(x, y, margin)),
+        "distance_off_grid_us": per_point(fence.distance, far),
+        "brute_force_us": per_point(brute_force),
+        "check_path": {
+            "points": path_points,
+            "ms": summarize(path_samples),
+            "per_point_us": statistics.fmean(path_samples) / path_points * 1e6,
+            "brute_force_ms": brute_path * 1000,
+        },
+    }
+
+
+def _ride(rng, minutes, rate, speed_mps=4.0, noise=0.5):
+    """
+    Fixes for a ride along straight streets with turns and gentle curves, at
+    rate fixes per second with noise metres of GPS scatter.
+    """
+    lat, lon, heading = 40.4433, -79.9436, rng.uniform(0, 2 * math.pi)
+    meters_per_lon = gps_fix.METERS_PER_DEG_LON * math.cos(math.radians(lat))
+    x = y = 0.0
+    fixes = []
+    for i in range(int(minutes * 60 * rate)):
+        if rng.random() < 0.02 / rate:
+            heading += rng.choice((-1, 1)) * math.pi / 2    # Corner
+        heading += rng.gauss(0.0, 0.02) / rate
+        x += speed_mps / rate * math.sin(heading)
+        y += speed_mps / rate * math.cos(heading)
+        fixes.append((lat + (y + rng.gauss(0.0, noise)) / gps_fix.METERS_PER_DEG_LAT,
+                      lon + (x + rng.gauss(0.0, noise)) / meters_per_lon, i / rate))
+    return fixes
+
+
+def bench_track(minutes=10, rates=(1.0, 5.0), polls=(10.0, 30.0)):
+    """
+    Bytes per minute of riding to get the ride's path to the app, against
+    sending every fix as a raw pair of floats: as binary doubles against the
+    encoded points, and as JSON text lines against the 'track <cursor>'
+    response lines with the app polling every poll seconds. Also the cost of
+    Track.add() per fix and how far the simplified path strays from the fixes.
+    """
+    import types
+    import numpy as np
+    import geofence
+    rng = random.Random(44)
+    result = {}
+    for rate in rates:
+        fixes = _ride(rng, minutes, rate)
+        path = track.Track()
+        add_ns = []
+        for lat, lon, t in fixes:
+            started = time.perf_counter_ns()
+            path.add(lat, lon, t)
+            add_ns.append(time.perf_counter_ns() - started)
+
+        # Replay the ride for each polling interval, paging until a short page
+        line_bytes = {}
+        for poll in polls:
+            replay = track.Track()
+            skateback = types.SimpleNamespace(track=replay)     # All the 'track' command needs
+            cursor = sent = payload_bytes = 0
+            next_poll = poll
+            for lat, lon, t in fixes:
+                replay.add(lat, lon, t)
+                if t >= next_poll:
+                    next_poll += poll
+                    while True:
+                        line = SkateBack._track_command(skateback, [str(cursor)])
+                        page = json.loads(line)
+                        sent += len(line) + 1
+                        payload_bytes += len(base64.b64decode(page["points"]))
+                        if page["next"] - cursor < track.PAGE_POINTS:
+                            cursor = page["next"]
+                            break
+                        cursor = page["next"]
+            line_bytes[poll] = sent
+
+        # Largest distance from a fix to the kept path, in metres
+        first, kept = path.since(0, len(fixes))
+        scale = np.array([gps_fix.METERS_PER_DEG_LON * math.cos(math.radians(fixes[0][0])),
+                          gps_fix.METERS_PER_DEG_LAT]) / track.UNITS
+        vertices = np.array([(p[2], p[1]) for p in kept]) * scale
+        covered = [f for f in fixes if (f[2] - fixes[0][2]) * track.TIME_UNITS <= kept[-1][0]]
+        points = np.array([(lon * track.UNITS, lat * track.UNITS) for lat, lon, _ in covered]) * scale
+        start, end = vertices[:-1], vertices[1:]
+        deviation = max(float(geofence._segment_distance(x, y, start[:, 0], start[:, 1], end[:, 0], end[:, 1]).min())
+                        for x, y in points)
+
+        raw_json = sum(len(json.dumps([round(lat, 7), round(lon, 7)])) + 1 for lat, lon, _ in fixes)
+        result[f"{rate:g}_hz"] = {
+            "fixes": len(fixes),
+            "kept": len(kept),
+            "bytes_per_min": {
+                "raw_doubles": 16 * len(fixes) / minutes,
+                "delta_varint_unsimplified": len(track.encode(
+                    [(round(t * track.TIME_UNITS), round(lat * track.UNITS), round(lon * track.UNITS))
+                     for lat, lon, t in fixes])) / minutes,
+                "track_payload": payload_bytes / minutes,
+                "raw_json_lines": raw_json / minutes,
+                **{f"track_lines_poll_{poll:g}s": sent / minutes for poll, sent in line_bytes.items()},
+            },
+            "reduction_vs_raw_doubles": 16 * len(fixes) / payload_bytes,
+            "reduction_vs_raw_json": {f"poll_{poll:g}s": raw_json / sent for poll, sent in line_bytes.items()},
+            "max_deviation_m": deviation,
+            "tolerance_m": path.tolerance,
+            "add_us": summarize([ns / 1e9 for ns in add_ns], scale=1e6),
+        }
+    return result
+
+
+def _render_depth(boxes, pose, camera, shape=(480, 640), box_height=1.0, far=9.0):
+    """
+    Depth frame a level camera at pose would see of a flat ground with
+    axis-aligned boxes standing on it, in the same form as distance_check.py's
+    depth_in_meters (0 where nothing is in range).
+
+    Args:
+        boxes (numpy.ndarray [size: (N,4)]): x0, y0, x1, y1 of each box (m).
+        pose (tuple): (x, y, heading) as for OccupancyMap.add_scan().
+    """
+    import numpy as np
+    height, width = shape
+    x, y, heading = pose
+    tangent = (np.arange(width) - camera.cx) / camera.fx
+    directions = math.radians(heading) + np.arctan(tangent)
+    east, north = np.sin(directions)[:, None], np.cos(directions)[:, None]
+    # Slab test of every column's ray against every box, for the horizontal distance to it
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tx = np.stack(((boxes[:, 0] - x) / east, (boxes[:, 2] - x) / east))
+        ty = np.stack(((boxes[:, 1] - y) / north, (boxes[:, 3] - y) / north))
+    near = np.maximum(np.nanmin(tx, axis=0), np.nanmin(ty, axis=0))
+    far_side = np.minimum(np.nanmax(tx, axis=0), np.nanmax(ty, axis=0))
+    hit = (near <= far_side) & (far_side > 0)
+    distance = np.where(hit, np.maximum(near, 0.0), np.inf).min(axis=1)
+
+    # Depth along the optical axis per pixel: the box face where it is tall
+    # enough at that row, otherwise the ground for rows below the horizon
+    cosine = 1.0 / np.sqrt(1.0 + tangent * tangent)
+    z_box = distance * cosine
+    down = (np.arange(height) - camera.cy)[:, None] / camera.fy
+    with np.errstate(invalid='ignore'):
+        heights = camera.height - down * z_box[None, :]
+    box_rows = (heights >= 0.0) & (heights <= box_height)
+    with np.errstate(divide='ignore'):
+        z_ground = np.where(down > 0, camera.height / down, np.inf) * np.ones((1, width))
+    depth = np.where(box_rows & (z_box[None, :] < z_ground), z_box[None, :], z_ground)
+    return np.where(depth <= far, depth, 0.0)
+
+
+def bench_occupancy(frames=500, step=0.2):
+    """
+    Building the occupancy map from depth frames rendered along a 100 m
+    street lined with parked cars and walls: time per frame against updating
+    the cells one ray at a time in Python, how well the map matches the
+    street, and how long a restarted process takes to answer its first query
+    from the stored tiles.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+    import occupancy
+    rng = random.Random(45)
+    boxes = [(-3.0, 0.0, -2.5, 100.0), (2.5, 0.0, 3.0, 100.0)]     # Walls
+    for _ in range(12):
+        start = rng.uniform(0, 95)
+        boxes.append(rng.choice(((-2.5, start, -1.6, start + 4.0), (1.6, start, 2.5, start + 4.0))))  # Parked cars
+    for _ in range(4):
+        cx, cy = rng.uniform(-1.0, 1.0), rng.uniform(10, 95)
+        boxes.append((cx - 0.2, cy - 0.2, cx + 0.2, cy + 0.2))       # Bollards
+    boxes = np.array(boxes)
+    camera = occupancy.Camera()
+    # Weaving gently down the street, heading along the path
+    poses = [(0.8 * math.sin(i / 40), i * step, math.degrees(math.atan2(0.02 * math.cos(i / 40), step)))
+             for i in range(frames)]
+    depths = [_render_depth(boxes, pose, camera) for pose in poses]
+
+    result = {}
+    directory = tempfile.mkdtemp()
+    try:
+        grid = occupancy.OccupancyMap(directory)
+        samples = []
+        for depth, pose in zip(depths, poses):
+            started = time.perf_counter()
+            grid.add_depth_frame(depth, pose, camera)
+            samples.append(time.perf_counter() - started)
+        grid.close()
+        result["frame_ms"] = summarize(samples)
+        result["tiles"] = len(grid.stored_tiles())
+        result["disk_bytes"] = sum(os.stat(os.path.join(directory, name)).st_blocks * 512
+                                   for name in os.listdir(directory))
+
+        # The same rays, one cell at a time
+        naive = {}
+        started = time.perf_counter()
+        for depth, pose in zip(depths[:50], poses[:50]):
+            bearings, ranges, hits = camera.scan(depth)
+            for bearing, distance, hit in zip(bearings.tolist(), ranges.tolist(), hits.tolist()):
+                direction = math.radians(pose[2]) + bearing
+                s = 0.0
+                while s < distance - (grid.resolution * 0.5 if hit else 0.0):
+                    cell = (math.floor((pose[0] + s * math.sin(direction)) / grid.resolution),
+                            math.floor((pose[1] + s * math.cos(direction)) / grid.resolution))
+                    naive[cell] = max(occupancy.L_MIN, naive.get(cell, 0.0) + occupancy.L_MISS)
+                    s += grid.resolution * 0.5
+                if hit:
+                    cell = (math.floor((pose[0] + distance * math.sin(direction)) / grid.resolution),
+                            math.floor((pose[1] + distance * math.cos(direction)) / grid.resolution))
+                    naive[cell] = min(occupancy.L_MAX, naive.get(cell, 0.0) + occupancy.L_HIT)
+        result["naive_frame_ms"] = (time.perf_counter() - started) / 50 * 1000
+
+        # A restarted process: open the stored map and check the street
+        started = time.perf_counter()
+        warm = occupancy.OccupancyMap(directory)
+        lane = np.stack((np.zeros(200), np.linspace(0.0, 99.0, 200)), axis=1)
+        warm.occupied(lane)
+        result["reopen_first_query_ms"] = (time.perf_counter() - started) * 1000
+
+        # Cell centres across the street: cells that overlap a box, and cells
+        # that do not even touch one
+        xs, ys = np.meshgrid(np.arange(-2.95, 3.0, 0.1), np.arange(5.05, 95.0, 0.1))
+        points = np.stack((xs.ravel(), ys.ravel()), axis=1)
+
+        def overlaps(reach):
+            return ((points[:, None, 0] + reach > boxes[None, :, 0]) & (points[:, None, 0] - reach < boxes[None, :, 2])
+                    & (points[:, None, 1] + reach > boxes[None, :, 1])
+                    & (points[:, None, 1] - reach < boxes[None, :, 3])).any(axis=1)
+
+        obstacle, clear = overlaps(0.04), ~overlaps(0.06)
+        values = warm.log_odds(points)
+        occupied = values > occupancy.OCCUPIED
+        free = values < 0.0
+        result["accuracy"] = {
+            "clear_cells_observed": float((values[clear] != 0).mean()),
+            "clear_cells_marked_occupied": float(occupied[clear & (values != 0)].mean()),
+            "obstacle_cells_occupied": int((occupied & obstacle).sum()),
+            "obstacle_cells_marked_free": int((free & obstacle).sum()),
+        }
+        warm.close()
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+
+class _Values:
+    """
+    The GetValues fields TripStats reads, without the message machinery.
+    """
+    __slots__ = ('tachometer', 'rpm', 'v_in', 'avg_input_current', 'watt_hours', 'watt_hours_charged')
+
+    def __init__(self, tachometer, rpm, v_in, avg_input_current, watt_hours):
+        self.tachometer = tachometer
+        self.rpm = rpm
+        self.v_in = v_in
+        self.avg_input_current = avg_input_current
+        self.watt_hours = watt_hours
+        self.watt_hours_charged = 0.0
+
+
+def _discharge_ride(rng, rate):
+    """
+    Telemetry for riding a full pack flat, on vesc_sim's battery model: cruising
+    at 3 to 5 m/s with stops, over rolling hills, at rate samples per second.
+
+    Yields:
+        tuple: (t, distance so far in m, left values, right values); the last
+        distance is where the pack reached trip.V_CUTOFF.
+    """
+    rider = 80.0                    # kg, board included
+    t = distance = amp_hours = watt_hours = tachometer = 0.0
+    speed_now, target, grade = 0.0, 4.0, 0.0
+    voltage = vesc_sim.V_FULL
+    dt = 1.0 / rate
+    while True:
+        if rng.random() < dt / 30.0:
+            target = rng.choice((0.0, 3.0, 4.0, 4.0, 5.0))
+        speed_now += max(-1.5 * dt, min(1.5 * dt, target - speed_now))
+        grade = max(-0.04, min(0.04, grade + rng.gauss(0.0, 0.002)))
+        force = rider * 9.81 * (0.015 + grade) + 0.3 * speed_now ** 2
+        power = max(0.0, speed_now * force) / 0.8 + (3.0 if speed_now > 0 else 0.0)
+        current = power / voltage
+        charge = 1.0 - amp_hours / vesc_sim.CAPACITY_AH
+        rest = vesc_sim.V_EMPTY + (vesc_sim.V_FULL - vesc_sim.V_EMPTY) * charge
+        if rest <= trip.V_CUTOFF:
+            return
+        voltage = rest - current * vesc_sim.BATTERY_RESISTANCE
+        amp_hours += current * dt / 3600.0
+        watt_hours += current * voltage * dt / 3600.0
+        distance += speed_now * dt
+        t += dt
+        tachometer = distance / odometry.METERS_PER_TACHO
+        erpm = -speed_now * speed.ERPM_PER_MPS
+        measured = voltage + rng.gauss(0.0, 0.05)
+        halves = [_Values(-int(tachometer), erpm, measured, current / 2, watt_hours / 2) for _ in range(2)]
+        yield t, distance, halves[0], halves[1]
+
+
+def bench_trip(rate=10.0, checkpoints=(0.1, 0.25, 0.5, 0.75, 0.9), history_minutes=(1, 10, 60)):
+    """
+    Cost of TripStats.add() per telemetry sample and of 'stats', against
+    recomputing the same totals from the stored history on every request,
+    and how close the range estimate is to the distance actually left on a
+    ride that runs a simulated pack flat (sampled at rate Hz to keep it short).
+    """
+    rng = random.Random(46)
+    samples = list(_discharge_ride(rng, rate))
+    total = samples[-1][1]
+
+    stats = trip.TripStats()
+    add_ns = []
+    estimates = {}
+    marks = iter(sorted(checkpoints))
+    mark = next(marks)
+    for t, distance, left, right in samples:
+        started = time.perf_counter_ns()
+        stats.add(t, left, right)
+        add_ns.append(time.perf_counter_ns() - started)
+        if mark is not None and distance >= mark * total:
+            report = stats.stats()
+            remaining = total - distance
+            # The same Wh/km with the energy read off the loaded voltage alone
+            charge = (left.v_in - trip.V_CUTOFF) / (trip.V_FULL - trip.V_CUTOFF)
+            estimates[f"{mark:g}"] = {
+                "true_km": remaining / 1000,
+                "estimate_km": report["range_km"],
+                "error_pct": (report["range_km"] * 1000 - remaining) / remaining * 100,
+                "method": report["range_method"],
+                "true_wh": samples[-1][2].watt_hours * 2 - stats.wh_used,
+                "estimate_wh": report["remaining_wh"],
+                "voltage_only_error_pct": (charge * trip.PACK_WH / stats.wh_per_km * 1000 - remaining) / remaining * 100,
+            }
+            mark = next(marks, None)
+
+    stats_us = []
+    for _ in range(1000):
+        started = time.perf_counter_ns()
+        json.dumps(stats.stats())
+        stats_us.append((time.perf_counter_ns() - started) / 1000)
+
+    def from_history(history):
+        # What 'stats' would cost without running totals: one pass over every sample
+        distance = moving = peak = 0.0
+        for (t0, _, l0, r0), (t1, _, l1, r1) in zip(history, history[1:]):
+            distance += abs((l1.tachometer - l0.tachometer) + (r1.tachometer - r0.tachometer)) / 2
+            speed = abs(l1.rpm + r1.rpm) / 2
+            peak = max(peak, speed)
+            moving += (t1 - t0) if speed > 0 else 0.0
+        return distance, moving, peak
+
+    recompute = {}
+    for minutes in history_minutes:
+        history = samples[:int(minutes * 60 * 20)]     # At the motor tick's 20 Hz
+        started = time.perf_counter()
+        from_history(history)
+        recompute[f"{minutes}_min_ms"] = (time.perf_counter() - started) * 1000
+
+    return {
+        "ride_km": total / 1000,
+        "ride_hours": samples[-1][0] / 3600,
+        "wh_per_km": stats.wh_per_km,
+        "add_ns": summarize([ns / 1e9 for ns in add_ns], scale=1e9),
+        "stats_us": summarize([us / 1e6 for us in stats_us], scale=1e6),
+        "recompute_from_history": recompute,
+        "range": estimates,
+    }
+
+
+def _spin(n=2000):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def _profiled_run(port, duration, action):
+    """
+    Calls of _spin() a busy thread gets through in duration seconds on a
+    running controller, with the profiler started by the given 'profile start'
+    arguments (None to leave it off).
+
+    Returns:
+        tuple: (spins per second, 'profile stop' reply or None)
+    """
+    client = Client(port)
+    stop = threading.Event()
+    spins = [0]
+
+    def busy():
+        while not stop.is_set():
+            _spin()
+            spins[0] += 1
+
+    if action is not None:
+        client.command(f"profile start {action}")
+    worker = threading.Thread(target=busy, name="busy", daemon=True)
+    started = time.perf_counter()
+    worker.start()
+    # The remote's command stream, so the socket threads have work too
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        client.command(random.choice(('accelerate', 'decelerate')))
+        time.sleep(0.05)
+    stop.set()
+    worker.join()
+    rate = spins[0] / (time.perf_counter() - started)
+    reply = None
+    if action is not None:
+        reply = json.loads(client.command("profile stop benchmark.folded"))
+    client.command('stop')
+    client.close()
+    return rate, reply
+
+
+def bench_profiler(duration=3.0, configs=("100 cpu", "1000 cpu", "100 wall")):
+    """
+    Slowdown of a busy Python thread on a running controller with the
+    sampling profiler off and on, the sampler's own cost per pass, and what
+    the samples show: the share landing in the busy thread's _spin(), and how
+    many samples idle threads (blocked on a socket, queue or sleep) take up
+    in cpu mode versus wall mode.
+    """
+    results = {}
+    with controller() as (board, skateback, port):
+        _profiled_run(port, 0.5, None)      # Warm up
+        baseline = [_profiled_run(port, duration, None)[0] for _ in range(2)]
+        off = statistics.fmean(baseline)
+        results["off_spins_per_s"] = off
+        results["off_noise_pct"] = (max(baseline) - min(baseline)) / off * 100
+        for action in configs:
+            rate, reply = _profiled_run(port, duration, action)
+            samples = max(reply["samples"], 1)
+            threads = reply["threads"]
+            busy = threads.get("busy", {})
+            weights = [(line, int(line.rsplit(' ', 1)[1])) for line in skateback.profiler.collapsed()]
+            total = sum(weight for _, weight in weights) or 1
+            in_busy = sum(weight for line, weight in weights if line.startswith('busy;'))
+            in_spin = sum(weight for line, weight in weights
+                          if line.startswith('busy;') and '_spin (benchmark.py)' in line)
+            sampled = sum(entry["samples"] for entry in threads.values())
+            results[action.replace(' ', '_')] = {
+                "slowdown_pct": (off - rate) / off * 100,
+                "passes_per_s": reply["samples"] / reply["elapsed_s"],
+                "pass_us": skateback.profiler.sampling_time / samples * 1e6,
+                "sampler_overhead_pct": reply["overhead_pct"],
+                "threads_seen": len(threads),
+                "stacks": reply["stacks"],
+                "busy_cpu_pct": busy.get("cpu_pct"),
+                "busy_weight_in_spin_pct": in_spin / max(in_busy, 1) * 100,
+                "busy_share_of_weight_pct": in_busy / total * 100,
+                "idle_thread_samples_per_pass": (sampled - busy.get("samples", 0)) / samples,
+                "profiler_cpu_pct": threads.get("profiler", {}).get("cpu_pct"),
+            }
+    results["off_cost"] = "no sampler thread; nothing on any other code path"
+    return results
+
+
+class _GeoReading:
+    """
+    The NAV-PVT fields SkateBackGPS reads, in the receiver's units.
+    """
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.hAcc = 800         # mm
+
+    def _asdict(self):
+        return {"lat": self.lat, "lon": self.lon, "hAcc": self.hAcc}
+
+
+class _FakeReceiver:
+    def __init__(self, fixes, rate, stop):
+        """
+        Answers geo_coords() like a UbloxGps solving rate times a second,
+        until stop is set; then it blocks for good.
+        """
+        self.fixes = iter(fixes)
+        self.period = 1.0 / rate
+        self.stop = stop
+
+    def geo_coords(self):
+        if self.stop.wait(self.period):
+            threading.Event().wait()
+        lat, lon, _ = next(self.fixes)
+        return _GeoReading(lat, lon)
+
+
+def _capture_session(directory, duration, depth_rate=5.0, gps_rate=5.0):
+    """
+    Ride the simulated board for duration seconds with a Capture running:
+    remote commands on the socket (including a stretch in speed mode and the
+    occasional 'stats', 'profile', 'log' or 'links' query, as the app sends), GPS
+    fixes through SkateBackGPS and depth frames of a street at depth_rate.
+
+    Returns:
+        dict: The live controller's final outputs, to compare replays with.
+    """
+    import numpy as np
+    import SkateBackGPS
+    import occupancy
+    import session
+    rng = random.Random(48)
+    camera = occupancy.Camera()
+    boxes = np.array([(-3.0, 0.0, -2.5, 100.0), (2.5, 0.0, 3.0, 100.0), (1.6, 8.0, 2.5, 12.0), (-0.2, 15.0, 0.2, 15.4)])
+    scale = 0.00025                 # The L515's depth unit (m)
+    frames = [np.round(_render_depth(boxes, (0.0, i * 1.0, 0.0), camera) / scale).astype(np.uint16) for i in range(10)]
+
+    capture = session.Capture(directory)
+    stop = threading.Event()
+    with controller(capture=capture) as (board, skateback, port):
+        gps = SkateBackGPS.SkateBackGPS(receiver=_FakeReceiver(_ride(rng, 10, gps_rate), gps_rate, stop),
+                                        capture=capture)
+        threading.Thread(target=gps.follow, args=(skateback.track,), name="gps", daemon=True).start()
+
+        def depth():
+            for i in itertools.count():
+                if stop.wait(1.0 / depth_rate):
+                    return
+                capture.depth(frames[i % len(frames)], scale)
+
+        depth_thread = threading.Thread(target=depth, name="depth", daemon=True)
+        depth_thread.start()
+
+        client = Client(port)
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            phase = (time.perf_counter() - started) / duration
+            if 0.4 < phase < 0.6:
+                if skateback.speed_targets is None:
+                    client.command("speed 2.0")
+                time.sleep(0.25)
+                continue
+            if skateback.speed_targets is not None:
+                client.command("stop")
+            client.command(rng.choice(('accelerate', 'accelerate', 'decelerate')) if rng.random() < 0.9 else 'stop')
+            if rng.random() < 0.1:
+                client.command(rng.choice(('stats', 'stats trace', 'profile', 'log', 'links')))
+            time.sleep(rng.uniform(0.1, 0.4))
+        client.command("stop")
+        client.close()
+        stop.set()
+        depth_thread.join()
+        live = {"duty": [skateback.left_duty_cycle, skateback.right_duty_cycle],
+                "trip_m": skateback.trip.distance, "track_points": skateback.track.next_seq}
+    capture.close()
+    return live
+
+
+def bench_session(duration=30.0, realtime_duration=10.0):
+    """
+    Capture a ride on the simulated board (socket commands, VESC replies, GPS
+    and depth frames), then replay it through SkateBack, SkateBackGPS and the
+    occupancy map as fast as possible and in real time. Reports the replay
+    speed, whether two fast replays give identical outputs, how close the
+    replays end up to the live run, the time spent per stage and what
+    capturing costs per event.
+    """
+    import shutil
+    import tempfile
+    import session
+    directory = tempfile.mkdtemp()
+    try:
+        live = _capture_session(directory, duration)
+        recorded = session.Session(directory)
+        fast = [session.replay(recorded) for _ in range(2)]
+        outputs = [replayed["outputs"] for replayed in fast]
+        short = session.Session(directory)
+        short.events = [event for event in short.events if event["t"] <= realtime_duration]
+        slow = session.replay(short, realtime=True)
+
+        # Capture cost per VESC reply, the most frequent input
+        reply = vesc_sim.SimulatedVesc.values(types.SimpleNamespace(
+            motor_current=10.0, duty_now=0.2, erpm=5000.0, v_in=40.0, amp_hours=0.5, watt_hours=20.0,
+            tachometer=123456, tachometer_abs=123456))
+        capture = session.Capture(os.path.join(directory, "cost"))
+        started = time.perf_counter_ns()
+        for _ in range(10000):
+            capture.vesc("L", reply)
+        vesc_ns = (time.perf_counter_ns() - started) / 10000
+        capture.close()
+
+        return {
+            "session_s": recorded.duration,
+            "events": recorded.counts(),
+            "bytes": {name: os.path.getsize(os.path.join(directory, name))
+                      for name in (session.EVENTS, session.DEPTH)},
+            "max_speed": {
+                "replay_s": fast[0]["replay_s"],
+                "speedup": fast[0]["speedup"],
+                "deterministic": outputs[0] == outputs[1],
+                "frames_digest": outputs[0]["frames_digest"],
+                "stages_us": fast[0]["stages_us"],
+            },
+            "realtime": {
+                "session_s": short.duration,
+                "replay_s": slow["replay_s"],
+                "stages_us": slow["stages_us"],
+            },
+            "live_vs_replay": {
+                "duty": {"live": live["duty"], "replay": outputs[0]["duty"]},
+                "trip_m": {"live": live["trip_m"], "replay": outputs[0]["trip"]["distance_m"]},
+                "track_points": {"live": live["track_points"], "replay": outputs[0]["track"]["points"]},
+                "map": outputs[0].get("map"),
+            },
+            "capture_vesc_us": vesc_ns / 1000,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _launch_run(board, start, target, duration, period=0.01):
+    """
+    Sample both simulated wheels after start() until duration has passed.
+    start() runs on its own thread so a blocking ramp is sampled too.
+
+    Returns:
+        dict: time until the board's ground speed first reached 90% of target,
+        overshoot past target in percent, the largest motor current and the
+        largest change in it over one motor tick, the largest left/right
+        wheel speed difference, how long either wheel spun more than 10%
+        faster than the ground under it, and how far the board turned.
+    """
+    samples = []
+    threading.Thread(target=start, daemon=True).start()
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        # The wheels turn forward for a negative current and ERPM on the wire
+        samples.append((time.perf_counter() - started,
+                        -board.left.erpm / speed.ERPM_PER_MPS, -board.right.erpm / speed.ERPM_PER_MPS,
+                        -board.left.ground_erpm / speed.ERPM_PER_MPS, -board.right.ground_erpm / speed.ERPM_PER_MPS,
+                        -board.left.motor_current, -board.right.motor_current))
+        time.sleep(period)
+
+    reached = next((t for t, _, _, gl, gr, _, _ in samples if (gl + gr) / 2 >= 0.9 * target), None)
+    tick = max(1, round(SkateBack.TICK_PERIOD / period))
+    steps = [max(abs(b[5] - a[5]), abs(b[6] - a[6])) for a, b in zip(samples, samples[tick:])]
+    spinning = [b[0] - a[0] for a, b in zip(samples, samples[1:])
+                if a[1] > 1.1 * a[3] + 0.1 or a[2] > 1.1 * a[4] + 0.1]
+    return {
+        "to_90pct_s": None if reached is None else round(reached, 3),
+        "overshoot_pct": round(100 * max(0.0, max((gl + gr) / 2 for _, _, _, gl, gr, _, _ in samples) - target)
+                               / target, 1),
+        "peak_current": round(max(max(s[5], s[6]) for s in samples), 1),
+        "max_current_step_per_tick": round(max(steps), 1) if steps else None,
+        "max_left_right_mps": round(max(abs(s[1] - s[2]) for s in samples), 2),
+        "spin_s": round(sum(spinning), 2),
+        "heading_change_deg": round(math.degrees(sum((a[3] - a[4]) * (b[0] - a[0])
+                                                     for a, b in zip(samples, samples[1:]))
+                                                 / odometry.TRACK_WIDTH), 1),
+    }
+
+
+def bench_launch(target=2.5, duration=4.0, grip=6.0, slip_duration=6.0):
+    """
+    Starting from standstill to target m/s three ways: the duty cycle ramp
+    (ACC_STEP per tick to the duty cycle that gives target on a fresh pack),
+    speed mode on its own (MAX_DUTY_STEP per tick), and speed mode with a
+    current-controlled launch (see launch.py). Then the same launch on a left
+    tyre that can only put down grip amps, with slip detection on and off,
+    and speed mode on its own for reference, over slip_duration.
+    """
+    probe = 0.1
+    with controller() as (board, skateback, port):
+        skateback.set_wheels(probe, probe)
+        time.sleep(3.0)
+        duty = probe * target * speed.ERPM_PER_MPS / -board.left.erpm
+
+    def run(mode, left_grip=None, duration=duration):
+        with controller() as (board, skateback, port):
+            board.left.grip = left_grip
+            time.sleep(0.2)     # Let the telemetry tick see the wheels standing still
+            if mode == "duty_ramp":
+                start = lambda: skateback.ramp_wheels(duty, duty)
+            elif mode == "speed":
+                start = lambda: skateback.set_speed(target)
+            else:
+                skateback.enable_launch(detect_slip=mode != "launch_no_slip_detection")
+                start = lambda: skateback.set_speed(target)
+            result = _launch_run(board, start, target, duration)
+            result["launch"] = skateback.last_launch
+            return result
+
+    result = {"target_mps": target, "ramp_duty": round(duty, 3),
+              "max_current": launch.MAX_CURRENT, "current_rate": launch.CURRENT_RATE}
+    for mode in ("duty_ramp", "speed", "launch"):
+        result[mode] = run(mode)
+    result["slip"] = {"left_grip_amps": grip}
+    for mode in ("speed", "launch", "launch_no_slip_detection"):
+        result["slip"][mode] = run(mode, grip, slip_duration)
+    return result
+
+
+def bench_tracing_overhead(iterations=200000):
+    """
+    Cost of tracing one command (begin, setpoint, frame, end) in
+    nanoseconds. per_command_ns is the whole sequence of calls with tracing
+    on and off; overhead_ns is the difference, what tracing adds to a
+    command's threads. flush_ns is the cost per span of bucketing it into the
+    histograms later, on the trace task.
+    """
+    results = {}
+    for enabled in (True, False):
+        tracer = tracing.Tracer(enabled=enabled)
+        start = time.perf_counter_ns()
+        for i in range(iterations):
+            span = tracer.begin(time.perf_counter_ns())
+            tracer.setpoint()
+            tracer.frame()
+            tracer.end(span)
+            if i % 4096 == 4095:
+                # Keep the queue short as the trace task would, outside the timing
+                paused = time.perf_counter_ns()
+                tracer.flush()
+                start += time.perf_counter_ns() - paused
+        results["enabled" if enabled else "disabled"] = {"per_command_ns": (time.perf_counter_ns() - start) / iterations}
+
+    tracer = tracing.Tracer()
+    for _ in range(tracing.MAX_PENDING):
+        span = tracer.begin(time.perf_counter_ns())
+        tracer.setpoint()
+        tracer.frame()
+        tracer.end(span)
+    start = time.perf_counter_ns()
+    tracer.flush()
+    results["flush_ns"] = (time.perf_counter_ns() - start) / tracing.MAX_PENDING
+    results["overhead_ns"] = results["enabled"]["per_command_ns"] - results["disabled"]["per_command_ns"]
+    return results
+
+
+def _drained_pipe(stall=0.0):
+    """
+    Line-buffered text stream into a pipe, like stdout under systemd, with a
+    reader that sleeps for stall seconds after every read to play a journald
+    that has fallen behind.
+
+    Returns:
+        tuple: (stream, close function)
+    """
+    read_fd, write_fd = os.pipe()
+    stream = os.fdopen(write_fd, 'w', buffering=1)
+
+    def drain():
+        while os.read(read_fd, 65536):
+            if stall:
+                time.sleep(stall)
+        os.close(read_fd)
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+
+    def close():
+        stream.close()
+        reader.join()
+    return stream, close
+
+
+def bench_logging(iterations=20000, stalled_calls=5000, stall=0.05):
+    """
+    Cost of the log line stop() writes on every step, per call in
+    nanoseconds: print() into a drained pipe (before) against logs with the
+    line written, filtered out by level and suppressed by the rate limit.
+
+    The stalled runs time each call while the pipe's reader keeps pausing, as
+    when journald falls behind; print() blocks once the pipe is full, logs drops.
+    """
+    left, right = 0.123, -0.456
+    message = "Stopping - Left: %.3f, Right: %.3f"
+    result = {}
+
+    def per_call(call, count=iterations):
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            call()
+        return (time.perf_counter_ns() - start) / count
+
+    def call_latencies(call):
+        latencies = []
+        for _ in range(stalled_calls):
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        return summarize(latencies, scale=1e6)
+
+    stream, close = _drained_pipe()
+    result["print_ns"] = per_call(lambda: print(f"Stopping - Left: {left:.3f}, Right: {right:.3f}", file=stream))
+    close()
+
+    rate, burst = logs.RATE, logs.BURST
+    stream, close = _drained_pipe()
+    logs.set_stream(stream)
+    log = logs.Logger('bench', logs.DEBUG)
+    try:
+        logs.RATE = logs.BURST = float('inf')       # Every line written
+        result["logs_ns"] = per_call(lambda: log.debug(message, left, right))
+        logs.flush(10)
+        log.level = logs.INFO
+        result["logs_filtered_ns"] = per_call(lambda: log.debug(message, left, right))
+        log.level = logs.DEBUG
+        logs.RATE, logs.BURST = rate, burst
+        result["logs_suppressed_ns"] = per_call(lambda: log.debug(message, left, right))
+        logs.flush(10)
+    finally:
+        logs.RATE, logs.BURST = rate, burst
+        logs.set_stream(None)
+        close()
+
+    stream, close = _drained_pipe(stall)
+    result["stalled_print_us"] = call_latencies(
+        lambda: print(f"Stopping - Left: {left:.3f}, Right: {right:.3f}", file=stream))
+    close()
+
+    stream, close = _drained_pipe(stall)
+    logs.set_stream(stream)
+    dropped = logs.dropped
+    try:
+        logs.RATE = logs.BURST = float('inf')
+        result["stalled_logs_us"] = call_latencies(lambda: log.debug(message, left, right))
+        result["stalled_logs_dropped"] = logs.dropped - dropped
+        logs.RATE, logs.BURST = rate, burst
+        logs.flush(30)
+    finally:
+        logs.RATE, logs.BURST = rate, burst
+        logs.set_stream(None)
+        close()
+    return result
+
+
+def _virtual_heading(skateback, clock, rate=90.0):
+    """
+    Heading source for a SkateBack on a SimClock: pivots at rate deg/s while
+    the wheel setpoints differ, clockwise when the left wheel is ahead.
+    """
+    state = {"time": clock.time(), "heading": 0.0}
+
+    def heading():
+        now = clock.time()
+        difference = skateback.left_duty_cycle - skateback.right_duty_cycle
+        if difference:
+            state["heading"] += math.copysign(rate, difference) * (now - state["time"])
+        state["time"] = now
+        return state["heading"]
+
+    return heading
+
+
+def bench_virtual_clock(repeats=20):
+    """
+    Wall-clock cost of a full stop from 0.5 duty followed by a left turn when
+    the controller runs on a SimClock, against the virtual time it covers.
+
+    The simulated VESCs move in real time, so the turn is steered by a heading
+    that pivots at a steady 90 deg/s of virtual time while the wheels are
+    commanded apart, instead of odometry.
+    """
+    walls = []
+    virtual = 0.0
+    with vesc_sim.SimulatedBoard() as board:
+        for _ in range(repeats):
+            clock = clocks.SimClock()
+            skateback = SkateBack.SkateBack(*board.ports, clock=clock)
+            started = time.perf_counter()
+            skateback.set_duty_cycle("L", 0.5)
+            skateback.set_duty_cycle("R", 0.5)
+            skateback.stop()
+            skateback.turn_left(heading=_virtual_heading(skateback, clock))
+            walls.append(time.perf_counter() - started)
+            virtual = clock.time()
+            skateback.close()
+    wall = statistics.fmean(walls)
+    return {"virtual_s": virtual, "wall": summarize(walls), "speedup": virtual / wall}
+
+
+def bench_frame_rate(duration=2.0):
+    """
+    SetDutyCycle frames per second a single writer can push to one VESC,
+    opening and closing the port for every frame (the old motors/jason.py
+    set_motor_duty_cycle) versus the shared persistent connection.
+    """
+    results = {}
+    with vesc_sim.SimulatedVesc() as sim:
+        frame = pyvesc.encode(SetDutyCycle(0.1))
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            with serial.Serial(sim.port, baudrate=vesc.BAUD_RATE, timeout=vesc.TIMEOUT) as ser:
+                ser.write(frame)
+            count += 1
+        results["open_per_frame"] = count / (time.perf_counter() - started)
+
+        transport = vesc.connect(sim.port)
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            transport.send(SetDutyCycle(0.1))
+            count += 1
+        results["persistent"] = count / (time.perf_counter() - started)
+        transport.release()
+    results["speedup"] = results["persistent"] / results["open_per_frame"]
+    return results
+
+
+def _tick_lateness(stop, lateness, period=0.05):
+    deadline = time.perf_counter()
+    while not stop.is_set():
+        deadline += period
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        lateness.append(time.perf_counter() - deadline)
+
+
+def bench_key_packets(duration=2.0):
+    """
+    UDP remote ingestion in motors/jason.py: packets per second the receiver
+    keeps up with while being flooded (with every tenth packet replayed out of
+    order), and how late a 50 ms control tick runs with and without the flood.
+    """
+    from motors import jason
+
+    udp_port = free_port()
+    threading.Thread(target=jason.receive_key_states, args=(udp_port,), daemon=True).start()
+    time.sleep(0.1)
+
+    results = {}
+    for flood in (False, True):
+        stop = threading.Event()
+        lateness = []
+        ticker = threading.Thread(target=_tick_lateness, args=(stop, lateness), daemon=True)
+        ticker.start()
+
+        received_before = jason.packets_received
+        discarded_before = jason.packets_discarded
+        sent = 0
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            started = time.perf_counter()
+            seq = jason.key_state.seq or 0
+            while time.perf_counter() - started < duration:
+                if flood:
+                    seq += 1
+                    packet_seq = seq - 5 if sent % 10 == 9 else seq
+                    sender.sendto(jason.encode_key_state(sent & jason.KEY_W, packet_seq), (HOST, udp_port))
+                    sent += 1
+                else:
+                    time.sleep(0.01)
+            elapsed = time.perf_counter() - started
+        time.sleep(0.1)
+        stop.set()
+        ticker.join()
+
+        results["flood" if flood else "idle"] = {
+            "sent": sent,
+            "received_per_s": (jason.packets_received - received_before) / elapsed,
+            "discarded": jason.packets_discarded - discarded_before,
+            "tick_lateness": summarize(lateness),
+        }
+    return results
+
+
+BENCHMARKS = {
+    "command_latency": bench_command_latency,
+    "tick_jitter": bench_tick_jitter,
+    "throughput": bench_throughput,
+    "multi_board": bench_multi_board,
+    "burst": bench_burst,
+    "stop_to_zero": bench_stop_to_zero,
+    "estop": bench_estop,
+    "turns": bench_turns,
+    "gps_fix": bench_gps_fix,
+    "geofence": bench_geofence,
+    "track": bench_track,
+    "occupancy": bench_occupancy,
+    "trip": bench_trip,
+    "speed_control": bench_speed_control,
+    "launch": bench_launch,
+    "tracing_overhead": bench_tracing_overhead,
+    "profiler": bench_profiler,
+    "session": bench_session,
+    "logging": bench_logging,
+    "telemetry": bench_telemetry,
+    "recorder": bench_recorder,
+    "startup": bench_startup,
+    "reconnect": bench_reconnect,
+    "virtual_clock": bench_virtual_clock,
+    "frame_rate": bench_frame_rate,
+    "key_packets": bench_key_packets,
+}
+
+
+def run(names):
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {},
+    }
+    for name in names:
+        # The controller logs every command, and the logs writer writes to
+        # whatever sys.stdout is at the time; keep that out of the report. The
+        # flush inside lets lines still queued land here too
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            result = BENCHMARKS[name]()
+            logs.flush()
+        report["results"][name] = result
+        print(f"{name}: done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SkateBack control-path benchmarks")
+    parser.add_argument("-o", "--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    args = parser.parse_args()
+
+    report = run(args.only or list(BENCHMARKS))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,297 @@
+"""
+Batched differential-drive simulator for tuning the ramp and turn constants.
+
+The notes at the top of SkateBack.py say turn quality depends on ACC/DEC_STEP
+and was found by trial on the board. This simulates thousands of parameter
+combinations in lockstep with NumPy, one array element per combination, and
+replays what SkateBack does:
+
+    turn   turn(TURN_ANGLE) TURN_REPEATS times in a row: the pivot ramps by the
+           acc step every TICK_PERIOD and stops on the predicted heading, and
+           the coast estimate is carried from one turn to the next
+    stop   stop() from cruise, BRK_STEP every 50 ms with the MIN_DUTY_CYCLE cut
+    decel  decelerate_to(0) from cruise, DEC_STEP every 100 ms
+
+The wheel model is the one in vesc_sim.py (duty to current through back-EMF,
+current limit, stiction below the breakaway current, drag, and scrub drag that
+resists the wheels turning opposite ways in a pivot) with the VESC timeout
+releasing a wheel when setpoints stop arriving. The two wheels break away at
+slightly different currents, which is what makes slow ramps drift.
+
+Usage:
+    python board_sim.py --acc 0.003:0.01:8 --dec 0.003:0.01:8 --brk 0.01:0.05:5 \
+        --turn-duty 0.06:0.2:8 -o sweep.csv
+"""
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import math
+import os
+import sys
+import numpy as np
+import SkateBack
+import vesc_sim
+from odometry import WHEEL_DIAMETER, TRACK_WIDTH, POLE_PAIRS
+
+MISMATCH = 0.1              # Right wheel needs this much more breakaway current than the left
+
+DT = 0.002                  # Integration step (s)
+RAMP_PERIOD = 0.1           # accelerate_to / decelerate_to step period (set_duty_cycle duration)
+STOP_PERIOD = 0.05          # stop() step period
+TURN_REPEATS = 5            # Turns in a row, so the coast estimate has converged by the last
+SETTLE = 1.5                # Time simulated after the last setpoint change
+CRUISE_DUTY = 0.3           # Starting speed for the stop and decel scenarios
+CHUNK = 2048                # Combinations per worker task
+
+METERS_PER_ERPM_S = math.pi * WHEEL_DIAMETER / POLE_PAIRS / 60.0
+
+
+def _ramp(t, start, target, step, period):
+    """
+    Setpoint of accelerate_to/decelerate_to at time t: one step per period,
+    the first step applied immediately, clamped at the target.
+    """
+    steps = np.floor(t / period) + 1
+    direction = np.sign(target - start)
+    value = start + direction * step * steps
+    return np.where(direction >= 0, np.minimum(value, target), np.maximum(value, target))
+
+
+def _stop_ramp(t, start, step):
+    """
+    Setpoint of stop() at time t, including the jump to zero below MIN_DUTY_CYCLE.
+    """
+    value = np.maximum(0.0, start - step * (np.floor(t / STOP_PERIOD) + 1))
+    return np.where(value < SkateBack.MIN_DUTY_CYCLE, 0.0, value)
+
+
+class BoardBatch:
+    def __init__(self, n, tick_period=SkateBack.TICK_PERIOD, timeout=vesc_sim.VESC_TIMEOUT, mismatch=MISMATCH):
+        """
+        State for n independent boards.
+
+        Args:
+            n (int): Number of boards (parameter combinations).
+            tick_period (float): Period at which the controller sends setpoints.
+            timeout (float): VESC command timeout.
+            mismatch (float): Relative breakaway current difference between wheels.
+        """
+        self.tick_period = tick_period
+        self.timeout = timeout
+        self.erpm = np.zeros((2, n))            # Row 0 left, row 1 right, SkateBack sign (positive forward)
+        self.applied = np.zeros((2, n))         # Duty cycle the VESC is currently applying
+        self.released = np.zeros((2, n), dtype=bool)
+        self.last_command = np.zeros(n)
+        self.pose = np.zeros((3, n))            # x, y, heading (rad)
+        self.breakaway = np.array([[vesc_sim.STARTUP_CURRENT], [vesc_sim.STARTUP_CURRENT * (1 + mismatch)]])
+        self.t = 0.0
+
+    def set_speed(self, duty):
+        """
+        Start every board at the steady-state speed for a duty cycle.
+        """
+        self.erpm[:] = duty * vesc_sim.ERPM_PER_DUTY / (1 + vesc_sim.DRAG * vesc_sim.MOTOR_RESISTANCE
+                                                       * vesc_sim.ERPM_PER_DUTY / (vesc_sim.ERPM_PER_AMP_S * vesc_sim.V_FULL))
+        self.applied[:] = duty
+
+    def step(self, setpoint, send):
+        """
+        Advance all boards by DT.
+
+        Args:
+            setpoint (ndarray [2, n]): Controller duty setpoints.
+            send (bool): Whether a motor tick fires during this step.
+        """
+        if send:
+            self.applied = setpoint.copy()
+            self.last_command[:] = self.t
+            self.released[:] = False
+        self.released |= (self.t - self.last_command) > self.timeout
+
+        back_emf = self.erpm / vesc_sim.ERPM_PER_DUTY
+        current = (self.applied - back_emf) * vesc_sim.V_FULL / vesc_sim.MOTOR_RESISTANCE
+        current = np.clip(current, -vesc_sim.CURRENT_LIMIT, vesc_sim.CURRENT_LIMIT)
+        current[self.released] = 0.0
+
+        stuck = (self.erpm == 0.0) & (np.abs(current) < self.breakaway)
+        pivoting = self.erpm[0] * self.erpm[1] <= 0
+        scrub = np.where(pivoting, vesc_sim.SCRUB * (self.erpm - self.erpm[::-1]) / 2, 0.0)
+        accel = np.where(stuck, 0.0, current * vesc_sim.ERPM_PER_AMP_S - vesc_sim.DRAG * self.erpm - scrub)
+        previous = self.erpm
+        self.erpm = self.erpm + accel * DT
+        # Coasting never reverses a wheel, and a slow wheel with little current stops
+        self.erpm[self.released & (previous * self.erpm < 0)] = 0.0
+        self.erpm[(np.abs(self.erpm) < 1.0) & (np.abs(current) < self.breakaway)] = 0.0
+
+        v_left, v_right = self.erpm * METERS_PER_ERPM_S
+        v = (v_left + v_right) / 2
+        self.pose[0] += v * np.cos(self.pose[2]) * DT
+        self.pose[1] += v * np.sin(self.pose[2]) * DT
+        self.pose[2] += (v_right - v_left) / TRACK_WIDTH * DT
+        self.t += DT
+
+    def run(self, schedule, duration):
+        """
+        Drive the boards with a setpoint schedule.
+
+        Args:
+            schedule (function): Maps time t to a [2, n] array of setpoints.
+            duration (float): Seconds to simulate.
+
+        Returns:
+            ndarray [n]: Distance travelled by the board centre.
+        """
+        distance = np.zeros(self.erpm.shape[1])
+        ticks_per_send = max(1, round(self.tick_period / DT))
+        for i in range(int(round(duration / DT))):
+            x, y = self.pose[0].copy(), self.pose[1].copy()
+            self.step(schedule(self.t), i % ticks_per_send == 0)
+            distance += np.hypot(self.pose[0] - x, self.pose[1] - y)
+        return distance
+
+
+def turn(acc_step, turn_duty, lead, angle=SkateBack.TURN_ANGLE):
+    """
+    One SkateBack.turn() to the left from standstill, for arrays of
+    parameters: the pivot ramps by acc_step every tick, and the wheels stop on
+    the tick where the heading so far plus the coast at the wheels' yaw rate
+    lands closest to the angle. Then the board coasts to a stop.
+
+    Args:
+        acc_step, turn_duty (ndarray [n]): Pivot ramp step and duty cycle.
+        lead (ndarray [n]): Coast estimate going in (s of yaw rate).
+        angle (float): Requested heading change (degrees).
+
+    Returns:
+        tuple: (heading change in degrees, drift of the board centre in m,
+        coast estimate corrected by this turn) arrays.
+    """
+    n = len(acc_step)
+    board = BoardBatch(n)
+    ticks = max(1, round(SkateBack.TICK_PERIOD / DT))
+    duty = np.zeros(n)
+    turning = np.ones(n, dtype=bool)
+    rate = last_rate = np.zeros(n)
+    last_predicted = None
+    stop_rate, stop_turned = np.zeros(n), np.zeros(n)
+    for _ in range(int(SkateBack.TURN_TIMEOUT / SkateBack.TICK_PERIOD)):
+        if not turning.any():
+            break
+        duty = np.where(turning, np.minimum(duty + acc_step, turn_duty), 0.0)
+        setpoint = np.stack((-duty, duty))
+        for i in range(ticks):
+            board.step(setpoint, i == 0)
+        turned = np.degrees(board.pose[2])
+        last_rate, rate = rate, np.degrees((board.erpm[1] - board.erpm[0]) * METERS_PER_ERPM_S / TRACK_WIDTH)
+        stop_rate_now = np.maximum(rate + np.maximum(rate - last_rate, 0.0), 0.0)
+        predicted = turned + stop_rate_now * lead
+        step = 0.0 if last_predicted is None else np.maximum(predicted - last_predicted, 0.0)
+        stopping = turning & (predicted + step / 2 >= angle)
+        stop_rate = np.where(stopping, stop_rate_now, stop_rate)
+        stop_turned = np.where(stopping, turned, stop_turned)
+        turning &= ~stopping
+        last_predicted = predicted
+    board.run(lambda t: np.zeros((2, n)), SETTLE)
+
+    turned = np.degrees(board.pose[2])
+    coast = np.where(stop_rate > 0, (turned - stop_turned) / np.maximum(stop_rate, 1e-9), lead)
+    lead = np.clip(lead + SkateBack.TURN_LEAD_GAIN * (coast - lead), 0.0, 1.0)
+    return turned, np.hypot(board.pose[0], board.pose[1]), lead
+
+
+def simulate(acc_step, dec_step, brk_step, turn_duty):
+    """
+    Run the turn, stop and decel scenarios for arrays of parameters.
+
+    Args:
+        acc_step, dec_step, brk_step, turn_duty (ndarray [n]): One entry per combination.
+
+    Returns:
+        dict: turn_error_deg and turn_drift_m of the last turn,
+        turn_first_error_deg, stop_distance_m and decel_distance_m arrays.
+    """
+    n = len(acc_step)
+    zero = np.zeros(n)
+
+    # TURN_REPEATS turns of TURN_ANGLE, learning the coast estimate as SkateBack does
+    lead = np.full(n, SkateBack.TURN_STOP_LEAD)
+    errors = []
+    for _ in range(TURN_REPEATS):
+        turned, turn_drift, lead = turn(acc_step, turn_duty, lead)
+        errors.append(turned - SkateBack.TURN_ANGLE)
+
+    # stop() from cruise
+    stop = BoardBatch(n)
+    stop.set_speed(CRUISE_DUTY)
+    cruise = np.full(n, CRUISE_DUTY)
+    stop_time = float(np.max(np.ceil(CRUISE_DUTY / brk_step))) * STOP_PERIOD
+    stop_distance = stop.run(lambda t: np.stack([_stop_ramp(t, cruise, brk_step)] * 2), stop_time + SETTLE)
+
+    # decelerate_to(0) from cruise
+    decel = BoardBatch(n)
+    decel.set_speed(CRUISE_DUTY)
+    decel_time = float(np.max(np.ceil(CRUISE_DUTY / dec_step))) * RAMP_PERIOD
+    decel_distance = decel.run(lambda t: np.stack([_ramp(t, cruise, zero, dec_step, RAMP_PERIOD)] * 2),
+                               decel_time + SETTLE)
+
+    return {
+        "turn_error_deg": errors[-1],
+        "turn_first_error_deg": errors[0],
+        "turn_drift_m": turn_drift,
+        "stop_distance_m": stop_distance,
+        "decel_distance_m": decel_distance,
+    }
+
+
+def _simulate_chunk(chunk):
+    return simulate(*chunk.T)
+
+
+def sweep(acc_steps, dec_steps, brk_steps, turn_duties, workers=None, chunk=CHUNK):
+    """
+    Simulate every combination of the given parameter values across a process pool.
+
+    Returns:
+        tuple: (params ndarray [n, 4] of acc, dec, brk, turn_duty; dict of result arrays)
+    """
+    params = np.array(list(itertools.product(acc_steps, dec_steps, brk_steps, turn_duties)))
+    chunks = [params[i:i + chunk] for i in range(0, len(params), chunk)]
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for part in pool.map(_simulate_chunk, chunks):
+            for key, values in part.items():
+                results.setdefault(key, []).append(values)
+    return params, {key: np.concatenate(values) for key, values in results.items()}
+
+
+def _range(text):
+    """
+    Parse 'start:stop:num' (inclusive, like np.linspace) or a single value.
+    """
+    parts = [float(p) for p in text.split(':')]
+    if len(parts) == 1:
+        return np.array(parts)
+    return np.linspace(parts[0], parts[1], int(parts[2]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep SkateBack ramp and turn parameters in simulation")
+    parser.add_argument("--acc", type=_range, default=_range("0.003:0.01:8"), help="ACC_STEP values, start:stop:num")
+    parser.add_argument("--dec", type=_range, default=_range(str(SkateBack.DEC_STEP)), help="DEC_STEP values")
+    parser.add_argument("--brk", type=_range, default=_range(str(SkateBack.BRK_STEP)), help="BRK_STEP values")
+    parser.add_argument("--turn-duty", type=_range, default=_range("0.06:0.2:8"), help="Turn duty cycle values")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("-o", "--output", help="CSV file (default: stdout)")
+    args = parser.parse_args()
+
+    params, results = sweep(args.acc, args.dec, args.brk, args.turn_duty, workers=args.workers)
+    columns = ["acc_step", "dec_step", "brk_step", "turn_duty"] + list(results)
+    rows = np.column_stack([params] + [results[key] for key in results])
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    writer.writerows([f"{value:.6g}" for value in row] for row in rows)
+    if args.output:
+        out.close()
@@ -0,0 +1,159 @@
+"""
+Clocks for the controller.
+
+SkateBack never calls time.sleep or time.time directly; it asks its clock.
+RealClock is the wall clock with one thread per periodic task. SimClock is a
+deterministic virtual clock: time only moves when someone sleeps on it, and
+periodic tasks (the motor ticks) run inline at their exact due times, so a full
+stop or turn runs as fast as the CPU allows and every run ticks identically.
+
+SimClock is meant to be driven from a single thread. Sleeps from several
+threads each advance the clock, so time is no longer reproducible.
+"""
+import heapq
+import itertools
+import threading
+import time
+import logs
+
+log = logs.get('clock')
+
+
+class PeriodicTask:
+    def __init__(self, period, callback, start=0.0, name=None):
+        self.period = period
+        self.callback = callback
+        self.start = start
+        self.name = name
+        self.calls = 0
+        self.cancelled = False
+
+    def due(self):
+        """
+        Time of the next call, computed from the start so ticks do not drift.
+        """
+        return self.start + self.calls * self.period
+
+    def cancel(self):
+        """
+        Stop calling the callback. A call in progress finishes.
+        """
+        self.cancelled = True
+
+
+class RealClock:
+    def time(self):
+        """
+        Seconds from an arbitrary start point.
+        """
+        return time.monotonic()
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+    def wait(self, event, timeout):
+        """
+        Sleep until the event is set or the timeout passes.
+
+        Returns:
+            bool: True if the event was set.
+        """
+        return event.wait(timeout)
+
+    def call_every(self, period, callback, name=None):
+        """
+        Call callback every period seconds on a daemon thread.
+
+        Calls are scheduled on fixed deadlines, so time spent in the callback
+        does not stretch the period. If a call overruns, the next one starts
+        straight away instead of trying to catch up. An exception in the
+        callback is logged and the next call goes ahead as usual, so one bad
+        tick never ends the task.
+
+        Args:
+            period (float): Seconds between calls.
+            callback (function): Called with no arguments.
+            name (str): Thread name.
+
+        Returns:
+            PeriodicTask: Handle whose cancel() stops the task.
+        """
+        task = PeriodicTask(period, callback, name=name)
+
+        def run():
+            deadline = time.monotonic()
+            while not task.cancelled:
+                try:
+                    task.callback()
+                except Exception as e:
+                    log.error("Error in periodic task %s: %r", name, e)
+                deadline += period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return task
+
+
+class SimClock:
+    def __init__(self, start=0.0):
+        """
+        Virtual clock starting at the given time.
+        """
+        self.now = start
+        self._tasks = []                # Heap of (due, order, task)
+        self._order = itertools.count()
+        self._lock = threading.RLock()
+
+    def time(self):
+        return self.now
+
+    def call_every(self, period, callback, name=None):
+        """
+        Call callback every period seconds of virtual time, starting now.
+
+        The first call happens on the next sleep() or advance(), like the
+        real clock's thread starting up. As there, an exception in the
+        callback is logged and the task keeps its schedule.
+        """
+        with self._lock:
+            task = PeriodicTask(period, callback, start=self.now, name=name)
+            heapq.heappush(self._tasks, (task.due(), next(self._order), task))
+        return task
+
+    def advance(self, duration):
+        """
+        Move virtual time forward, running every periodic task that falls due
+        in order. Tasks due at the same instant run in the order they were added.
+        """
+        with self._lock:
+            end = self.now + duration
+            while self._tasks and self._tasks[0][0] <= end:
+                due, order, task = heapq.heappop(self._tasks)
+                if task.cancelled:
+                    continue
+                self.now = max(self.now, due)
+                try:
+                    task.callback()
+                except Exception as e:
+                    log.error("Error in periodic task %s: %r", task.name, e)
+                task.calls += 1
+                heapq.heappush(self._tasks, (task.due(), order, task))
+            self.now = max(self.now, end)
+
+    def sleep(self, duration):
+        self.advance(duration)
+
+    def wait(self, event, timeout):
+        """
+        Advance by the timeout unless the event is already set. Nothing else
+        can set it while virtual time is moving, short of a periodic task.
+        """
+        if event.is_set():
+            return True
+        self.advance(timeout)
+        return event.is_set()
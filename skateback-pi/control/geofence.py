@@ -0,0 +1,402 @@
+"""
+Geofences: no-go zones in world coordinates (see world.py) and a uniform grid
+index over them.
+
+When the board drives itself back it has to stay off the roads and out of the
+buildings around the World origin, so every pose update asks which zone the
+board is in and how far it is from the nearest zone boundary, and a planner
+checks whole candidate paths at once.
+
+The zones' bounding box is divided into square cells of CELL metres. Each cell
+lists the zones whose bounding box overlaps it and the boundary edges that pass
+near it. A cell no edge passes through is entirely inside one zone or outside
+all of them, which is worked out once when the index is built, so most point
+queries are one array lookup. Only points in boundary cells are ray cast
+against the candidate zones (even-odd rule, so a zone's holes work too), and a
+distance query only looks at the edges in the cells around the point.
+
+Single points are answered in plain Python, which is faster than numpy at that
+size. zones_at() and distances() answer arrays of points with numpy.
+
+Zones are stored in a JSON file as
+
+    {"zones": [{"name": "Forbes Ave", "rings": [[[x, y], ...], ...]}, ...]}
+
+with the outline as the first ring and any holes after it, or as a GeoJSON
+FeatureCollection of Polygons in longitude/latitude.
+"""
+import json
+import math
+import numpy as np
+
+CELL = 10.0             # Grid cell size (m)
+MAX_CELLS = 1000000     # Use larger cells rather than a grid bigger than this
+
+
+def _expand(starts, counts):
+    """
+    Flatten variable-length ranges: for ranges i of counts[i] items from
+    starts[i], the range each item belongs to and the item's index.
+    """
+    total = int(counts.sum())
+    rows = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, np.repeat(starts, counts) + offsets
+
+
+def _gap(value, low, high):
+    """
+    Distance from value to the interval [low, high], 0 inside it.
+    """
+    return low - value if value < low else value - high if value > high else 0.0
+
+
+def _span(center, reach, low, high):
+    """
+    Cells from low to high that come within reach cells of center.
+    """
+    if reach < math.inf:
+        low = max(low, math.floor(center - reach))
+        high = min(high, math.floor(center + reach))
+    return range(low, high + 1)
+
+
+def _segment_distance(px, py, x0, y0, x1, y1):
+    """
+    Distance from points to segments, elementwise over numpy arrays.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    t = np.clip(((px - x0) * dx + (py - y0) * dy) / np.where(length2 > 0.0, length2, 1.0), 0.0, 1.0)
+    return np.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+
+
+class Geofence:
+    def __init__(self, zones, cell=CELL):
+        """
+        Build the index.
+
+        Args:
+            zones (list): (name, rings) pairs. rings is a list of polygons, each
+                          a sequence of (x, y) world coordinates in metres; the
+                          first is the zone's outline and the rest are holes.
+            cell (float): Grid cell size (m). Around the size of a typical zone
+                          works well.
+        """
+        self.names = []
+        edges, edge_zone, zone_edge_start = [], [], [0]
+        for name, rings in zones:
+            self.names.append(name)
+            for ring in rings:
+                ring = [tuple(map(float, point)) for point in ring]
+                if len(ring) > 1 and ring[0] == ring[-1]:
+                    ring.pop()      # GeoJSON repeats the first point
+                for i, start in enumerate(ring):
+                    edges.append(start + ring[(i + 1) % len(ring)])
+                    edge_zone.append(len(self.names) - 1)
+            zone_edge_start.append(len(edges))
+        # Edges of zone z are edges[zone_edge_start[z]:zone_edge_start[z + 1]]
+        self.edges = np.array(edges, dtype=float).reshape(-1, 4)
+        self.edge_zone = np.array(edge_zone, dtype=np.int64)
+        self.zone_edge_start = np.array(zone_edge_start, dtype=np.int64)
+
+        if len(self.edges):
+            xs, ys = self.edges[:, [0, 2]], self.edges[:, [1, 3]]
+            self.origin = (xs.min(), ys.min())
+            width, height = xs.max() - self.origin[0], ys.max() - self.origin[1]
+        else:
+            self.origin, width, height = (0.0, 0.0), 0.0, 0.0
+        cell = max(cell, math.sqrt(width * height / MAX_CELLS))
+        self.cell = cell
+        self.nx = int(width // cell) + 1
+        self.ny = int(height // cell) + 1
+        self._build_cells()
+
+    @classmethod
+    def load(cls, path, cell=CELL):
+        """
+        Read zones from a JSON file (see the module docstring).
+
+        Args:
+            path (str): File to read.
+            cell (float): Grid cell size (m).
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if "features" not in data:
+            return cls([(zone["name"], zone["rings"]) for zone in data["zones"]], cell)
+
+        import world    # Pulls in utm, only needed for GeoJSON
+
+        zones = []
+        for number, feature in enumerate(data["features"]):
+            geometry = feature["geometry"]
+            polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+            name = (feature.get("properties") or {}).get("name", f"zone {number}")
+            for polygon in polygons:
+                # GeoJSON is (longitude, latitude); World wants (latitude, longitude)
+                rings = [world.World.gps_to_world_numpy(np.asarray(ring, dtype=float)[:, ::-1]) for ring in polygon]
+                zones.append((name, rings))
+        return cls(zones, cell)
+
+    def _cell_range(self, low, high, count, origin):
+        return (max(0, int((low - origin) // self.cell)),
+                min(count - 1, int((high - origin) // self.cell)))
+
+    def _build_cells(self):
+        """
+        Fill the per-cell zone and edge lists, flattened as start offsets into
+        one index array each, and classify the cells no edge passes through.
+        """
+        cells = self.nx * self.ny
+        cell_zones = [[] for _ in range(cells)]
+        cell_edges = [[] for _ in range(cells)]
+        for zone in range(len(self.names)):
+            block = self.edges[self.zone_edge_start[zone]:self.zone_edge_start[zone + 1]]
+            if not len(block):
+                continue
+            x0, x1 = self._cell_range(block[:, [0, 2]].min(), block[:, [0, 2]].max(), self.nx, self.origin[0])
+            y0, y1 = self._cell_range(block[:, [1, 3]].min(), block[:, [1, 3]].max(), self.ny, self.origin[1])
+            for j in range(y0, y1 + 1):
+                for i in range(x0, x1 + 1):
+                    cell_zones[j * self.nx + i].append(zone)
+        for number, (ax, ay, bx, by) in enumerate(self.edges.tolist()):
+            x0, x1 = self._cell_range(min(ax, bx), max(ax, bx), self.nx, self.origin[0])
+            y0, y1 = self._cell_range(min(ay, by), max(ay, by), self.ny, self.origin[1])
+            for j in range(y0, y1 + 1):
+                for i in range(x0, x1 + 1):
+                    cell_edges[j * self.nx + i].append(number)
+
+        self.cell_zone_count = np.array([len(zones) for zones in cell_zones], dtype=np.int64)
+        self.cell_zone_start = np.cumsum(self.cell_zone_count) - self.cell_zone_count
+        self.cell_zone_ids = np.array([z for zones in cell_zones for z in zones], dtype=np.int64)
+        self.cell_edge_count = np.array([len(edges) for edges in cell_edges], dtype=np.int64)
+        self.cell_edge_start = np.cumsum(self.cell_edge_count) - self.cell_edge_count
+        self.cell_edge_ids = np.array([e for edges in cell_edges for e in edges], dtype=np.int64)
+
+        # Zone containing each cell with no edges in it, from its centre;
+        # -2 marks boundary cells, which need a ray cast per point
+        self.cell_zone = np.full(cells, -2, dtype=np.int64)
+        interior = np.nonzero(self.cell_edge_count == 0)[0]
+        centres = np.stack((self.origin[0] + (interior % self.nx + 0.5) * self.cell,
+                            self.origin[1] + (interior // self.nx + 0.5) * self.cell), axis=1)
+        self.cell_zone[interior] = self._ray_cast(centres, interior)
+
+        # Plain Python copies for single point queries
+        self._edge_list = [tuple(edge) for edge in self.edges.tolist()]
+        self._zone_edges = [self._edge_list[start:end] for start, end
+                            in zip(self.zone_edge_start[:-1].tolist(), self.zone_edge_start[1:].tolist())]
+        self._cell_zones = cell_zones
+        self._cell_edges = cell_edges
+        self._cell_zone_list = self.cell_zone.tolist()
+
+    def _cells(self, points):
+        """
+        Integer cell coordinates of points, and their flat index (-1 outside the grid).
+        """
+        i = np.floor((points[:, 0] - self.origin[0]) / self.cell).astype(np.int64)
+        j = np.floor((points[:, 1] - self.origin[1]) / self.cell).astype(np.int64)
+        inside = (i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny)
+        return i, j, np.where(inside, j * self.nx + i, -1)
+
+    def _ray_cast(self, points, cells):
+        """
+        Zone index containing each point, or -1, testing the zones listed for
+        each point's cell.
+        """
+        result = np.full(len(points), len(self.names), dtype=np.int64)
+        rows, slots = _expand(self.cell_zone_start[cells], self.cell_zone_count[cells])
+        zones = self.cell_zone_ids[slots]
+        pairs, edges = _expand(self.zone_edge_start[zones], np.diff(self.zone_edge_start)[zones])
+        px, py = points[rows[pairs], 0], points[rows[pairs], 1]
+        x0, y0, x1, y1 = self.edges[edges].T
+        # Even-odd rule: count edges crossing a ray from the point in +x
+        crosses = ((y0 > py) != (y1 > py)) & (px < x0 + (py - y0) * (x1 - x0) / np.where(y1 != y0, y1 - y0, 1.0))
+        inside = np.bincount(pairs, weights=crosses, minlength=len(zones)).astype(np.int64) % 2 == 1
+        # A point inside overlapping zones reports the first one
+        np.minimum.at(result, rows[inside], zones[inside])
+        result[result == len(self.names)] = -1
+        return result
+
+    def zone_at(self, x, y):
+        """
+        The zone containing a point.
+
+        Args:
+            x (float): World x (m).
+            y (float): World y (m).
+
+        Returns:
+            str: The zone's name, or None outside every zone.
+        """
+        i = math.floor((x - self.origin[0]) / self.cell)
+        j = math.floor((y - self.origin[1]) / self.cell)
+        if not (0 <= i < self.nx and 0 <= j < self.ny):
+            return None
+        cell = j * self.nx + i
+        zone = self._cell_zone_list[cell]
+        if zone == -2:
+            zone = -1
+            for candidate in self._cell_zones[cell]:
+                inside = False
+                for x0, y0, x1, y1 in self._zone_edges[candidate]:
+                    if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                        inside = not inside
+                if inside:
+                    zone = candidate
+                    break
+        return None if zone < 0 else self.names[zone]
+
+    def distance(self, x, y, limit=math.inf):
+        """
+        Distance from a point to the nearest zone boundary, inside or outside.
+
+        Args:
+            x (float): World x (m).
+            y (float): World y (m).
+            limit (float): Stop looking this far out; returned if nothing is closer.
+
+        Returns:
+            float: Distance in metres.
+        """
+        u = (x - self.origin[0]) / self.cell
+        v = (y - self.origin[1]) / self.cell
+        i = math.floor(u)
+        j = math.floor(v)
+        best = limit
+        # Rings of cells around the point. Everything outside ring k is at
+        # least k cells away, so stop once the best edge is closer than that.
+        # A point off the grid starts at the first ring that reaches it
+        first = max(0, -i, i - (self.nx - 1), -j, j - (self.ny - 1))
+        for k in range(first, max(i, j, self.nx - 1 - i, self.ny - 1 - j) + 1):
+            bound = self._ring_bound(u, v, i, j, k) if first else (k - 1) * self.cell
+            if bound >= best:
+                break
+            # All of the top and bottom rows, just the two ends of the rows
+            # between, each cut down to the cells that could hold a closer edge
+            for cj in (j - k, j + k) if k else (j,):
+                if 0 <= cj < self.ny:
+                    gap = _gap(v, cj, cj + 1) * self.cell
+                    if gap < best:
+                        reach = math.sqrt(best * best - gap * gap) / self.cell
+                        for ci in _span(u, reach, max(i - k, 0), min(i + k, self.nx - 1)):
+                            best = self._cell_distance(x, y, cj * self.nx + ci, best)
+            for ci in (i - k, i + k) if k else ():
+                if 0 <= ci < self.nx:
+                    gap = _gap(u, ci, ci + 1) * self.cell
+                    if gap < best:
+                        reach = math.sqrt(best * best - gap * gap) / self.cell
+                        for cj in _span(v, reach, max(j - k + 1, 0), min(j + k - 1, self.ny - 1)):
+                            best = self._cell_distance(x, y, cj * self.nx + ci, best)
+        return best
+
+    def _cell_distance(self, x, y, cell, best):
+        """
+        Distance from a point to the nearest of a cell's edges, or best if
+        none is closer.
+        """
+        for edge in self._cell_edges[cell]:
+            x0, y0, x1, y1 = self._edge_list[edge]
+            dx, dy = x1 - x0, y1 - y0
+            length2 = dx * dx + dy * dy
+            t = ((x - x0) * dx + (y - y0) * dy) / length2 if length2 else 0.0
+            t = 0.0 if t < 0.0 else 1.0 if t > 1.0 else t
+            d = math.hypot(x - x0 - t * dx, y - y0 - t * dy)
+            if d < best:
+                best = d
+        return best
+
+    def _ring_bound(self, u, v, i, j, k):
+        """
+        Distance from a point off the grid to the grid cells at least k cells
+        from its own. Ring k's cells on the grid lie in up to four strips
+        along the grid's sides, seen at a slant from a point off a corner, so
+        k cells would undercount by up to a factor of sqrt(2) and leave far
+        queries scanning whole rings that cannot hold anything closer.
+
+        Args:
+            u, v (float): The point in cells from the grid origin.
+            i, j (int): Its cell.
+            k (int): Ring.
+
+        Returns:
+            float: Lower bound in metres, inf if no grid cell is that far out.
+        """
+        gu = _gap(u, 0, self.nx)
+        gv = _gap(v, 0, self.ny)
+        bound = math.inf
+        if i - k >= 0:
+            bound = min(bound, math.hypot(_gap(u, 0, i - k + 1), gv))
+        if i + k < self.nx:
+            bound = min(bound, math.hypot(_gap(u, i + k, self.nx), gv))
+        if j - k >= 0:
+            bound = min(bound, math.hypot(gu, _gap(v, 0, j - k + 1)))
+        if j + k < self.ny:
+            bound = min(bound, math.hypot(gu, _gap(v, j + k, self.ny)))
+        return bound * self.cell
+
+    def zones_at(self, points):
+        """
+        Zone containing each of an array of points.
+
+        Args:
+            points (numpy.ndarray [size: (N,2)]): World x, y pairs.
+
+        Returns:
+            numpy.ndarray [size: (N,)]: Index into self.names, or -1 outside every zone.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        _, _, cells = self._cells(points)
+        result = np.where(cells >= 0, self.cell_zone[np.maximum(cells, 0)], -1)
+        boundary = np.nonzero(result == -2)[0]
+        if len(boundary):
+            result[boundary] = self._ray_cast(points[boundary], cells[boundary])
+        return result
+
+    def distances(self, points, limit):
+        """
+        Distance from each of an array of points to the nearest zone boundary,
+        looking only as far as limit.
+
+        Args:
+            points (numpy.ndarray [size: (N,2)]): World x, y pairs.
+            limit (float): Largest distance of interest (m).
+
+        Returns:
+            numpy.ndarray [size: (N,)]: Distances in metres, limit where no boundary is closer.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = np.full(len(points), float(limit))
+        reach = int(math.ceil(limit / self.cell))
+        i, j, _ = self._cells(points)
+        offsets = np.arange(-reach, reach + 1)
+        ci = (i[:, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1).reshape(len(points), -1)
+        cj = (j[:, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2).reshape(len(points), -1)
+        valid = (ci >= 0) & (ci < self.nx) & (cj >= 0) & (cj < self.ny)
+        rows, cells = np.nonzero(valid)
+        cells = cj[rows, cells] * self.nx + ci[rows, cells]
+        pairs, slots = _expand(self.cell_edge_start[cells], self.cell_edge_count[cells])
+        if not len(slots):
+            return result
+        point_rows = rows[pairs]
+        x0, y0, x1, y1 = self.edges[self.cell_edge_ids[slots]].T
+        d = _segment_distance(points[point_rows, 0], points[point_rows, 1], x0, y0, x1, y1)
+        np.minimum.at(result, point_rows, d)
+        return result
+
+    def check_path(self, points, margin=0.0):
+        """
+        First point of a path that enters a zone or comes within margin of one.
+
+        Args:
+            points (numpy.ndarray [size: (N,2)]): World x, y pairs along the path.
+            margin (float): Clearance to keep from every zone boundary (m).
+
+        Returns:
+            int: Index of the first offending point, or None if the path is clear.
+        """
+        bad = self.zones_at(points) >= 0
+        if margin > 0.0:
+            bad |= self.distances(points, margin) < margin
+        offending = np.nonzero(bad)[0]
+        return int(offending[0]) if len(offending) else None
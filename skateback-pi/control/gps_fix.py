@@ -0,0 +1,254 @@
+"""
+GPS fix acquisition: accuracy-weighted position and heading estimates that
+stop as soon as they are good enough.
+
+Each fix is weighted by 1 / accuracy^2, using the horizontal accuracy (hAcc)
+or heading accuracy the receiver reports with it, so a 0.5 m fix counts 100
+times as much as a 5 m one. Headings are averaged on the circle (mean of unit
+vectors), so 359 and 1 average to 0, not 180.
+
+The uncertainty of an estimate is the larger of what the reported accuracies
+give, sqrt(1 / sum of weights), and what the scatter of the accepted fixes
+gives, so a receiver that is optimistic about its accuracy does not end the
+acquisition early. Once MIN_FIXES are in, a fix further from the estimate than
+OUTLIER_SIGMA times its combined uncertainty is rejected (multipath jumps, a
+stale heading). One of the first fixes can itself be the outlier, so while the
+scatter is more than OUTLIER_SIGMA times what the reported accuracies allow,
+the fix furthest out is dropped again. acquire() stops when the uncertainty is
+within the requested confidence, or gives up after max_reads.
+
+Acquisition takes at most MAX_READS readings, so the estimates keep their
+accepted fixes and recompute from them, which makes dropping one trivial.
+"""
+import math
+
+MIN_FIXES = 2               # Fixes needed before the estimate can be trusted or reject anything
+OUTLIER_SIGMA = 3.0         # Reject a fix this many combined standard deviations from the estimate
+MAX_READS = 30              # Give up after this many readings
+LOCATION_CONFIDENCE = 1.5   # Default uncertainty to reach for a location (m)
+HEADING_CONFIDENCE = 3.0    # Default uncertainty to reach for a heading (degrees)
+
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LON = 111320.0   # At the equator, times cos(latitude)
+
+
+def _effective_count(weights):
+    """
+    Number of equally weighted fixes that would give the same precision.
+    """
+    return sum(weights) ** 2 / sum(w * w for w in weights)
+
+
+class LocationEstimate:
+    def __init__(self):
+        """
+        Weighted mean of fixes, kept in metres east and north of the first fix
+        so a handful of readings never needs a projection.
+        """
+        self.origin = None
+        self.rejected = 0
+        self._fixes = []            # Accepted (east, north, weight)
+        self._mean = (0.0, 0.0)
+        self._scatter = 0.0         # Weighted sum of squared distances from the mean
+        self._sum_w = 0.0
+
+    @property
+    def count(self):
+        return len(self._fixes)
+
+    def _local(self, lat, lon):
+        lat0, lon0 = self.origin
+        return ((lon - lon0) * METERS_PER_DEG_LON * math.cos(math.radians(lat0)),
+                (lat - lat0) * METERS_PER_DEG_LAT)
+
+    def add(self, lat, lon, accuracy):
+        """
+        Add a fix unless it is an outlier.
+
+        Args:
+            lat (float): Latitude in degrees.
+            lon (float): Longitude in degrees.
+            accuracy (float): Reported horizontal accuracy (m).
+
+        Returns:
+            bool: True if the fix was accepted.
+        """
+        accuracy = max(accuracy, 0.01)
+        if self.origin is None:
+            self.origin = (lat, lon)
+        x, y = self._local(lat, lon)
+        if self.count >= MIN_FIXES:
+            limit = OUTLIER_SIGMA * math.hypot(accuracy, self.accuracy)
+            if math.hypot(x - self._mean[0], y - self._mean[1]) > limit:
+                self.rejected += 1
+                return False
+
+        fix = (x, y, 1.0 / (accuracy * accuracy))
+        self._fixes.append(fix)
+        self._update()
+        while self.count > MIN_FIXES and self._observed() > OUTLIER_SIGMA * self._reported():
+            mean_x, mean_y = self._mean
+            self._fixes.remove(max(self._fixes, key=lambda f: f[2] * ((f[0] - mean_x) ** 2 + (f[1] - mean_y) ** 2)))
+            self.rejected += 1
+            self._update()
+        return fix in self._fixes
+
+    def _update(self):
+        self._sum_w = sum(w for x, y, w in self._fixes)
+        self._mean = (sum(w * x for x, y, w in self._fixes) / self._sum_w,
+                      sum(w * y for x, y, w in self._fixes) / self._sum_w)
+        self._scatter = sum(w * ((x - self._mean[0]) ** 2 + (y - self._mean[1]) ** 2) for x, y, w in self._fixes)
+
+    def _reported(self):
+        return math.sqrt(1.0 / self._sum_w)
+
+    def _observed(self):
+        """
+        Uncertainty of the mean from the scatter of the fixes (m).
+        """
+        if self.count < 2:
+            return 0.0
+        effective = _effective_count([w for x, y, w in self._fixes])
+        return math.sqrt(self._scatter / self._sum_w / max(effective - 1.0, 1.0))
+
+    @property
+    def accuracy(self):
+        """
+        Standard uncertainty of the estimate (m), or infinity with no fixes.
+        """
+        if not self.count:
+            return math.inf
+        return max(self._reported(), self._observed())
+
+    @property
+    def value(self):
+        """
+        (latitude, longitude) in degrees, or None with no fixes.
+        """
+        if not self.count:
+            return None
+        lat0, lon0 = self.origin
+        return (lat0 + self._mean[1] / METERS_PER_DEG_LAT,
+                lon0 + self._mean[0] / (METERS_PER_DEG_LON * math.cos(math.radians(lat0))))
+
+
+def _angle_difference(a, b):
+    """
+    Signed smallest difference a - b in degrees, in [-180, 180).
+    """
+    return (a - b + 180.0) % 360.0 - 180.0
+
+
+class HeadingEstimate:
+    def __init__(self):
+        """
+        Weighted circular mean of headings.
+        """
+        self.rejected = 0
+        self._headings = []         # Accepted (heading, weight)
+        self._sin = 0.0
+        self._cos = 0.0
+        self._sum_w = 0.0
+
+    @property
+    def count(self):
+        return len(self._headings)
+
+    def add(self, heading, accuracy):
+        """
+        Add a heading unless it is an outlier.
+
+        Args:
+            heading (float): Heading in degrees.
+            accuracy (float): Reported heading accuracy (degrees).
+
+        Returns:
+            bool: True if the heading was accepted.
+        """
+        accuracy = max(accuracy, 0.01)
+        if self.count >= MIN_FIXES:
+            limit = OUTLIER_SIGMA * math.hypot(accuracy, self.accuracy)
+            if abs(_angle_difference(heading, self.value)) > limit:
+                self.rejected += 1
+                return False
+
+        reading = (heading, 1.0 / (accuracy * accuracy))
+        self._headings.append(reading)
+        self._update()
+        while self.count > MIN_FIXES and self._observed() > OUTLIER_SIGMA * self._reported():
+            mean = self.value
+            self._headings.remove(max(self._headings, key=lambda h: h[1] * _angle_difference(h[0], mean) ** 2))
+            self.rejected += 1
+            self._update()
+        return reading in self._headings
+
+    def _update(self):
+        self._sum_w = sum(w for heading, w in self._headings)
+        self._sin = sum(w * math.sin(math.radians(heading)) for heading, w in self._headings)
+        self._cos = sum(w * math.cos(math.radians(heading)) for heading, w in self._headings)
+
+    def _reported(self):
+        return math.sqrt(1.0 / self._sum_w)
+
+    def _observed(self):
+        """
+        Uncertainty of the mean from the circular spread of the headings (degrees).
+        """
+        if self.count < 2:
+            return 0.0
+        resultant = self.resultant
+        if resultant <= 0.0:
+            return 180.0
+        spread = math.degrees(math.sqrt(-2.0 * math.log(min(resultant, 1.0))))     # Circular standard deviation
+        return spread / math.sqrt(_effective_count([w for heading, w in self._headings]))
+
+    @property
+    def resultant(self):
+        """
+        Mean resultant length, 1 when every heading agrees. One minus this is
+        the circular variance.
+        """
+        if not self.count:
+            return 0.0
+        return math.hypot(self._sin, self._cos) / self._sum_w
+
+    @property
+    def accuracy(self):
+        """
+        Standard uncertainty of the estimate (degrees), or infinity with no headings.
+        """
+        if not self.count:
+            return math.inf
+        return max(self._reported(), self._observed())
+
+    @property
+    def value(self):
+        """
+        Heading in degrees in [0, 360), or None with no headings.
+        """
+        if not self.count:
+            return None
+        return math.degrees(math.atan2(self._sin, self._cos)) % 360.0
+
+
+def acquire(read, estimate, confidence, max_reads=MAX_READS):
+    """
+    Feed readings into an estimate until it is within the confidence.
+
+    Args:
+        read (function): Returns the next reading as a tuple of arguments for
+                         estimate.add(), or None for an empty reading.
+        estimate: A LocationEstimate or HeadingEstimate.
+        confidence (float): Uncertainty to reach, in the estimate's units.
+        max_reads (int): Readings, empty ones included, before giving up.
+
+    Returns:
+        int: Number of readings taken.
+    """
+    for reads in range(1, max_reads + 1):
+        reading = read()
+        if reading is not None:
+            estimate.add(*reading)
+        if estimate.count >= MIN_FIXES and estimate.accuracy <= confidence:
+            return reads
+    return max_reads
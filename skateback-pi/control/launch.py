@@ -0,0 +1,206 @@
+"""
+Current-controlled launch from standstill.
+
+In duty cycle mode the motor current is (duty - back EMF) * V / R. Every step
+of a ramp from standstill therefore puts a current step into the wheels, and
+its size depends on the battery voltage. The speed controller's MAX_DUTY_STEP
+behaves the same way. With launch mode on (SkateBack.enable_launch()) a start
+from standstill is driven by motor current instead. Launch moves each wheel's
+current towards max_current by at most current_rate amps per second.
+Acceleration follows current, so this limits the jerk.
+
+Launch hands over to the speed controller once both wheels are at HANDOVER of
+their target, or as soon as either wheel reaches its target so neither waits
+for the other. The speed controller starts from the duty cycle that keeps the
+same current, and its MAX_DUTY_STEP eases the current down from there. A
+launch that hands over to fixed duty cycles (an accelerate from standstill)
+also hands over once the duty cycle that gives the same current has passed
+the target duty. From then on the duty cycle asks for less current than the
+launch.
+
+Slip shows up as the wheels' ERPM parting by more than the commanded turn
+explains, with the faster wheel also speeding up faster. Slip is checked on
+every update. When one wheel slips, its current drops to SLIP_BACKOFF of its
+value in the same update. The other wheel drops to no more than that, so the
+board does not yaw towards the wheel that grips. Both currents stay there
+until the slipping wheel has come down from the fastest it spun and is
+speeding up with the board again. Whatever left/right difference is left then
+is heading the slip cost, and later checks start from it. For the rest of the
+launch both wheels stay below GRIP_MARGIN of the current the wheel slipped at.
+Slip shows in the ERPM a tick or two after it starts, so that current is the
+lowest of the last SLIP_LOOKBACK outputs.
+"""
+import collections
+import speed
+
+MAX_CURRENT = 12.0          # Default launch current per wheel (A), about 3 m/s2 on the simulated board
+CURRENT_LIMIT = 30.0        # Largest max_current accepted, the VESC motor current limit (A)
+CURRENT_RATE = 40.0         # Default largest change in current (A/s)
+HANDOVER = 0.9              # Hand over at this fraction of the target speed
+TIMEOUT = 5.0               # Hand over after this long whatever the speed (s)
+STANDSTILL_ERPM = 100.0     # Slower than this counts as standing still
+SLIP_ERPM = 150.0           # Unexplained left/right difference that counts as slip...
+SLIP_FRACTION = 0.08        # ...plus this fraction of the mean speed
+SLIP_BACKOFF = 0.5          # A slipping wheel keeps this fraction of its current
+GRIP_MARGIN = 0.8           # Later current stays below this fraction of the current that slipped
+SLIP_LOOKBACK = 2           # Outputs back the current that slipped is taken from
+MOTOR_RESISTANCE = 0.5      # Phase resistance for the handover duty cycle (ohm)
+
+
+def handover_duty(erpm, current, v_in):
+    """
+    Duty cycle that gives the same motor current at this speed, for the
+    controller taking over from a launch.
+
+    Args:
+        erpm (float): Measured ERPM, positive forward.
+        current (float): Motor current (A), positive forward.
+        v_in (float): Battery voltage.
+
+    Returns:
+        float: Duty cycle, positive forward.
+    """
+    return erpm / speed.ERPM_PER_DUTY + current * MOTOR_RESISTANCE / v_in
+
+
+class Launch:
+    def __init__(self, max_current=MAX_CURRENT, current_rate=CURRENT_RATE, detect_slip=True):
+        """
+        A launch from standstill. The motor tick calls update() every tick and
+        sends the currents it returns until done is set.
+
+        Args:
+            max_current (float): Largest motor current per wheel (A).
+            current_rate (float): Largest change in current per second (A/s).
+            detect_slip (bool): Back off a wheel whose ERPM runs away from the other's.
+        """
+        if not 0 < max_current <= CURRENT_LIMIT:
+            raise ValueError(f"Launch current must be between 0 and {CURRENT_LIMIT} A")
+        if current_rate <= 0:
+            raise ValueError("Current rate must be positive")
+        self.max_current = max_current
+        self.current_rate = current_rate
+        self.detect_slip = detect_slip
+        self.limit = max_current            # Lowered after a slip
+        self.currents = [0.0, 0.0]          # Latest (left, right) output, positive forward
+        self._recent = collections.deque(maxlen=SLIP_LOOKBACK)   # Latest outputs, in the direction of travel
+        self.erpms = None                   # Latest measured (left, right) ERPM
+        self.predicted = None               # The same extrapolated one update ahead
+        self._rise = (0.0, 0.0)             # Change in ERPM since the reading before
+        self._spun = [None, None]           # Fastest ERPM seen of a slipping wheel
+        self._offset = 0.0                  # Left/right difference left behind by earlier slips
+        self.slipping = [False, False]
+        self.slips = 0
+        self.peak_current = 0.0
+        self.elapsed = 0.0
+        self.done = False
+        self.reason = None                  # Why it handed over: 'speed', 'duty', 'timeout' or 'feedback'; None if cancelled
+
+    def update(self, targets, erpms, v_in, dt, duties=None):
+        """
+        One step.
+
+        Args:
+            targets (tuple): (left, right) target ERPM, both nonzero and the same sign.
+            erpms (tuple): (left, right) measured ERPM, positive forward; None if unknown.
+            v_in (tuple): (left, right) battery voltage.
+            dt (float): Seconds since the last update.
+            duties (tuple): (left, right) duty cycles the launch hands over to,
+                            or None when it hands over to the speed controller.
+
+        Returns:
+            tuple: (left, right) motor currents in amps, positive forward. Once
+            done is set the caller takes over from handover_duty() instead.
+        """
+        if erpms[0] is None or erpms[1] is None:
+            self._finish('feedback')
+            return tuple(self.currents)
+        self.elapsed += dt
+        # Readings lag the wheels by about one update; extrapolate for the handover
+        # from the change since the previous reading (not repeats of the same one)
+        if erpms != self.erpms:
+            previous = self.erpms or erpms
+            self.erpms = erpms
+            self.predicted = tuple(2 * erpms[i] - previous[i] for i in (0, 1))
+            self._rise = tuple(erpms[i] - previous[i] for i in (0, 1))
+        # Work in the direction of travel
+        direction = 1.0 if targets[0] + targets[1] > 0 else -1.0
+        targets = (targets[0] * direction, targets[1] * direction)
+        erpms = (erpms[0] * direction, erpms[1] * direction)
+        currents = [current * direction for current in self.currents]
+
+        if self.detect_slip:
+            self._check_slip(targets, erpms, (self._rise[0] * direction, self._rise[1] * direction), currents)
+
+        step = self.current_rate * dt
+        for i in (0, 1):
+            current = currents[i] + max(-step, min(step, self.limit - currents[i]))
+            if any(self.slipping):
+                current = min(current, currents[i])
+            currents[i] = current
+            self.peak_current = max(self.peak_current, current)
+        self.currents = [current * direction for current in currents]
+        self._recent.append(tuple(currents))
+
+        if (all(erpms[i] >= HANDOVER * targets[i] for i in (0, 1))
+                or any(erpms[i] >= targets[i] for i in (0, 1))):
+            self._finish('speed')
+        elif duties is not None and all(handover_duty(erpms[i], currents[i], v_in[i]) >= abs(duties[i])
+                                        for i in (0, 1)):
+            self._finish('duty')
+        elif self.elapsed >= TIMEOUT:
+            self._finish('timeout')
+        return tuple(self.currents)
+
+    def handover_duties(self, v_in):
+        """
+        (left, right) duty cycles that keep the wheels' present currents at
+        the speed they are expected to have reached by the next tick, see
+        handover_duty().
+        """
+        return tuple(handover_duty(self.predicted[i], self.currents[i], v_in[i]) for i in (0, 1))
+
+    def _check_slip(self, targets, erpms, rise, currents):
+        # Positive when the left wheel runs ahead of the right by more than the
+        # commanded turn asks for at this point of the launch. A wheel only
+        # slips if it is also speeding up faster than the other, not when it is
+        # ahead because the other is still falling back after its own slip.
+        mean_target = (targets[0] + targets[1]) / 2
+        mean = (erpms[0] + erpms[1]) / 2
+        progress = max(0.0, min(1.0, mean / mean_target))
+        difference = (erpms[0] - erpms[1]) - (targets[0] - targets[1]) * progress
+        for i in (0, 1):
+            if self.slipping[i]:
+                if erpms[i] < self._spun[i] and rise[i] >= 0:
+                    self.slipping[i] = False
+                    self._offset = difference
+                self._spun[i] = max(self._spun[i], erpms[i])
+        if any(self.slipping):
+            return
+        excess = difference - self._offset
+        wheel = 0 if excess > 0 else 1
+        if abs(excess) > SLIP_ERPM + SLIP_FRACTION * abs(mean) and rise[wheel] > rise[1 - wheel]:
+            self.slipping[wheel] = True
+            self._spun[wheel] = erpms[wheel]
+            self.slips += 1
+            slipped = min([recent[wheel] for recent in self._recent] + [currents[wheel]])
+            self.limit = min(self.limit, GRIP_MARGIN * slipped)
+            currents[wheel] *= SLIP_BACKOFF
+            currents[1 - wheel] = min(currents[1 - wheel], currents[wheel])
+
+    def _finish(self, reason):
+        self.done = True
+        self.reason = reason
+
+    def stats(self):
+        """
+        How the launch went, JSON serializable.
+        """
+        return {
+            "done": self.done,
+            "reason": self.reason,
+            "elapsed_s": round(self.elapsed, 2),
+            "peak_current": round(self.peak_current, 1),
+            "slips": self.slips,
+            "limit": round(self.limit, 1),
+        }
@@ -0,0 +1,373 @@
+"""
+Load test for the control socket with several boards and many clients.
+
+Starts N 'SkateBack.py --simulate' servers, one process per board on its own
+port. Each board is driven by C concurrent clients that speak the BLE bridge
+protocol: one newline-terminated command per line and one reply line each.
+Every client sends a scripted mix of commands, open loop, at R commands per
+second. A command goes out on schedule whether or not earlier replies have
+come back. Latency runs from the scheduled send time to the reply, so a server
+that falls behind shows up as latency, not as a lower offered rate.
+
+The clients of each board run in a process of their own, so the load
+generator does not put every board's clients behind one GIL.
+
+The report has these figures per board and in total:
+    latency percentiles (ms)
+    offered and achieved rate (cmd/s)
+    dropped: no reply by DRAIN seconds after the run
+    errored: the reply was an error or 'Unknown command'
+    connections that failed
+    server CPU per reply, from /proc (Linux only). The total and what is left
+    after the idle motor and telemetry ticks are both reported.
+
+A mix is a name from MIXES or inline 'command:weight,...'. Give --mix more
+than once to hand the mixes out to a board's clients in turn:
+
+    python loadtest.py --boards 4 --clients 8 --rate 20 --duration 10 --mix ride --mix dashboard
+    python loadtest.py --boards 2 --clients 1 --rate 200 --mix "accelerate:1,decelerate:1"
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from benchmark import HOST, free_port, summarize
+from SkateBack import PRIORITY_COMMANDS
+
+# Command mixes, as command -> weight. Priority commands ('estop') are left out:
+# they are answered ahead of queued commands, so their replies would arrive
+# out of order and the clients match replies to commands in order.
+MIXES = {
+    # The remote through the BLE bridge
+    "ride": {"accelerate": 10, "decelerate": 10, "stop": 1},
+    # The app's status screens polling a board
+    "dashboard": {"stats": 2, "stats trip": 2, "links": 2, "speed": 2, "launch": 1, "track": 1, "log": 1},
+    # Both on one connection
+    "mixed": {"accelerate": 5, "decelerate": 5, "stop": 1, "stats": 1, "links": 1, "speed": 1},
+}
+ERROR_PREFIXES = ("Error", "Unknown")
+START_TIMEOUT = 30.0        # Seconds for a server to start answering
+START_DELAY = 1.0           # Seconds between the drivers starting and the first command
+DRAIN = 5.0                 # Seconds to wait for replies after the last command
+IDLE_WINDOW = 2.0           # Seconds of idle server CPU measured before the run
+
+
+def parse_mix(text):
+    """
+    A mix from its name in MIXES or from 'command:weight,command:weight'.
+
+    Returns:
+        dict: command -> weight.
+
+    Raises:
+        ValueError: For an unknown name, a bad weight or a priority command.
+    """
+    if text in MIXES:
+        return dict(MIXES[text])
+    mix = {}
+    for part in text.split(','):
+        command, _, weight = part.rpartition(':')
+        if not command:
+            command, weight = weight, '1'
+        command = command.strip()
+        if command in PRIORITY_COMMANDS:
+            raise ValueError(f"'{command}' is answered out of order and cannot be in a mix")
+        mix[command] = float(weight)
+        if mix[command] <= 0:
+            raise ValueError(f"Weight of '{command}' must be positive")
+    if not mix:
+        raise ValueError(f"Empty mix: {text!r}")
+    return mix
+
+
+def _cpu_seconds(pid):
+    """
+    User plus system CPU time of a process, or None if /proc cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime are fields 14 and 15, counting the pid as 1
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def start_board(server_log=None):
+    """
+    Start one simulated board's control server and wait until it answers.
+
+    Args:
+        server_log (str): Log level to set on the server, e.g. 'warning'; None
+                          leaves its default, which logs every command.
+
+    Returns:
+        tuple: (subprocess.Popen, port)
+
+    Raises:
+        RuntimeError: If the server exits or does not answer within START_TIMEOUT.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "SkateBack.py", "--simulate", "--no-record",
+                               "--host", HOST, "--port", str(port)],
+                              cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.monotonic()
+    while True:
+        try:
+            sock = socket.create_connection((HOST, port), timeout=1.0)
+            break
+        except OSError:
+            if time.monotonic() - started > START_TIMEOUT or server.poll() is not None:
+                server.kill()
+                raise RuntimeError(f"Board server on port {port} did not start")
+            time.sleep(0.01)
+    with sock, sock.makefile('r', encoding='utf-8') as replies:
+        if server_log is not None:
+            sock.sendall(f"log {server_log}\n".encode('utf-8'))
+            replies.readline()
+    return server, port
+
+
+def _run_client(port, mix, rate, duration, start_at, seed, result):
+    """
+    One client: send commands drawn from mix at rate from start_at for
+    duration, and match each reply line to the oldest unanswered command.
+    Fills result with latencies, counts and errors.
+    """
+    rng = random.Random(seed)
+    commands, weights = list(mix), list(mix.values())
+    pending = collections.deque()       # (scheduled send time, command) awaiting a reply
+    latencies = result["latencies"] = []
+    result.update(sent=0, replied=0, errored=0, last_reply=None, connection_error=None, error_examples=[])
+    try:
+        sock = socket.create_connection((HOST, port), timeout=START_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        result["connection_error"] = str(e)
+        return
+    sending = threading.Event()
+    sending.set()
+
+    def read_replies():
+        sock.settimeout(None)
+        replies = sock.makefile('r', encoding='utf-8')
+        try:
+            for line in replies:
+                received = time.monotonic()
+                if not pending:
+                    continue    # Every command gets one line, so this is not ours to count
+                scheduled, command = pending.popleft()
+                latencies.append(received - scheduled)
+                result["replied"] += 1
+                result["last_reply"] = received
+                if line.startswith(ERROR_PREFIXES):
+                    result["errored"] += 1
+                    if len(result["error_examples"]) < 3 and line.strip() not in result["error_examples"]:
+                        result["error_examples"].append(line.strip())
+        except (OSError, ValueError) as e:
+            if sending.is_set() or pending:
+                result["connection_error"] = result["connection_error"] or str(e)
+
+    reader = threading.Thread(target=read_replies, name="replies", daemon=True)
+    reader.start()
+    try:
+        count = int(rate * duration)
+        for i in range(count):
+            scheduled = start_at + i / rate
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            command = rng.choices(commands, weights)[0]
+            pending.append((scheduled, command))
+            sock.sendall((command + '\n').encode('utf-8'))
+            result["sent"] += 1
+    except OSError as e:
+        result["connection_error"] = str(e)
+    sending.clear()
+    deadline = start_at + duration + DRAIN
+    while pending and reader.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+    reader.join(timeout=1.0)
+
+
+def drive_board(port, mixes, clients, rate, duration, start_at, seed=0):
+    """
+    Drive one board from concurrent clients. Runs in a process of its own.
+
+    Args:
+        port (int): The board's control socket.
+        mixes (list): Mixes (command -> weight), handed out to the clients in turn.
+        clients (int): Concurrent connections.
+        rate (float): Commands per second from each client.
+        duration (float): Seconds to send for.
+        start_at (float): time.monotonic() of the first send, shared by all boards.
+        seed (int): Seed for the command draws; each client gets its own stream.
+
+    Returns:
+        dict: Latencies in seconds (all clients together) and summed counts.
+    """
+    results = [{} for _ in range(clients)]
+    threads = [threading.Thread(target=_run_client, name=f"client {i}",
+                                args=(port, mixes[i % len(mixes)], rate, duration, start_at,
+                                      seed * 1000 + i, results[i]))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = [latency for result in results for latency in result.get("latencies", ())]
+    return {
+        "latencies": latencies,
+        "sent": sum(result.get("sent", 0) for result in results),
+        "replied": sum(result.get("replied", 0) for result in results),
+        "errored": sum(result.get("errored", 0) for result in results),
+        "connection_errors": [result["connection_error"] for result in results if result.get("connection_error")],
+        "error_examples": sorted({line for result in results for line in result.get("error_examples", ())})[:5],
+        "last_reply": max((result["last_reply"] for result in results if result.get("last_reply")), default=None),
+    }
+
+
+def _board_report(driven, cpu_used, idle_cpu_rate, elapsed, offered):
+    replied = driven["replied"]
+    report = {
+        "offered_per_s": offered,
+        "achieved_per_s": round(replied / elapsed, 1) if elapsed > 0 else 0.0,
+        "sent": driven["sent"],
+        "replied": replied,
+        "dropped": driven["sent"] - replied,
+        "errored": driven["errored"],
+        "connection_errors": len(driven["connection_errors"]),
+        "latency_ms": {key: round(value, 3) if isinstance(value, float) else value
+                       for key, value in summarize(driven["latencies"]).items()},
+        "cpu_s": None if cpu_used is None else round(cpu_used, 3),
+        "cpu_pct": None if cpu_used is None else round(100.0 * cpu_used / elapsed, 1),
+        "cpu_ms_per_reply": None,
+        "net_cpu_ms_per_reply": None,
+    }
+    if cpu_used is not None and replied:
+        report["cpu_ms_per_reply"] = round(1000.0 * cpu_used / replied, 3)
+        if idle_cpu_rate is not None:
+            # What the replies cost on top of the ticks that run anyway
+            net = max(0.0, cpu_used - idle_cpu_rate * elapsed)
+            report["net_cpu_ms_per_reply"] = round(1000.0 * net / replied, 3)
+    if driven["error_examples"]:
+        report["error_examples"] = driven["error_examples"]
+    if driven["connection_errors"]:
+        report["connection_error_examples"] = driven["connection_errors"][:3]
+    return report
+
+
+def run(boards=2, clients=4, rate=20.0, duration=10.0, mixes=("ride",), server_log=None, seed=0):
+    """
+    Start the boards, drive them all at once and report.
+
+    Args:
+        boards (int): Simulated boards, one server process each.
+        clients (int): Concurrent clients per board.
+        rate (float): Commands per second from each client.
+        duration (float): Seconds of load.
+        mixes (tuple): Mix names or inline mixes, see parse_mix(); handed out
+                       to each board's clients in turn.
+        server_log (str): Log level for the servers, None for their default.
+        seed (int): Seed for the command draws.
+
+    Returns:
+        dict: The settings, a report per board and the totals, JSON serializable.
+    """
+    parsed = [parse_mix(mix) for mix in mixes]
+    servers = []
+    try:
+        for _ in range(boards):
+            servers.append(start_board(server_log))
+
+        # What the servers use doing nothing but their ticks, to take out of the per-reply cost
+        idle_before = [_cpu_seconds(server.pid) for server, _ in servers]
+        time.sleep(IDLE_WINDOW)
+        idle_rates = [None if before is None or after is None else (after - before) / IDLE_WINDOW
+                      for before, after in zip(idle_before, (_cpu_seconds(server.pid) for server, _ in servers))]
+
+        start_at = time.monotonic() + START_DELAY
+        with concurrent.futures.ProcessPoolExecutor(max_workers=boards) as pool:
+            futures = [pool.submit(drive_board, port, parsed, clients, rate, duration, start_at, seed * 100 + i)
+                       for i, (_, port) in enumerate(servers)]
+            time.sleep(max(0.0, start_at - time.monotonic()))
+            cpu_before = [_cpu_seconds(server.pid) for server, _ in servers]
+            driven = [future.result() for future in futures]
+        cpu_after = [_cpu_seconds(server.pid) for server, _ in servers]
+        crashed = [i for i, (server, _) in enumerate(servers) if server.poll() is not None]
+    finally:
+        for server, _ in servers:
+            server.terminate()
+        for server, _ in servers:
+            try:
+                server.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    per_board = []
+    for i, result in enumerate(driven):
+        # Time from the first scheduled send to the last reply, at least the sending window
+        elapsed = max(duration, (result["last_reply"] or start_at) - start_at)
+        used = None if cpu_before[i] is None or cpu_after[i] is None else cpu_after[i] - cpu_before[i]
+        report = _board_report(result, used, idle_rates[i], elapsed, rate * clients)
+        report["crashed"] = i in crashed
+        per_board.append(report)
+
+    everything = {"latencies": [latency for result in driven for latency in result["latencies"]],
+                  "sent": sum(result["sent"] for result in driven),
+                  "replied": sum(result["replied"] for result in driven),
+                  "errored": sum(result["errored"] for result in driven),
+                  "connection_errors": [e for result in driven for e in result["connection_errors"]],
+                  "error_examples": []}
+    elapsed = max([duration] + [result["last_reply"] - start_at for result in driven if result["last_reply"]])
+    cpu_used = None if None in cpu_before or None in cpu_after else sum(cpu_after) - sum(cpu_before)
+    idle = None if None in idle_rates else sum(idle_rates)
+    total = _board_report(everything, cpu_used, idle, elapsed, rate * clients * boards)
+    total["crashed"] = len(crashed)
+    return {
+        "settings": {"boards": boards, "clients_per_board": clients, "rate_per_client": rate,
+                     "duration_s": duration, "mixes": parsed, "server_log": server_log},
+        "boards": per_board,
+        "total": total,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test simulated SkateBack control servers")
+    parser.add_argument("--boards", type=int, default=2, help="Simulated boards, one server process each")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent clients per board")
+    parser.add_argument("--rate", type=float, default=20.0, help="Commands per second from each client")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--mix", action="append",
+                        help=f"Command mix, one of {', '.join(MIXES)} or 'command:weight,...' (default: ride)")
+    parser.add_argument("--server-log", help="Log level for the servers, e.g. warning (default: theirs)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the command draws")
+    parser.add_argument("-o", "--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    mixes = args.mix or ["ride"]
+    for mix in mixes:
+        try:
+            parse_mix(mix)
+        except ValueError as e:
+            parser.error(str(e))
+    report = run(args.boards, args.clients, args.rate, args.duration, mixes, args.server_log, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,239 @@
+"""
+Non-blocking logging for the control process.
+
+Under systemd every print() is a write to journald from whichever thread
+called it, and it blocks when journald falls behind. Here a log call only
+checks the logger's level, takes a token from the call site's rate limit and
+puts a tuple on a queue.SimpleQueue (implemented in C, no Python lock). A
+daemon thread formats the records and writes them out in batches, so the
+motor and command threads never wait on the journal and never build a string
+for a line that is filtered out.
+
+Each subsystem gets a Logger:
+
+    log = logs.get('skateback')
+    log.info("New duty cycles - Left: %.3f, Right: %.3f", left, right)
+
+Arguments are %-formatted on the writer thread. A call site is identified by
+its format string and may write RATE lines per second after a burst of BURST;
+the lines in between are counted and the next line that gets through says how
+many were suppressed. Levels can be changed at runtime with set_level(), e.g.
+from the 'log' socket command.
+"""
+import atexit
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+DEFAULT_LEVEL = INFO
+RATE = 10.0             # Lines per second each call site may write...
+BURST = 20.0            # ...after a burst of this many
+MAX_QUEUED = 10000      # Records waiting for the writer before new ones are dropped
+BATCH = 256             # Records written per flush
+
+_monotonic = time.monotonic
+_epoch = time.time() - time.monotonic()     # Record times are monotonic, lines show wall time
+_queue = queue.SimpleQueue()
+_loggers = {}
+_loggers_lock = threading.Lock()
+_stream = None          # None writes to whatever sys.stdout is at the time
+dropped = 0             # Records lost because the queue was full
+
+
+class _Site:
+    __slots__ = ('tokens', 'last', 'suppressed')
+
+    def __init__(self, now):
+        self.tokens = BURST
+        self.last = now
+        self.suppressed = 0     # Lines dropped since the last one written
+
+
+class Logger:
+    def __init__(self, name, level=DEFAULT_LEVEL):
+        """
+        Logger for one subsystem. Use get() rather than creating these directly.
+
+        Args:
+            name (str): Shown on every line and used by set_level().
+            level (int): Lowest level written.
+        """
+        self.name = name
+        self.level = level
+        self.suppressed = 0     # Total lines dropped by rate limiting
+        self._sites = {}        # Format string -> _Site
+
+    def debug(self, message, *args):
+        if self.level <= DEBUG:
+            self._log(DEBUG, message, args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            self._log(INFO, message, args)
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            self._log(WARNING, message, args)
+
+    def error(self, message, *args):
+        if self.level <= ERROR:
+            self._log(ERROR, message, args)
+
+    def _log(self, level, message, args):
+        """
+        Rate limit and queue a record. Unlocked like tracing.Histogram: a racing
+        update can at worst let one line too many through.
+        """
+        global dropped
+        now = _monotonic()
+        site = self._sites.get(message)
+        if site is None:
+            site = self._sites[message] = _Site(now)
+        else:
+            tokens = site.tokens + (now - site.last) * RATE
+            site.tokens = tokens if tokens < BURST else BURST
+            site.last = now
+        if site.tokens < 1.0:
+            site.suppressed += 1
+            self.suppressed += 1
+            return
+        site.tokens -= 1.0
+        if _queue.qsize() >= MAX_QUEUED:
+            dropped += 1
+            return
+        suppressed = site.suppressed
+        site.suppressed = 0
+        _queue.put((now, self.name, level, message, args, suppressed))
+
+
+def get(name):
+    """
+    The logger for a subsystem, created at the default level on first use.
+    """
+    logger = _loggers.get(name)
+    if logger is None:
+        with _loggers_lock:
+            logger = _loggers.setdefault(name, Logger(name, DEFAULT_LEVEL))
+    return logger
+
+
+def parse_level(text):
+    """
+    Level from its name ('debug', 'INFO', ...) or number.
+
+    Raises:
+        ValueError: If the text is neither.
+    """
+    for level, name in LEVEL_NAMES.items():
+        if text.upper() == name:
+            return level
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"Unknown log level: {text}") from None
+
+
+def set_level(level, name=None):
+    """
+    Change the lowest level written, for one logger or for all of them
+    (including ones created later).
+
+    Args:
+        level (int): DEBUG, INFO, WARNING or ERROR.
+        name (str): Logger name, or None for every logger.
+
+    Raises:
+        KeyError: If there is no logger by that name.
+    """
+    global DEFAULT_LEVEL
+    if name is None:
+        DEFAULT_LEVEL = level
+        for logger in list(_loggers.values()):
+            logger.level = level
+    else:
+        _loggers[name].level = level
+
+
+def set_stream(stream):
+    """
+    Write lines to stream instead of sys.stdout. Pass None to go back to stdout.
+    """
+    global _stream
+    _stream = stream
+
+
+def stats():
+    """
+    Levels and lost lines, for the 'log' socket command.
+    """
+    return {
+        "levels": {name: LEVEL_NAMES.get(logger.level, logger.level) for name, logger in _loggers.items()},
+        "suppressed": {name: logger.suppressed for name, logger in _loggers.items() if logger.suppressed},
+        "queued": _queue.qsize(),
+        "dropped": dropped,
+    }
+
+
+def flush(timeout=1.0):
+    """
+    Wait until everything logged so far has been written.
+
+    Returns:
+        bool: False if the writer did not catch up within the timeout.
+    """
+    done = threading.Event()
+    _queue.put(done)
+    return done.wait(timeout)
+
+
+def _format(record):
+    now, name, level, message, args, suppressed = record
+    if args:
+        try:
+            message = message % args
+        except Exception:
+            message = f"{message} {args!r}"
+    stamp = _epoch + now
+    line = (f"{time.strftime('%H:%M:%S', time.localtime(stamp))}.{int(stamp % 1 * 1000):03d} "
+            f"{LEVEL_NAMES.get(level, level)} {name}: {message}")
+    if suppressed:
+        line += f" ({suppressed} similar lines suppressed)"
+    return line + "\n"
+
+
+def _write_loop():
+    while True:
+        batch = [_queue.get()]
+        try:
+            while len(batch) < BATCH:
+                batch.append(_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        stream = _stream or sys.stdout
+        flushed = []
+        for record in batch:
+            if isinstance(record, threading.Event):
+                flushed.append(record)
+                continue
+            try:
+                stream.write(_format(record))
+            except Exception:
+                pass    # Nowhere left to report it
+        try:
+            stream.flush()
+        except Exception:
+            pass
+        for done in flushed:
+            done.set()
+
+
+threading.Thread(target=_write_loop, name="log-writer", daemon=True).start()
+atexit.register(flush)
@@ -0,0 +1,337 @@
+"""
+Persistent occupancy map built from lidar depth frames.
+
+The board drives the same routes every day, so what the lidar has seen is
+kept: each depth frame, placed by the board's world pose (see world.py), adds
+evidence to a log-odds occupancy grid. A cell a ray ended in gets L_HIT, a cell
+a ray passed through gets L_MISS, and the sum is clamped so the map can still
+change its mind about a parked car. A log-odds of 0 is unknown.
+
+The grid is split into TILE x TILE cell tiles, each a NumPy .npy file in the
+map directory opened with numpy's open_memmap. A tile is only mapped when a
+frame or a query touches it, at most MAX_OPEN_TILES at a time, and a tile that
+was never observed has no file at all. Updates are written straight into the
+mappings, so the page cache holds them across a crash of the process and
+flush() (called by close()) gets them to disk, and the next run starts with
+everything seen so far.
+
+A frame is turned into a horizontal scan first, like depthimage_to_laserscan:
+every image column is one bearing, and its range is the nearest pixel that is
+an obstacle (between MIN_HEIGHT and MAX_HEIGHT above the ground). A column
+with no obstacle is free as far as the ground is seen. The rays are then
+sampled at the map resolution and added with a handful of array operations
+per frame and touched tile.
+
+    grid = occupancy.OccupancyMap()
+    grid.add_depth_frame(depth_in_meters, (x, y, heading))
+    grid.occupied(path_points)
+
+or run 'python3 occupancy.py' for a summary of the stored map.
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import numpy as np
+
+DEFAULT_DIR = os.path.expanduser('~/.skateback/map')
+RESOLUTION = 0.1        # Cell size (m)
+TILE = 256              # Cells per tile side, 25.6 m at the default resolution
+MAX_OPEN_TILES = 64     # Tiles mapped at once, 16 MB of float32
+DTYPE = np.float32
+
+L_HIT = 0.85            # Log-odds added where a ray ends on an obstacle
+L_MISS = -0.4           # Log-odds added where a ray passes through
+L_MIN = -2.0            # Clamp, so a cell that was free for weeks can still fill up...
+L_MAX = 3.5             # ...and a parked car can still drive off
+OCCUPIED = 0.85         # Log-odds above which a cell counts as occupied (p = 0.7)
+
+_OFFSET = 1 << 30       # Cell coordinates are packed into one int64 as two offset 31 bit fields
+_MASK = (1 << 31) - 1
+
+MAX_RANGE = 4.0         # Use depth up to this far (m)
+MIN_HEIGHT = 0.05       # Points lower than this above the ground are ground (m)...
+MAX_HEIGHT = 1.5        # ...and higher than this are overhead, not obstacles
+
+
+class Camera:
+    def __init__(self, fx=458.0, fy=458.0, cx=320.0, cy=240.0, height=0.15, stride=4):
+        """
+        Depth camera intrinsics and mounting. The defaults are close to the
+        L515's 640x480 depth stream, looking straight ahead; take the real
+        intrinsics from the stream profile when there is one.
+
+        Args:
+            fx (float): Focal length in pixels, horizontally...
+            fy (float): ...and vertically.
+            cx (float): Principal point column...
+            cy (float): ...and row.
+            height (float): Height of the camera above the ground (m).
+            stride (int): Use every stride-th row and column.
+        """
+        self.fx = fx
+        self.fy = fy
+        self.cx = cx
+        self.cy = cy
+        self.height = height
+        self.stride = stride
+
+    def scan(self, depth):
+        """
+        Turn a depth frame into a horizontal scan.
+
+        Args:
+            depth (numpy.ndarray [size: (H,W)]): Depth along the optical axis (m), 0 where unknown.
+
+        Returns:
+            tuple: (bearings, ranges, hits) per used column: bearing right of
+            straight ahead (radians), how far the ray is known (m), and whether
+            it ends on an obstacle.
+        """
+        depth = np.asarray(depth)[::self.stride, ::self.stride]
+        rows = np.arange(0, depth.shape[0] * self.stride, self.stride)
+        columns = np.arange(0, depth.shape[1] * self.stride, self.stride)
+        tangent = (columns - self.cx) / self.fx
+        bearings = np.arctan(tangent)
+
+        valid = (depth > 0.0) & (depth <= MAX_RANGE)
+        heights = self.height - (rows[:, None] - self.cy) * depth / self.fy
+        obstacle = valid & (heights > MIN_HEIGHT) & (heights < MAX_HEIGHT)
+        ground = valid & (heights <= MIN_HEIGHT)
+        horizontal = depth * np.sqrt(1.0 + tangent * tangent)[None, :]
+
+        nearest = np.where(obstacle, horizontal, np.inf).min(axis=0)
+        seen = np.where(ground, horizontal, 0.0).max(axis=0)
+        hits = np.isfinite(nearest)
+        ranges = np.where(hits, nearest, np.minimum(seen, MAX_RANGE))
+        return bearings, ranges, hits
+
+    def nearest(self, depth):
+        """
+        Horizontal range to the nearest obstacle in a depth frame, e.g. for
+        the flight recorder.
+
+        Args:
+            depth (numpy.ndarray [size: (H,W)]): Depth along the optical axis (m), 0 where unknown.
+
+        Returns:
+            float: Range in metres, or None if no obstacle is within MAX_RANGE.
+        """
+        _, ranges, hits = self.scan(depth)
+        return float(ranges[hits].min()) if hits.any() else None
+
+
+class OccupancyMap:
+    def __init__(self, directory=DEFAULT_DIR, resolution=RESOLUTION, tile=TILE, max_open=MAX_OPEN_TILES):
+        """
+        Open the map in a directory, creating it if needed.
+
+        Args:
+            directory (str): Where the tiles are kept.
+            resolution (float): Cell size (m).
+            tile (int): Cells per tile side.
+            max_open (int): Tiles kept mapped at once.
+
+        Raises:
+            ValueError: If the directory holds a map with a different resolution or tile size.
+        """
+        self.directory = directory
+        self.resolution = resolution
+        self.tile = tile
+        self.max_open = max_open
+        self._tiles = collections.OrderedDict()     # (tile x, tile y) -> memmap, least recently used first
+        self.frames = 0
+
+        os.makedirs(directory, exist_ok=True)
+        layout = {"resolution": resolution, "tile": tile, "dtype": np.dtype(DTYPE).name}
+        path = os.path.join(directory, 'map.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored != layout:
+                raise ValueError(f"Map in {directory} has layout {stored}, not {layout}")
+        else:
+            with open(path, 'w') as f:
+                json.dump(layout, f)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'tile_{key[0]}_{key[1]}.npy')
+
+    def _open(self, key, create):
+        """
+        The mapped tile for key, or None if it was never observed and create is False.
+        """
+        grid = self._tiles.get(key)
+        if grid is not None:
+            self._tiles.move_to_end(key)
+            return grid
+        path = self._path(key)
+        if os.path.exists(path):
+            grid = np.lib.format.open_memmap(path, mode='r+')
+        elif create:
+            grid = np.lib.format.open_memmap(path, mode='w+', dtype=DTYPE, shape=(self.tile, self.tile))
+        else:
+            return None
+        self._tiles[key] = grid
+        while len(self._tiles) > self.max_open:
+            _, evicted = self._tiles.popitem(last=False)
+            evicted.flush()
+        return grid
+
+    def _cells(self, points):
+        """
+        Cells under world points, each packed into one int64 so that sorting
+        and deduplicating them is a one-dimensional operation.
+        """
+        cells = np.floor(np.asarray(points, dtype=float).reshape(-1, 2) / self.resolution).astype(np.int64)
+        return ((cells[:, 0] + _OFFSET) << 31) | (cells[:, 1] + _OFFSET)
+
+    def _by_tile(self, cells):
+        """
+        Group packed cells by tile.
+
+        Yields:
+            tuple: (tile key, indices into cells, local rows, local columns)
+        """
+        x = (cells >> 31) - _OFFSET
+        y = (cells & _MASK) - _OFFSET
+        tx, ty = x // self.tile, y // self.tile
+        tiles = ((tx + _OFFSET) << 31) | (ty + _OFFSET)
+        order = np.argsort(tiles, kind='stable')
+        unique, starts = np.unique(tiles[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        for number, tile in enumerate(unique.tolist()):
+            indices = order[bounds[number]:bounds[number + 1]]
+            key = ((tile >> 31) - _OFFSET, (tile & _MASK) - _OFFSET)
+            yield key, indices, y[indices] - key[1] * self.tile, x[indices] - key[0] * self.tile
+
+    def update(self, free, occupied):
+        """
+        Add one observation's evidence. Each cell counts once per call, and a
+        cell that is both free and occupied counts as occupied.
+
+        Args:
+            free (numpy.ndarray [size: (N,2)]): World x, y of points rays passed through.
+            occupied (numpy.ndarray [size: (M,2)]): World x, y of points rays ended on.
+        """
+        hit_cells = np.unique(self._cells(occupied))
+        miss_cells = np.unique(self._cells(free))
+        miss_cells = miss_cells[~np.isin(miss_cells, hit_cells, assume_unique=True)]
+        cells = np.concatenate((hit_cells, miss_cells))
+        evidence = np.concatenate((np.full(len(hit_cells), L_HIT, dtype=DTYPE),
+                                   np.full(len(miss_cells), L_MISS, dtype=DTYPE)))
+        for key, indices, rows, columns in self._by_tile(cells):
+            grid = self._open(key, create=True)
+            # Cells are unique, so plain fancy indexing adds each one once
+            grid[rows, columns] = np.clip(grid[rows, columns] + evidence[indices], L_MIN, L_MAX)
+
+    def add_scan(self, bearings, ranges, hits, pose):
+        """
+        Add a horizontal scan taken from a world pose.
+
+        Args:
+            bearings (numpy.ndarray): Ray bearings right of the board's heading (radians).
+            ranges (numpy.ndarray): How far each ray is known (m).
+            hits (numpy.ndarray): Whether each ray ends on an obstacle.
+            pose (tuple): (x, y, heading): world position (m) and compass
+                          heading (degrees clockwise from north).
+        """
+        x, y, heading = pose
+        directions = math.radians(heading) + np.asarray(bearings)
+        east, north = np.sin(directions), np.cos(directions)
+        ranges = np.asarray(ranges)
+        steps = np.arange(0.0, MAX_RANGE, self.resolution * 0.5)
+        # Free up to half a cell short of a hit, so a ray never clears its own obstacle
+        short = np.where(hits, ranges - self.resolution * 0.5, ranges)
+        along = np.broadcast_to(steps, (len(ranges), len(steps)))
+        inside = along < short[:, None]
+        free = np.stack((x + (along * east[:, None])[inside], y + (along * north[:, None])[inside]), axis=1)
+        occupied = np.stack((x + ranges[hits] * east[hits], y + ranges[hits] * north[hits]), axis=1)
+        self.update(free, occupied)
+        self.frames += 1
+
+    def add_depth_frame(self, depth, pose, camera=None):
+        """
+        Add a depth frame taken from a world pose.
+
+        Args:
+            depth (numpy.ndarray [size: (H,W)]): Depth in metres, 0 where unknown.
+            pose (tuple): (x, y, heading) as for add_scan().
+            camera (Camera): Intrinsics and mounting, default Camera().
+        """
+        self.add_scan(*(camera or Camera()).scan(depth), pose)
+
+    def log_odds(self, points):
+        """
+        Log-odds of the cells under world points, 0 where never observed.
+        Never creates a tile.
+
+        Args:
+            points (numpy.ndarray [size: (N,2)]): World x, y pairs.
+
+        Returns:
+            numpy.ndarray [size: (N,)]
+        """
+        cells = self._cells(points)
+        result = np.zeros(len(cells), dtype=DTYPE)
+        for key, indices, rows, columns in self._by_tile(cells):
+            grid = self._open(key, create=False)
+            if grid is not None:
+                result[indices] = grid[rows, columns]
+        return result
+
+    def occupied(self, points, threshold=OCCUPIED):
+        """
+        Whether each world point is on a cell believed occupied.
+        """
+        return self.log_odds(points) > threshold
+
+    def stored_tiles(self):
+        """
+        Keys of every tile in the map directory.
+        """
+        keys = []
+        for name in os.listdir(self.directory):
+            if name.startswith('tile_') and name.endswith('.npy'):
+                tx, ty = name[5:-4].split('_')
+                keys.append((int(tx), int(ty)))
+        return sorted(keys)
+
+    def flush(self):
+        for grid in self._tiles.values():
+            grid.flush()
+
+    def close(self):
+        self.flush()
+        self._tiles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def summary(grid):
+    """
+    Counts of occupied, free and observed cells across every stored tile.
+    """
+    occupied = free = observed = 0
+    for key in grid.stored_tiles():
+        values = np.load(grid._path(key), mmap_mode='r')
+        occupied += int(np.count_nonzero(values > OCCUPIED))
+        free += int(np.count_nonzero(values < 0.0))
+        observed += int(np.count_nonzero(values))
+    area = grid.resolution ** 2
+    return {"tiles": len(grid.stored_tiles()), "occupied_m2": occupied * area,
+            "free_m2": free * area, "observed_m2": observed * area}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize the stored occupancy map")
+    parser.add_argument("directory", nargs="?", default=DEFAULT_DIR, help="Map directory")
+    args = parser.parse_args()
+    with open(os.path.join(args.directory, 'map.json')) as f:
+        layout = json.load(f)
+    print(json.dumps(summary(OccupancyMap(args.directory, layout["resolution"], layout["tile"])), indent=2))
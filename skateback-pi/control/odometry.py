@@ -0,0 +1,64 @@
+"""
+Wheel odometry from the VESC tachometers.
+
+Each VESC counts TACHO_PER_EREV steps per electrical revolution of its motor,
+so the tachometers give how far each wheel has rolled. The difference between
+the wheels over the track width is how far the board has turned. Tyres scrub in
+a pivot, so the effective track width is somewhat larger than the measured one;
+pass a calibrated value if turns come out short.
+"""
+import math
+
+WHEEL_DIAMETER = 0.083      # m
+TRACK_WIDTH = 0.19          # Distance between the driven wheels (m)
+POLE_PAIRS = 7
+TACHO_PER_EREV = 6          # VESC tachometer counts per electrical revolution
+
+METERS_PER_TACHO = math.pi * WHEEL_DIAMETER / (TACHO_PER_EREV * POLE_PAIRS)
+
+
+class Odometry:
+    def __init__(self, vesc_left, vesc_right, track_width=TRACK_WIDTH):
+        """
+        Args:
+            vesc_left (vesc.VescTransport): Left wheel's VESC.
+            vesc_right (vesc.VescTransport): Right wheel's VESC.
+            track_width (float): Effective distance between the wheels (m).
+        """
+        self.vesc_left = vesc_left
+        self.vesc_right = vesc_right
+        self.track_width = track_width
+
+    def wheels(self):
+        """
+        Distance each wheel has rolled forward since the VESCs powered up.
+
+        Returns:
+            tuple: (left, right) in metres, or None if either VESC did not answer.
+        """
+        left = self.vesc_left.get_values()
+        right = self.vesc_right.get_values()
+        if left is None or right is None:
+            return None
+        # The wheels turn forward for a negative duty cycle on the wire
+        return -left.tachometer * METERS_PER_TACHO, -right.tachometer * METERS_PER_TACHO
+
+    def heading(self):
+        """
+        Heading in degrees, clockwise like a compass, relative to an arbitrary
+        start. Not wrapped, so it can be compared across full turns.
+
+        Returns:
+            float: Heading, or None if either VESC did not answer.
+        """
+        return self.heading_from(self.vesc_left.get_values(), self.vesc_right.get_values())
+
+    def heading_from(self, left_values, right_values):
+        """
+        Heading as for heading(), from GetValues replies already received.
+        """
+        if left_values is None or right_values is None:
+            return None
+        left = -left_values.tachometer * METERS_PER_TACHO
+        right = -right_values.tachometer * METERS_PER_TACHO
+        return math.degrees((left - right) / self.track_width)
@@ -0,0 +1,289 @@
+"""
+Sampling profiler for the control process, started and stopped over the
+control socket ('profile start', 'profile stop').
+
+While it runs, a daemon thread wakes RATE times a second, takes every other
+thread's current frame from sys._current_frames() and counts the stack under
+the thread's name. In 'cpu' mode (the default) each stack is weighted by the
+CPU time its thread used since the previous sample, in microseconds, so a
+thread that wakes for 100 us every tick and is caught back in its sleep does
+not look as busy as one that never stops; threads whose CPU clock did not
+move are skipped. 'wall' mode counts every thread once per sample, blocked or
+not. Stacks are kept as tuples of code objects and only turned into text when
+dumped, so a sample is a frame walk and a dict increment per thread.
+
+dump() writes the totals as collapsed stacks, one line per distinct stack:
+
+    motor;_motor_tick (SkateBack.py);add (trip.py) 4200
+
+which flamegraph.pl, speedscope and inferno read directly. Per-thread CPU
+time comes from each thread's CPU clock (pthread_getcpuclockid), read at
+start, at every sample and at stop.
+
+When it is not running there is no thread, hook or check anywhere, so it
+costs nothing.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import logs
+
+log = logs.get('profiler')
+
+RATE = 100                  # Samples per second
+MAX_RATE = 1000             # Highest rate 'profile start' accepts
+MAX_DEPTH = 64              # Frames kept per stack, counting from the innermost
+DEFAULT_PATH = os.path.expanduser('~/.skateback/profile.folded')
+DUMP_DIR = os.path.dirname(DEFAULT_PATH)    # Where dumps asked for over the socket go
+MODES = ('cpu', 'wall')
+
+
+def dump_path(name):
+    """
+    Path of a dump named over the control socket. Only a plain file name is
+    accepted, and it always lands in DUMP_DIR: the socket carries whatever
+    the app sends through the BLE bridge, so it must not pick the directory.
+
+    Raises:
+        ValueError: If name has a directory part or is '.', '..' or hidden.
+    """
+    if os.path.basename(name) != name or name.startswith('.') or '\0' in name:
+        raise ValueError(f"Profile name must be a plain file name, got {name!r}")
+    return os.path.join(DUMP_DIR, name)
+
+
+def _cpu_time(ident):
+    """
+    CPU time of a thread in seconds, or None if it cannot be read
+    (the thread has exited, or the platform has no per-thread clocks).
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+def _label(code, labels):
+    """
+    'function (file.py)' for a code object, cached.
+    """
+    text = labels.get(code)
+    if text is None:
+        text = f"{code.co_name} ({os.path.basename(code.co_filename)})".replace(';', ':')
+        labels[code] = text
+    return text
+
+
+class Profiler:
+    def __init__(self):
+        """
+        A stopped profiler with no samples.
+        """
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.rate = RATE
+        self.mode = 'cpu'
+        self._reset()
+
+    def _reset(self):
+        self.counts = {}            # (thread name, stack of code objects, outermost first) -> weight
+        self.thread_samples = {}    # Thread name -> stacks counted
+        self.samples = 0            # Sampling passes
+        self.started = None         # time.monotonic() at start
+        self.duration = 0.0         # Seconds profiled in finished runs
+        self.sampling_time = 0.0    # Seconds the sampler spent sampling
+        self._cpu_start = {}        # ident -> (name, CPU time at start)
+        self._cpu_last = {}         # ident -> (name, CPU time at the latest sample)
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, rate=RATE, mode='cpu'):
+        """
+        Start sampling, discarding the previous run's samples.
+
+        Args:
+            rate (float): Samples per second, up to MAX_RATE.
+            mode (str): 'cpu' to sample threads that used CPU since the last
+                        sample, 'wall' to sample every thread.
+
+        Raises:
+            ValueError: For a rate or mode out of range.
+            RuntimeError: If the profiler is already running.
+        """
+        if not 0 < rate <= MAX_RATE:
+            raise ValueError(f"Rate must be between 0 and {MAX_RATE}")
+        if mode not in MODES:
+            raise ValueError(f"Mode must be one of {', '.join(MODES)}")
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("Profiler already running")
+            self._reset()
+            self.rate, self.mode = rate, mode
+            self._stop.clear()
+            for thread in threading.enumerate():
+                cpu = _cpu_time(thread.ident)
+                if cpu is not None:
+                    self._cpu_start[thread.ident] = (thread.name, cpu)
+            self._cpu_last = dict(self._cpu_start)
+            self.started = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+        log.info("Profiling at %s Hz (%s)", rate, mode)
+
+    def stop(self):
+        """
+        Stop sampling. The samples stay until the next start().
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stop.set()
+        thread.join()
+        with self._lock:
+            for running in threading.enumerate():
+                cpu = _cpu_time(running.ident)
+                if cpu is not None:
+                    self._cpu_last[running.ident] = (running.name, cpu)
+            self._thread = None
+            self.duration = time.monotonic() - self.started
+        log.info("Profiler stopped after %.1f s, %d samples", self.duration, self.samples)
+
+    def _run(self):
+        period = 1.0 / self.rate
+        me = threading.get_ident()
+        cpu_mode = self.mode == 'cpu'
+        counts, thread_samples = self.counts, self.thread_samples
+        last = self._cpu_last
+        deadline = time.monotonic()
+        while True:
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                # Fell behind (the sampler is starved too): skip ahead instead of bursting
+                deadline = time.monotonic()
+                delay = 0
+            if self._stop.wait(delay):
+                cpu = _cpu_time(me)
+                if cpu is not None:
+                    with self._lock:
+                        last[me] = ("profiler", cpu)
+                return
+            begin = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    name = names.get(ident) or f"thread {ident}"
+                    cpu = _cpu_time(ident)
+                    weight = 1
+                    if cpu is not None:
+                        previous = last.get(ident)
+                        last[ident] = (name, cpu)
+                        if cpu_mode:
+                            # A thread first seen now started after start(), all its time counts
+                            weight = round((cpu - (previous[1] if previous is not None else 0.0)) * 1e6)
+                            if weight <= 0:
+                                continue
+                    stack = []
+                    while frame is not None and len(stack) < MAX_DEPTH:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    stack.reverse()
+                    key = (name, tuple(stack))
+                    counts[key] = counts.get(key, 0) + weight
+                    thread_samples[name] = thread_samples.get(name, 0) + 1
+                self.samples += 1
+            del frames
+            self.sampling_time += time.perf_counter() - begin
+
+    def _elapsed(self):
+        return time.monotonic() - self.started if self.running else self.duration
+
+    def thread_times(self):
+        """
+        CPU seconds each thread used since start, and samples taken of it.
+
+        Returns:
+            dict: Thread name -> {"cpu_s", "cpu_pct", "samples"}, busiest first.
+            Threads sharing a name (e.g. one "commands" per client) are added up.
+        """
+        with self._lock:
+            start, last = dict(self._cpu_start), dict(self._cpu_last)
+            samples = dict(self.thread_samples)
+        if self.running:
+            # Not yet sampled since the last pass, or never seen by the sampler
+            for thread in threading.enumerate():
+                cpu = _cpu_time(thread.ident)
+                if cpu is not None:
+                    last[thread.ident] = (thread.name, cpu)
+        elapsed = self._elapsed()
+        threads = {}
+        for ident, (name, cpu) in last.items():
+            used = cpu - start[ident][1] if ident in start else cpu
+            entry = threads.setdefault(name, {"cpu_s": 0.0, "cpu_pct": 0.0, "samples": 0})
+            entry["cpu_s"] += used
+        for name, count in samples.items():
+            threads.setdefault(name, {"cpu_s": 0.0, "cpu_pct": 0.0, "samples": 0})["samples"] = count
+        for entry in threads.values():
+            entry["cpu_pct"] = round(100.0 * entry["cpu_s"] / elapsed, 1) if elapsed > 0 else 0.0
+            entry["cpu_s"] = round(entry["cpu_s"], 3)
+        return dict(sorted(threads.items(), key=lambda item: -item[1]["cpu_s"]))
+
+    def collapsed(self):
+        """
+        The samples as collapsed stack lines, heaviest first.
+
+        Returns:
+            list: 'thread;outer;...;inner weight' strings, the weight in CPU
+            microseconds in 'cpu' mode and in samples in 'wall' mode.
+        """
+        with self._lock:
+            counts = list(self.counts.items())
+        labels = {}
+        lines = []
+        for (name, stack), count in sorted(counts, key=lambda item: -item[1]):
+            frames = [name.replace(';', ':')] + [_label(code, labels) for code in stack]
+            lines.append(f"{';'.join(frames)} {count}")
+        return lines
+
+    def dump(self, path=DEFAULT_PATH):
+        """
+        Write the collapsed stacks to a file, and the per-thread CPU times to
+        the same path with '.json' appended.
+
+        Returns:
+            str: The path written.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        with open(path + '.json', 'w') as f:
+            json.dump(self.stats(), f, indent=1)
+        return path
+
+    def stats(self):
+        """
+        State, overhead and per-thread CPU times, JSON serializable.
+        """
+        elapsed = self._elapsed()
+        return {
+            "running": self.running,
+            "mode": self.mode,
+            "rate": self.rate,
+            "elapsed_s": round(elapsed, 2),
+            "samples": self.samples,
+            "stacks": len(self.counts),
+            "overhead_pct": round(100.0 * self.sampling_time / elapsed, 2) if elapsed > 0 else 0.0,
+            "threads": self.thread_times(),
+        }
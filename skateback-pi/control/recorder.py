@@ -0,0 +1,243 @@
+"""
+Flight recorder for the controller.
+
+Every motor tick, every command received and a few events (emergency stop,
+VESC reconnects) go into fixed-size binary records in a circular file mapped
+into memory. Writing a record is one struct.pack_into straight into the
+mapping: no syscall, no bytes object, no lock. The pages belong to the kernel's
+page cache, so whatever was written survives the process crashing or being
+killed; flush() (called by close()) also gets it to disk before a power cut.
+
+The file keeps the last CAPACITY records (about an hour of ticks) across
+restarts: a new run carries on after the highest sequence number in the file.
+read() loads it into a NumPy structured array for analysis, oldest first:
+
+    records = recorder.read('flight.rec')
+    ticks = records[records['kind'] == recorder.TICK]
+    plt.plot(ticks['t'], ticks['duty_left'])
+
+or run 'python3 recorder.py flight.rec' for a summary of the latest records.
+"""
+import argparse
+import itertools
+import mmap
+import os
+import struct
+import time
+
+DEFAULT_PATH = os.path.expanduser('~/.skateback/flight.rec')
+CAPACITY = 72000            # Records kept, one hour of motor ticks at 20 Hz
+MAGIC = b'SKBFLT\x00\x01'
+VERSION = 1
+
+# Header: magic, version, record size, capacity, padded to one cache line
+HEADER = struct.Struct('<8sHHI48x')
+# Record: sequence number (0 = empty slot), wall time, kind, flags, then
+# duty_left, duty_right, erpm_left, erpm_right, voltage, current, heading,
+# x, y, obstacle (NaN unless --gps and --lidar feed them), and a text field
+# for commands and events
+RECORD = struct.Struct('<QdBBxx10f20s')
+_SEQ = struct.Struct('<Q')
+
+# Record kinds
+TICK = 1
+COMMAND = 2
+EVENT = 3
+KINDS = {TICK: 'tick', COMMAND: 'command', EVENT: 'event'}
+
+# Tick flags
+FLAG_ESTOP = 0x01
+FLAG_LEFT_CONNECTED = 0x02
+FLAG_RIGHT_CONNECTED = 0x04
+
+NAN = float('nan')
+_NO_TEXT = b''
+
+
+class Recorder:
+    def __init__(self, path=DEFAULT_PATH, capacity=CAPACITY, clock=None):
+        """
+        Open the flight recorder file, creating it if it does not exist or
+        was written with a different layout.
+
+        Args:
+            path (str): File to record into.
+            capacity (int): Number of records kept; older ones are overwritten.
+            clock: The controller's clock. Record times are its time() shifted
+                   to wall-clock seconds, so they line up with the journal.
+        """
+        self.path = path
+        self.capacity = capacity
+        size = HEADER.size + capacity * RECORD.size
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not self._valid(fd, size):
+                self._create(fd, size)
+            self._mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)    # The mapping keeps the file open
+
+        now = clock.time() if clock is not None else time.monotonic()
+        self.epoch = time.time() - now       # Added to clock times on the hot path
+
+        # Latest pose and obstacle range from other subsystems, see set_pose()
+        self.x = NAN
+        self.y = NAN
+        self.obstacle = NAN
+
+        # next() on a count is atomic under the GIL, so writers never share a slot
+        last = max(_SEQ.unpack_from(self._mm, HEADER.size + i * RECORD.size)[0] for i in range(capacity))
+        self._seq = itertools.count(last + 1)
+        self.event(EVENT, 'start', now)
+
+    def _valid(self, fd, size):
+        if os.fstat(fd).st_size != size:
+            return False
+        header = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+        return header == (MAGIC, VERSION, RECORD.size, self.capacity)
+
+    def _create(self, fd, size):
+        """
+        Write the header and zero every record. Writing the zeros (rather than
+        truncating to a sparse file) allocates the blocks now, not on the hot path.
+        """
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity), 0)
+        chunk = bytes(RECORD.size * 1024)
+        offset = HEADER.size
+        while offset < size:
+            offset += os.pwrite(fd, chunk[:size - offset], offset)
+
+    def _offset(self):
+        seq = next(self._seq)
+        return seq, HEADER.size + (seq % self.capacity) * RECORD.size
+
+    def tick(self, t, flags, duty_left, duty_right, left, right, heading):
+        """
+        Record one motor tick. Called from the motor thread, so it only packs
+        into the mapping.
+
+        Args:
+            t (float): Clock time of the tick.
+            flags (int): FLAG_* bits.
+            duty_left (float): Left duty cycle sent, positive forward.
+            duty_right (float): Right duty cycle sent.
+            left (GetValues): Latest left VESC telemetry, or None.
+            right (GetValues): Latest right VESC telemetry, or None.
+            heading (float): Odometry heading in degrees, or None.
+        """
+        seq, offset = self._offset()
+        if left is not None and right is not None:
+            # The wheels turn forward for a negative duty cycle on the wire
+            RECORD.pack_into(self._mm, offset, seq, t + self.epoch, TICK, flags, duty_left, duty_right,
+                             -left.rpm, -right.rpm, (left.v_in + right.v_in) / 2,
+                             left.avg_input_current + right.avg_input_current,
+                             NAN if heading is None else heading,
+                             self.x, self.y, self.obstacle, _NO_TEXT)
+        else:
+            RECORD.pack_into(self._mm, offset, seq, t + self.epoch, TICK, flags, duty_left, duty_right,
+                             NAN, NAN, NAN, NAN, NAN, self.x, self.y, self.obstacle, _NO_TEXT)
+
+    def event(self, kind, text, t):
+        """
+        Record a command or event.
+
+        Args:
+            kind (int): COMMAND or EVENT.
+            text (str): The command line or event name; cut to 20 bytes.
+            t (float): Clock time it happened.
+        """
+        seq, offset = self._offset()
+        RECORD.pack_into(self._mm, offset, seq, t + self.epoch, kind, 0, NAN, NAN, NAN, NAN, NAN, NAN,
+                         NAN, self.x, self.y, self.obstacle, text.encode('utf-8', 'replace')[:20])
+
+    def set_pose(self, x, y):
+        """
+        Position in world coordinates (m), e.g. from the GPS. Included in every
+        record from now on.
+        """
+        self.x = x
+        self.y = y
+
+    def set_obstacle(self, distance):
+        """
+        Range to the nearest obstacle (m), e.g. from the lidar, or None if clear.
+        """
+        self.obstacle = NAN if distance is None else distance
+
+    def flush(self):
+        """
+        Write the mapped pages to disk. Not needed to survive a crash, only a power cut.
+        """
+        self._mm.flush()
+
+    def close(self):
+        if not self._mm.closed:
+            self._mm.flush()
+            self._mm.close()
+
+
+def dtype():
+    """
+    NumPy dtype matching RECORD.
+    """
+    import numpy as np
+    floats = ['duty_left', 'duty_right', 'erpm_left', 'erpm_right', 'voltage', 'current',
+              'heading', 'x', 'y', 'obstacle']
+    dt = np.dtype([('seq', '<u8'), ('t', '<f8'), ('kind', 'u1'), ('flags', 'u1'), ('_pad', 'V2')]
+                  + [(name, '<f4') for name in floats] + [('text', 'S20')])
+    assert dt.itemsize == RECORD.size
+    return dt
+
+
+def read(path=DEFAULT_PATH):
+    """
+    Load a flight recorder file.
+
+    Args:
+        path (str): File written by a Recorder, possibly still in use.
+
+    Returns:
+        numpy.ndarray: Structured array of the records with fields seq, t,
+        kind, flags, duty_left, duty_right, erpm_left, erpm_right, voltage,
+        current, heading, x, y, obstacle and text, oldest first. Missing values are NaN.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, record_size, capacity = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a version {VERSION} flight recorder file")
+    records = np.frombuffer(data, dtype=dtype(), count=capacity, offset=HEADER.size)
+    records = records[records['seq'] > 0]
+    return records[np.argsort(records['seq'], kind='stable')]
+
+
+def summary(records, last=20):
+    """
+    Describe a loaded recording: span, tick rate and the latest commands and events.
+    """
+    import numpy as np
+    if not len(records):
+        return "No records"
+    ticks = records[records['kind'] == TICK]
+    lines = [f"{len(records)} records over {records['t'][-1] - records['t'][0]:.1f} s, "
+             f"from {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(records['t'][0]))}"]
+    if len(ticks) > 1:
+        gaps = np.diff(ticks['t'])
+        lines.append(f"{len(ticks)} ticks, median period {np.median(gaps) * 1000:.1f} ms, "
+                     f"longest gap {gaps.max() * 1000:.1f} ms")
+    for record in records[records['kind'] != TICK][-last:]:
+        stamp = time.strftime('%H:%M:%S', time.localtime(record['t'])) + f"{record['t'] % 1:.3f}"[1:]
+        lines.append(f"{stamp} {KINDS[record['kind']]:8} {record['text'].decode('utf-8', 'replace')}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a SkateBack flight recorder file")
+    parser.add_argument("path", nargs="?", default=DEFAULT_PATH, help="Flight recorder file")
+    parser.add_argument("--last", type=int, default=20, help="Commands and events to list")
+    args = parser.parse_args()
+    print(summary(read(args.path), args.last))
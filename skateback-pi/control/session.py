@@ -0,0 +1,623 @@
+"""
+Session capture and replay, for reproducing a ride offline.
+
+Everything the control process reacts to comes from outside: commands on the
+control socket, VESC telemetry on the serial links, u-blox readings from
+/dev/gps and frames from the L515. A Capture records each of them as it
+arrives, timestamped from the start of the session, into a directory:
+
+    session.json    version, start time, depth frame shape and scale
+    events.jsonl    one JSON object per input, in arrival order:
+                    {"t": 1.25, "kind": "command", "text": "accelerate"}
+                    {"t": 1.27, "kind": "vesc", "wheel": "L", "values": {...}}
+                    {"t": 1.31, "kind": "gps", "type": "geo", "reading": {...}}
+                    {"t": 1.33, "kind": "depth", "frame": 12}
+    depth.z16       the depth frames as raw z16, one after the other
+
+Start a capture with 'python3 SkateBack.py --capture DIR' (add --gps and
+--capture-depth for those streams).
+
+replay() feeds a session back through the real code: a SkateBack whose VESCs
+are ReplayTransports, a SkateBackGPS reading a ReplayReceiver into the
+controller's track, and an OccupancyMap (in a scratch directory) fed with the
+depth frames, placed by wheel dead reckoning from where the session started.
+Commands go through the same path as the socket: priority commands run as
+soon as they arrive, 'stop' preempts the ramp in progress, and the rest run in
+order with queued speed commands coalesced. Telemetry subscriptions are not
+replayed; they only stream to the app.
+
+By default the replay runs on a clocks.SimClock as fast as the CPU allows:
+inputs are delivered from a periodic task every INPUT_PERIOD of virtual time,
+so they still land in the middle of ramps and turns, and two replays of the
+same session produce identical outputs: the frames sent to the VESCs
+(frames_digest), the replies (replies_digest), duty cycles, trip, pose,
+track and map. Replies to 'stats', 'profile', 'log' and 'links' report
+timings, so only their verb and whether they failed go into replies_digest;
+stages_us and the replay's own timings are measurements and differ every
+run. With realtime=True it runs on the wall clock with the controller's own
+threads, like the board did, and nothing is expected to repeat exactly.
+
+    python3 session.py replay DIR            # as fast as possible
+    python3 session.py replay DIR --realtime
+    python3 session.py info DIR
+"""
+import argparse
+import collections
+import hashlib
+import json
+import math
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import pyvesc
+import clocks
+import logs
+import odometry
+import tracing
+
+log = logs.get('session')
+
+VERSION = 1
+META = 'session.json'
+EVENTS = 'events.jsonl'
+DEPTH = 'depth.z16'
+FLUSH_PERIOD = 1.0          # Longest events wait in the write buffer (s)
+INPUT_PERIOD = 0.005        # Inputs are delivered this often in virtual time (s)
+STAGES = ('command', 'vesc', 'gps', 'depth', 'motor_tick', 'telemetry_tick')
+# Commands whose replies report timings, CPU time or log queue depth, which
+# differ from run to run; only whether they succeeded goes into replies_digest
+VOLATILE_COMMANDS = ('stats', 'profile', 'log', 'links')
+
+
+def _numbers(reading):
+    """
+    The numeric fields of a GetValues reply or a u-blox reading, as a dict.
+    """
+    if hasattr(reading, '_asdict'):
+        fields = reading._asdict()
+    elif hasattr(type(reading), 'fields'):
+        fields = {field[0]: getattr(reading, field[0], None) for field in type(reading).fields}
+    else:
+        fields = vars(reading)
+    return {name: value for name, value in fields.items() if isinstance(value, (int, float))}
+
+
+class Capture:
+    def __init__(self, directory):
+        """
+        Start recording a session into a directory, replacing any session in it.
+
+        Every method can be called from any thread.
+
+        Args:
+            directory (str): Session directory, created if needed.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._meta = {"version": VERSION, "started": time.time(), "depth": None}
+        self._events = open(os.path.join(directory, EVENTS), 'w', buffering=1 << 16)
+        self._depth = None
+        depth_path = os.path.join(directory, DEPTH)
+        if os.path.exists(depth_path):
+            os.remove(depth_path)
+        self._start = time.monotonic()
+        self._flushed = self._start
+        self._write_meta()
+
+    def _write_meta(self):
+        self._meta["events"] = dict(self.counts)
+        self._meta["duration"] = round(time.monotonic() - self._start, 6)
+        with open(os.path.join(self.directory, META), 'w') as f:
+            json.dump(self._meta, f, indent=1)
+
+    def _write(self, event):
+        """
+        Timestamp an event and append it. Called with self._lock held;
+        dropped once the capture is closed.
+        """
+        if self._events.closed:
+            return
+        now = time.monotonic()
+        event["t"] = round(now - self._start, 6)
+        self._events.write(json.dumps(event) + "\n")
+        self.counts[event["kind"]] += 1
+        if now - self._flushed >= FLUSH_PERIOD:
+            self._events.flush()
+            self._flushed = now
+
+    def command(self, text):
+        """
+        A command line as it came off the control socket.
+        """
+        with self._lock:
+            self._write({"kind": "command", "text": text})
+
+    def vesc(self, wheel, values):
+        """
+        A GetValues reply from one wheel's VESC.
+
+        Args:
+            wheel (str): "L" or "R".
+            values (GetValues): The decoded reply.
+        """
+        with self._lock:
+            self._write({"kind": "vesc", "wheel": wheel, "values": _numbers(values)})
+
+    def gps(self, kind, reading, error=None):
+        """
+        A u-blox reading, or the error reading it raised.
+
+        Args:
+            kind (str): 'geo' for geo_coords() or 'attitude' for veh_attitude().
+            reading: The reading, None if there was none.
+            error (Exception): What the read raised instead.
+        """
+        event = {"kind": "gps", "type": kind, "reading": None if reading is None else _numbers(reading)}
+        if error is not None:
+            event["error"] = str(error)
+        with self._lock:
+            self._write(event)
+
+    def depth(self, frame, scale):
+        """
+        A raw depth frame.
+
+        Args:
+            frame (numpy.ndarray [size: (H,W)]): z16 depth units, 0 where unknown.
+            scale (float): Metres per depth unit.
+        """
+        import numpy as np
+        frame = np.ascontiguousarray(frame, dtype=np.uint16)
+        with self._lock:
+            if self._events.closed:
+                return
+            if self._depth is None:
+                self._meta["depth"] = {"shape": list(frame.shape), "scale": scale}
+                self._depth = open(os.path.join(self.directory, DEPTH), 'wb')
+            elif list(frame.shape) != self._meta["depth"]["shape"]:
+                raise ValueError(f"Depth frame shape {frame.shape} does not match the session's")
+            self._depth.write(frame.tobytes())
+            self._write({"kind": "depth", "frame": self.counts["depth"]})
+
+    def close(self):
+        with self._lock:
+            self._events.close()
+            if self._depth is not None:
+                self._depth.close()
+            self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CapturingReceiver:
+    def __init__(self, receiver, capture):
+        """
+        Wrap a UbloxGps so every reading it returns is also captured.
+        """
+        self.receiver = receiver
+        self.capture = capture
+
+    def _read(self, kind, read):
+        try:
+            reading = read()
+        except Exception as e:
+            self.capture.gps(kind, None, e)
+            raise
+        self.capture.gps(kind, reading)
+        return reading
+
+    def geo_coords(self):
+        return self._read('geo', self.receiver.geo_coords)
+
+    def veh_attitude(self):
+        return self._read('attitude', self.receiver.veh_attitude)
+
+
+def capture_depth(capture, stop, width=640, height=480, fps=30, on_frame=None):
+    """
+    Capture the L515's depth stream until stop is set. Run it on its own thread.
+
+    Args:
+        capture (Capture): Session to add the frames to, or None to only call on_frame.
+        stop (threading.Event): Set to end the capture.
+        on_frame (function): Also called with each frame in metres.
+    """
+    import numpy as np
+    import pyrealsense2 as rs      # Only on the board, and only needed here
+    pipeline = rs.pipeline()
+    config = rs.config()
+    config.enable_stream(rs.stream.depth, width, height, rs.format.z16, fps)
+    profile = pipeline.start(config)
+    try:
+        scale = profile.get_device().first_depth_sensor().get_depth_scale()
+        while not stop.is_set():
+            depth = pipeline.wait_for_frames().get_depth_frame()
+            if depth:
+                frame = np.asanyarray(depth.get_data())
+                if capture is not None:
+                    capture.depth(frame, scale)
+                if on_frame is not None:
+                    on_frame(frame * scale)
+    finally:
+        pipeline.stop()
+
+
+class Session:
+    def __init__(self, directory):
+        """
+        A captured session, loaded for replay.
+
+        Args:
+            directory (str): Directory written by a Capture.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, META)) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != VERSION:
+            raise ValueError(f"Unsupported session version {self.meta.get('version')}")
+        self.events = []
+        with open(os.path.join(directory, EVENTS)) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    self.events.append(json.loads(line))
+        self._frames = None
+
+    @property
+    def duration(self):
+        return self.events[-1]["t"] if self.events else 0.0
+
+    def counts(self):
+        return dict(collections.Counter(event["kind"] for event in self.events))
+
+    def depth_frame(self, index):
+        """
+        A depth frame in metres, as distance_check.py computes depth_in_meters.
+        """
+        import numpy as np
+        depth = self.meta["depth"]
+        if self._frames is None:
+            self._frames = np.memmap(os.path.join(self.directory, DEPTH), dtype=np.uint16, mode='r')
+            self._frames = self._frames.reshape(-1, *depth["shape"])
+        return self._frames[index].astype(np.float32) * np.float32(depth["scale"])
+
+
+class ReplayTransport:
+    def __init__(self, name):
+        """
+        Stands in for a vesc.VescTransport: replies come from the session, and
+        the frames the controller sends are counted and hashed instead of written.
+
+        Args:
+            name (str): Wheel, for logs and link stats.
+        """
+        self.port = f"replay {name}"
+        self.connected = True
+        self.disconnects = 0
+        self.values = None
+        self.values_time = None
+        self.values_count = 0
+        self.frames = 0
+        self.requests = 0
+        self.last = None                # Last setter message sent
+        self._digest = hashlib.sha1()
+        self._listeners = []
+
+    def receive(self, values, t):
+        """
+        Deliver a reply from the session, as the reader thread would.
+        """
+        self.values = values
+        self.values_time = t
+        self.values_count += 1
+
+    def send(self, message):
+        frame = pyvesc.encode(message)
+        self._digest.update(frame)
+        self.frames += 1
+        self.last = message
+
+    def request_values(self):
+        self.requests += 1
+
+    def get_values(self):
+        return self.values
+
+    def start_reader(self):
+        pass
+
+    def add_reconnect_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_reconnect_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def add_values_listener(self, listener):
+        pass
+
+    def remove_values_listener(self, listener):
+        pass
+
+    def link_stats(self):
+        return {"connected": True, "disconnects": 0, "last_reconnect_ms": None,
+                "mean_reconnect_ms": None, "max_reconnect_ms": None}
+
+    def digest(self):
+        return self._digest.hexdigest()
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayReceiver:
+    def __init__(self):
+        """
+        Stands in for a UbloxGps, answering with the session's readings in order.
+        """
+        self._pending = {'geo': collections.deque(), 'attitude': collections.deque()}
+
+    def push(self, event):
+        self._pending[event["type"]].append(event)
+
+    def _next(self, kind):
+        pending = self._pending[kind]
+        if not pending:
+            return None
+        event = pending.popleft()
+        if "error" in event:
+            raise IOError(event["error"])
+        reading = event["reading"]
+        return None if reading is None else types.SimpleNamespace(**reading)
+
+    def geo_coords(self):
+        return self._next('geo')
+
+    def veh_attitude(self):
+        return self._next('attitude')
+
+
+class _Replies:
+    def __init__(self):
+        """
+        Stands in for a socket Connection, hashing the responses. A reply to
+        one of VOLATILE_COMMANDS is hashed as the command's verb and whether
+        it failed, not its text.
+        """
+        self.count = 0
+        self._digest = hashlib.sha1()
+        self._lock = threading.Lock()
+
+    def send(self, message, command=None):
+        with self._lock:
+            self.count += 1
+            if command is not None and command.split()[0] in VOLATILE_COMMANDS:
+                failed = message.startswith('Error')
+                message = f"{command.split()[0]} {'error' if failed else 'ok'}\n"
+            self._digest.update(message.encode('utf-8'))
+
+    def to(self, command):
+        """
+        A connection for the reply to one command.
+        """
+        return types.SimpleNamespace(send=lambda message: self.send(message, command))
+
+    def digest(self):
+        return self._digest.hexdigest()
+
+
+class _DeadReckoning:
+    def __init__(self, track_width=odometry.TRACK_WIDTH):
+        """
+        Board pose from the wheel tachometers: x east and y north of where the
+        session started (m) and compass heading (degrees), as OccupancyMap wants.
+        """
+        self.track_width = track_width
+        self.pose = (0.0, 0.0, 0.0)
+        self._last = None
+
+    def update(self, left, right):
+        if left is None or right is None:
+            return
+        wheels = (-left.tachometer * odometry.METERS_PER_TACHO, -right.tachometer * odometry.METERS_PER_TACHO)
+        if self._last is None:
+            self._last = wheels
+            self._origin = (wheels[0] - wheels[1]) / self.track_width
+            return
+        x, y, heading = self.pose
+        distance = ((wheels[0] - self._last[0]) + (wheels[1] - self._last[1])) / 2
+        turned = math.degrees((wheels[0] - wheels[1]) / self.track_width - self._origin)
+        middle = math.radians((heading + turned) / 2)
+        self.pose = (x + distance * math.sin(middle), y + distance * math.cos(middle), turned)
+        self._last = wheels
+
+
+def _timed(callback, histogram):
+    def timed():
+        started = time.perf_counter_ns()
+        try:
+            return callback()
+        finally:
+            histogram.record(time.perf_counter_ns() - started)
+    return timed
+
+
+def _run_queued(skateback, connection, commands):
+    """
+    Run the queued commands the way SkateBack._command_worker does: a speed
+    command takes the speed commands queued straight behind it, anything
+    else runs on its own.
+    """
+    import SkateBack
+    while commands:
+        command, recv_ns = commands.popleft()
+        if command not in SkateBack.SPEED_COMMANDS:
+            SkateBack._run_command(skateback, connection.to(command), command, recv_ns)
+            continue
+        batch = [(command, recv_ns)]
+        while commands and commands[0][0] in SkateBack.SPEED_COMMANDS:
+            batch.append(commands.popleft())
+        SkateBack._run_speed_commands(skateback, connection, batch)
+
+
+def replay(session, realtime=False, map_directory=None):
+    """
+    Feed a session through SkateBack, SkateBackGPS and the occupancy map.
+
+    Args:
+        session (Session): What to replay.
+        realtime (bool): Run on the wall clock at the session's pace instead
+                         of on a virtual clock as fast as possible.
+        map_directory (str): Where the occupancy map goes; a scratch directory
+                             that is removed afterwards by default.
+
+    Returns:
+        dict: The session's size, how long the replay took, the final outputs
+        and the time spent in each stage (microseconds).
+    """
+    import SkateBack
+    import SkateBackGPS
+
+    clock = clocks.RealClock() if realtime else clocks.SimClock()
+    stages = {stage: tracing.Histogram() for stage in STAGES}
+    left, right = ReplayTransport("L"), ReplayTransport("R")
+    wheels = {"L": left, "R": right}
+    replies = _Replies()
+    receiver = ReplayReceiver()
+    pose = _DeadReckoning()
+    scratch = None
+    grid = None
+    if session.meta.get("depth"):
+        import occupancy
+        if map_directory is None:
+            scratch = map_directory = tempfile.mkdtemp(prefix='skateback-replay-')
+        grid = occupancy.OccupancyMap(map_directory)
+
+    started = time.perf_counter()
+    skateback = SkateBack.SkateBack(clock=clock, transports=(left, right))
+    gps = SkateBackGPS.SkateBackGPS(receiver=receiver)
+    for stage, task in (('motor_tick', skateback.motor_task), ('telemetry_tick', skateback.telemetry_task)):
+        task.callback = _timed(task.callback, stages[stage])
+
+    def deliver(event, enqueue):
+        kind = event["kind"]
+        begin = time.perf_counter_ns()
+        if kind == "command":
+            command = event["text"]
+            # As _serve_connection does on the socket's reader thread
+            if command.split()[0] in ('subscribe', 'unsubscribe'):
+                return
+            if command in SkateBack.PRIORITY_COMMANDS:
+                SkateBack._run_command(skateback, replies.to(command), command, begin)
+            else:
+                if command == 'stop':
+                    skateback.preempt()
+                enqueue((command, begin))
+        elif kind == "vesc":
+            wheels[event["wheel"]].receive(types.SimpleNamespace(**event["values"]), clock.time())
+            pose.update(left.values, right.values)
+        elif kind == "gps":
+            receiver.push(event)
+            if event["type"] == "geo":
+                gps.track_fix(skateback.track, clock.time())
+            else:
+                gps.read_heading_fix()
+        elif kind == "depth" and grid is not None:
+            grid.add_depth_frame(session.depth_frame(event["frame"]), pose.pose)
+        stages[kind].record(time.perf_counter_ns() - begin)
+
+    events = collections.deque(session.events)
+    try:
+        if realtime:
+            commands = queue.Queue()
+            worker = threading.Thread(target=SkateBack._command_worker, args=(skateback, replies, commands),
+                                      name="commands", daemon=True)
+            worker.start()
+            origin = time.monotonic()
+            for event in events:
+                delay = origin + event["t"] - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                deliver(event, commands.put)
+            commands.put(None)
+            worker.join()
+        else:
+            commands = collections.deque()
+
+            def inputs():
+                while events and events[0]["t"] <= clock.time():
+                    deliver(events.popleft(), commands.append)
+
+            task = clock.call_every(INPUT_PERIOD, inputs, name="replay")
+            while events or commands:
+                if commands:
+                    _run_queued(skateback, replies, commands)
+                else:
+                    clock.advance(max(INPUT_PERIOD, events[0]["t"] - clock.time()))
+            task.cancel()
+        elapsed = time.perf_counter() - started
+        log.info("Replayed %.1f s of session in %.1f s", session.duration, elapsed)
+
+        outputs = {
+            "duty": [skateback.left_duty_cycle, skateback.right_duty_cycle],
+            "frames": {"L": left.frames, "R": right.frames},
+            "frames_digest": hashlib.sha1((left.digest() + right.digest()).encode()).hexdigest(),
+            "replies": replies.count,
+            "replies_digest": replies.digest(),
+            "estop": skateback.estop.is_set(),
+            "trip": skateback.trip.stats(),
+            "pose": [round(value, 3) for value in pose.pose],
+            "track": {"points": skateback.track.next_seq, "fixes": skateback.track.fixes,
+                      "position": skateback.track.position()},
+        }
+        if grid is not None:
+            grid.flush()
+            outputs["map"] = occupancy.summary(grid)
+    finally:
+        skateback.close()
+        if grid is not None:
+            grid.close()
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        "mode": "realtime" if realtime else "max_speed",
+        "session_s": session.duration,
+        "events": session.counts(),
+        "replay_s": elapsed,
+        "speedup": session.duration / elapsed if elapsed else None,
+        "outputs": outputs,
+        "stages_us": {stage: dict(histogram.summary(), total_ms=histogram.total / 1e6)
+                      for stage, histogram in stages.items() if histogram.count},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay or summarize a captured session")
+    parser.add_argument("action", choices=("replay", "info"))
+    parser.add_argument("directory", help="Session directory")
+    parser.add_argument("--realtime", action="store_true", help="Replay at the session's own pace")
+    parser.add_argument("--map", help="Keep the replayed occupancy map in this directory")
+    args = parser.parse_args()
+
+    logs.set_stream(sys.stderr)     # The replayed controller's logs, so the report stays alone on stdout
+    loaded = Session(args.directory)
+    if args.action == 'info':
+        print(json.dumps({"meta": loaded.meta, "duration_s": loaded.duration, "events": loaded.counts()}, indent=2))
+    else:
+        print(json.dumps(replay(loaded, args.realtime, args.map), indent=2))
+    logs.flush()
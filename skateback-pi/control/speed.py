@@ -0,0 +1,145 @@
+"""
+Closed-loop wheel speed control on VESC ERPM feedback.
+
+In duty cycle mode the same command gives a different speed depending on
+battery voltage, slope and load, and the two wheels drift apart (see
+motors/readme.md). In speed mode the motor tick instead runs a controller per
+wheel that turns a target speed into a duty cycle:
+
+    duty = feed-forward + KP * error + integral
+
+The feed-forward is the duty cycle that would give the target speed with no
+load, so the PI terms only correct what the model misses. The integral stops
+accumulating while the output is held by the duty cycle limit or the rate
+limit (anti-windup), and the output moves by at most MAX_DUTY_STEP per tick so
+a new target never jerks the rider. The sync term raises the target of the
+wheel that is further behind and lowers the other's, in proportion to how far
+behind it is and how far the board has turned off course, so straight-line
+driving stays straight even when one wheel carries more load.
+
+Errors are scaled by ERPM_PER_DUTY, so the gains are in duty cycle per
+unit of duty-equivalent speed error and do not depend on the motor.
+"""
+import odometry
+
+ERPM_PER_MPS = 60.0 / (odometry.METERS_PER_TACHO * odometry.TACHO_PER_EREV)   # ERPM per m/s of wheel speed
+ERPM_PER_DUTY = 20000.0     # No-load ERPM at 100% duty, the feed-forward model
+KP = 3.0                    # Duty per unit of scaled speed error
+KI = 8.0                    # Duty per unit of scaled speed error per second
+KS = 0.5                    # Target ERPM shift per ERPM of left/right tracking error difference...
+KSI = 2.0                   # ...and per ERPM second of its integral (1/s), which is the heading error
+MAX_DUTY_STEP = 0.02        # Largest change in duty cycle per tick
+STALE_TICKS = 3             # Ignore an ERPM reading that has not been updated for this many ticks
+
+
+class WheelSpeed:
+    def __init__(self, max_duty, kp=KP, ki=KI, max_step=MAX_DUTY_STEP):
+        """
+        Speed controller for one wheel. The caller provides the measured speed
+        each tick; see DriveSpeed for the pair with the sync term.
+
+        Args:
+            max_duty (float): Largest duty cycle magnitude it may output.
+            kp (float): Proportional gain.
+            ki (float): Integral gain (1/s).
+            max_step (float): Largest change in duty cycle per update.
+        """
+        self.max_duty = max_duty
+        self.kp = kp
+        self.ki = ki
+        self.max_step = max_step
+        self.integral = 0.0
+        self.duty = 0.0
+        self.stale = 0          # Updates since the ERPM last changed
+
+    def reset(self, duty=0.0):
+        """
+        Start from the given duty cycle with an empty integral, e.g. when
+        switching from duty cycle mode without a jump.
+        """
+        self.integral = 0.0
+        self.duty = duty
+        self.stale = 0
+
+    def update(self, target, erpm, dt, fresh=True):
+        """
+        One control step.
+
+        Args:
+            target (float): Target ERPM, positive forward.
+            erpm (float): Measured ERPM, positive forward, or None if unknown.
+            dt (float): Seconds since the last update.
+            fresh (bool): False if erpm is the same reading as last time. After
+                          STALE_TICKS of those it is ignored, and the output
+                          rests on the feed-forward and the integral.
+
+        Returns:
+            float: Duty cycle to send, positive forward.
+        """
+        self.stale = 0 if fresh else self.stale + 1
+        if self.stale >= STALE_TICKS:
+            erpm = None
+        feed_forward = target / ERPM_PER_DUTY
+        error = 0.0 if erpm is None else (target - erpm) / ERPM_PER_DUTY
+        wanted = feed_forward + self.kp * error + self.integral
+
+        duty = max(-self.max_duty, min(self.max_duty, wanted))
+        duty = max(self.duty - self.max_step, min(self.duty + self.max_step, duty))
+
+        # Conditional integration: only while the output follows the controller,
+        # or while the error would pull it back off a limit
+        held = duty != wanted
+        if erpm is not None and fresh and (not held or (error > 0) != (wanted > duty)):
+            self.integral += self.ki * error * dt
+            self.integral = max(-self.max_duty, min(self.max_duty, self.integral))
+        self.duty = duty
+        return duty
+
+
+class DriveSpeed:
+    def __init__(self, max_duty, ks=KS, ksi=KSI, **gains):
+        """
+        Speed controllers for both wheels, coupled by a sync term.
+
+        Args:
+            max_duty (float): Largest duty cycle magnitude for either wheel.
+            ks (float): Sync gain on the left/right tracking error difference.
+            ksi (float): Sync gain on its integral (1/s).
+            **gains: kp, ki and max_step for both WheelSpeed controllers.
+        """
+        self.left = WheelSpeed(max_duty, **gains)
+        self.right = WheelSpeed(max_duty, **gains)
+        self.ks = ks
+        self.ksi = ksi
+        self.sync_integral = 0.0    # Tracking error difference in ERPM seconds
+
+    def reset(self, left_duty=0.0, right_duty=0.0):
+        self.left.reset(left_duty)
+        self.right.reset(right_duty)
+        self.sync_integral = 0.0
+
+    def update(self, targets, erpms, dt, fresh=(True, True)):
+        """
+        One control step for both wheels.
+
+        Args:
+            targets (tuple): (left, right) target ERPM, positive forward.
+            erpms (tuple): (left, right) measured ERPM, positive forward; None if unknown.
+            dt (float): Seconds since the last update.
+            fresh (tuple): (left, right) False where the reading has not changed.
+
+        Returns:
+            tuple: (left, right) duty cycles, positive forward.
+        """
+        (target_left, target_right), (erpm_left, erpm_right) = targets, erpms
+        sync = 0.0
+        if erpm_left is not None and erpm_right is not None:
+            # Positive when the left wheel is further behind its target than the right.
+            # Its integral is how far the board has turned off the commanded path.
+            difference = (target_left - erpm_left) - (target_right - erpm_right)
+            self.sync_integral += difference * dt
+            sync = (self.ks * difference + self.ksi * self.sync_integral) / 2
+        # Speed up the wheel that is behind and slow down the other, through
+        # their own controllers so the correction is not integrated away
+        return (self.left.update(target_left + sync, erpm_left, dt, fresh[0]),
+                self.right.update(target_right - sync, erpm_right, dt, fresh[1]))
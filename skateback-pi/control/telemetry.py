@@ -0,0 +1,257 @@
+"""
+Telemetry stream for control socket clients.
+
+A client sends 'subscribe <fields> [rate]' and from then on gets lines of
+
+    telemetry {"t": 12.35, "speed": 1.2, "voltage": 39.8}
+
+at up to the requested rate. Once per motor tick the controller samples every
+field, and each distinct field selection that is due is serialized once and
+shared by every subscriber that asked for it.
+
+Each subscriber has a one-line mailbox and its own sender thread. A new line
+replaces one that has not been sent yet, so a slow BLE link only ever sees
+the latest state: the controller never waits for it and nothing queues up.
+"""
+import json
+import threading
+import logs
+import odometry
+
+log = logs.get('telemetry')
+
+SPEED_PER_ERPM = odometry.METERS_PER_TACHO * odometry.TACHO_PER_EREV / 60.0   # m/s per ERPM
+MAX_RATE = 20.0             # Hz, one line per motor tick
+DEFAULT_RATE = 5.0          # Hz
+
+
+def _forward(values, field):
+    # The wheels turn forward for a negative duty cycle on the wire
+    return None if values is None else -getattr(values, field)
+
+
+def _mean(left, right):
+    if left is None or right is None:
+        return None
+    return (left + right) / 2
+
+
+class Snapshot:
+    __slots__ = ('skateback', 'left', 'right')
+
+    def __init__(self, skateback, left, right):
+        """
+        Everything the field functions read for one tick.
+
+        Args:
+            skateback (SkateBack.SkateBack): The controller.
+            left (GetValues): Latest left VESC telemetry, or None.
+            right (GetValues): Latest right VESC telemetry, or None.
+        """
+        self.skateback = skateback
+        self.left = left
+        self.right = right
+
+
+# Field name -> function of a Snapshot. Values must be JSON serializable.
+FIELDS = {
+    "duty_left": lambda s: s.skateback.left_duty_cycle,
+    "duty_right": lambda s: s.skateback.right_duty_cycle,
+    "erpm_left": lambda s: _forward(s.left, 'rpm'),
+    "erpm_right": lambda s: _forward(s.right, 'rpm'),
+    "speed": lambda s: _mean(_forward(s.left, 'rpm'), _forward(s.right, 'rpm')) * SPEED_PER_ERPM
+                       if s.left is not None and s.right is not None else None,
+    "voltage": lambda s: _mean(s.left and s.left.v_in, s.right and s.right.v_in),
+    "current": lambda s: (s.left.avg_input_current + s.right.avg_input_current)
+                         if s.left is not None and s.right is not None else None,
+    "heading": lambda s: s.skateback.odometry.heading_from(s.left, s.right),
+    "estop": lambda s: s.skateback.estop.is_set(),
+    "position": lambda s: s.skateback.track.position(),
+}
+
+
+class Subscriber:
+    def __init__(self, send, fields, rate):
+        """
+        One client's subscription.
+
+        Args:
+            send (function): Writes a line to the client; may block.
+            fields (tuple): Field names, in the order they are sent.
+            rate (float): Lines per second.
+        """
+        self.send = send
+        self.fields = fields
+        self.period = 1.0 / rate
+        self.next_due = 0.0
+        self.sent = 0
+        self.replaced = 0       # Lines overwritten before the link took them
+        self.closed = False
+        self._line = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="telemetry-send", daemon=True)
+        self._thread.start()
+
+    def offer(self, line):
+        """
+        Put a line in the mailbox, replacing any line not yet sent. Never blocks
+        on the client.
+        """
+        with self._cond:
+            if self._line is not None:
+                self.replaced += 1
+            self._line = line
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._line is not None or self.closed)
+                if self.closed:
+                    return
+                line, self._line = self._line, None
+            try:
+                self.send(line)
+                self.sent += 1
+            except OSError:
+                self.close()
+
+
+class Telemetry:
+    def __init__(self, skateback, tick_period):
+        """
+        Telemetry publisher for a controller. publish() is called once per tick.
+
+        Args:
+            skateback (SkateBack.SkateBack): The controller to report on.
+            tick_period (float): Seconds between publish() calls.
+        """
+        self.skateback = skateback
+        self.tick_period = tick_period
+        self.fields = dict(FIELDS)
+        self.subscribers = []
+        self._lock = threading.Lock()
+        self._polling = False
+        self.always_poll = False    # Request values every tick even with no subscribers
+
+    def add_field(self, name, function):
+        """
+        Make another value available to subscribers, e.g. a GPS position.
+
+        Args:
+            name (str): Field name used in 'subscribe'.
+            function (function): Called with a Snapshot once per tick.
+        """
+        self.fields[name] = function
+
+    def subscribe(self, send, fields=None, rate=DEFAULT_RATE):
+        """
+        Start streaming to a client.
+
+        Args:
+            send (function): Writes a line to the client.
+            fields (iterable): Field names, or None for all of them.
+            rate (float): Lines per second, at most MAX_RATE.
+
+        Returns:
+            Subscriber: Pass to unsubscribe() to stop the stream.
+        """
+        fields = tuple(fields) if fields else tuple(self.fields)
+        unknown = [field for field in fields if field not in self.fields]
+        if unknown:
+            raise ValueError(f"Unknown telemetry fields: {', '.join(unknown)}")
+        if not 0 < rate <= MAX_RATE:
+            raise ValueError(f"Rate must be between 0 and {MAX_RATE} Hz")
+
+        subscriber = Subscriber(send, fields, rate)
+        with self._lock:
+            self.subscribers.append(subscriber)
+        self.start_polling()
+        return subscriber
+
+    def start_polling(self, always=False):
+        """
+        Start reading VESC replies in the background. Called on the first
+        subscription, or up front by something that wants fresh values every
+        tick regardless of subscribers, like the flight recorder.
+
+        Args:
+            always (bool): Keep requesting values with no subscribers.
+        """
+        if always:
+            self.always_poll = True
+        if not self._polling:
+            self._polling = True
+            self.skateback.vesc_left.start_reader()
+            self.skateback.vesc_right.start_reader()
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self):
+        """
+        Sample every field once, serialize each field selection that is due
+        once, and offer the lines to their subscribers. Runs on the telemetry tick.
+        """
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if not s.closed]
+            subscribers = list(self.subscribers)
+        if not subscribers and not self.always_poll:
+            return
+
+        if subscribers:
+            try:
+                self.offer_due(subscribers, self.skateback.clock.time())
+            except Exception as e:
+                log.error("Error publishing telemetry: %s", e)
+
+        # Ask for the next tick's values now; the replies arrive in the background.
+        # A VESC that is being reopened is skipped rather than reported every tick.
+        for transport in (self.skateback.vesc_left, self.skateback.vesc_right):
+            if not transport.connected:
+                continue
+            try:
+                transport.request_values()
+            except Exception as e:
+                log.error("Error requesting telemetry: %s", e)
+
+    def offer_due(self, subscribers, now):
+        """
+        Serialize and offer a line to each subscriber that is due at time now.
+        """
+        skateback = self.skateback
+        # Half a tick early counts as due, so a 5 Hz stream goes out every fourth tick
+        due = [s for s in subscribers if now >= s.next_due - self.tick_period / 2]
+        if due:
+            snapshot = Snapshot(skateback, skateback.vesc_left.values, skateback.vesc_right.values)
+            values = {"t": round(now, 3)}
+            lines = {}
+            for subscriber in due:
+                line = lines.get(subscriber.fields)
+                if line is None:
+                    for field in subscriber.fields:
+                        if field not in values:
+                            values[field] = self._sample(field, snapshot)
+                    selected = {"t": values["t"]}
+                    selected.update((field, values[field]) for field in subscriber.fields)
+                    line = lines[subscriber.fields] = "telemetry " + json.dumps(selected) + "\n"
+                subscriber.offer(line)
+                # Stay on the subscriber's own grid unless it has fallen behind
+                subscriber.next_due += subscriber.period
+                if subscriber.next_due < now:
+                    subscriber.next_due = now + subscriber.period
+
+    def _sample(self, field, snapshot):
+        try:
+            value = self.fields[field](snapshot)
+        except Exception:
+            return None
+        return round(value, 4) if isinstance(value, float) else value
@@ -37,17 +37,8 @@ def static_test():
             duty_cycle_L = -0.1  # Set desired duty cycle between -1.0 and 1.0
             duty_cycle_R = 0.1  # Set desired duty cycle between -1.0 and 1.0
 
-            # Create threads for left and right wheels
-            left_thread = threading.Thread(target=sk.accelerate_to, args=("L", duty_cycle_L))
-            right_thread = threading.Thread(target=sk.accelerate_to, args=("R", duty_cycle_R))
-
-            # Start both threads
-            left_thread.start()
-            right_thread.start()
-
-            # Wait for both threads to complete
-            left_thread.join()
-            right_thread.join()
+            # Ramp both wheels together
+            sk.ramp_wheels(duty_cycle_L, duty_cycle_R)
 
             print("Both wheels have completed rotation.")
 
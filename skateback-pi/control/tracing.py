@@ -0,0 +1,220 @@
+"""
+Per-command latency tracing for the control process.
+
+A command is timestamped when its bytes come off the control socket and again
+at each stage on its way to the VESC:
+
+    recv -> parse -> setpoint -> frame
+
+The time spent in each stage (and recv to frame in total) goes into a
+log-linear histogram in the style of HdrHistogram: 32 sub-buckets per power of
+two, so any recorded value is within ~3% of its bucket.
+
+On the command and motor threads a span is only a list of raw timestamps and
+costs three clock reads and four calls in all: begin() as the command starts
+running, setpoint() once per setpoint change of both wheels, frame() once per
+motor tick and end(). A finished span is appended to a deque, and flush()
+turns the queued spans into histogram counts off those threads; SkateBack
+calls it every FLUSH_PERIOD, and stats() calls it before reading. See
+'benchmark.py --only tracing_overhead' for what that adds per command.
+
+'parse' runs from the bytes arriving to the command starting on the socket
+server's worker thread, so it includes time spent queued behind earlier
+commands. 'setpoint' runs from there to the first setpoint change, so it
+covers dispatching the command too. The command runner holds the span
+begin() returns and hands it back to end(); in between it is the tracer's
+active span, which setpoint() closes. Only one command is traced at a time:
+a priority command arriving while another runs takes the active span over.
+The 'frame' stage runs on the motor thread: every span whose setpoint changed
+since the last tick closes on the tick's frames.
+"""
+import collections
+import time
+
+STAGES = ('parse', 'setpoint', 'frame', 'total')
+FLUSH_PERIOD = 1.0                      # Seconds between flush() calls from SkateBack
+MAX_PENDING = 8192                      # Finished spans kept for flush(); older ones are dropped beyond this
+SUB_BUCKET_BITS = 5                     # 32 sub-buckets per power of two
+MAX_VALUE_BITS = 44                     # ~4.9 hours in nanoseconds
+BUCKETS = ((MAX_VALUE_BITS - SUB_BUCKET_BITS) << SUB_BUCKET_BITS) + (2 << SUB_BUCKET_BITS)
+
+_now = time.perf_counter_ns
+
+
+class Histogram:
+    def __init__(self):
+        """
+        Log-linear histogram of non-negative integer values (nanoseconds).
+        """
+        self.counts = [0] * BUCKETS
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        Add a value to the histogram.
+
+        Increments are not locked; under the GIL a racing increment can at worst
+        lose a count, which is fine for latency statistics.
+        """
+        if value < 64:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - 6
+            index = (shift << 5) + (value >> shift)
+            if index >= BUCKETS:
+                index = BUCKETS - 1
+        self.counts[index] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @staticmethod
+    def bucket_value(index):
+        """
+        Midpoint of the values that land in a bucket.
+        """
+        if index < 64:
+            return index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        lower = (index - (shift << SUB_BUCKET_BITS)) << shift
+        return lower + ((1 << shift) >> 1)
+
+    def percentile(self, p):
+        """
+        Value at the given percentile (0-100), or 0 if the histogram is empty.
+        """
+        count = self.count
+        if not count:
+            return 0
+        rank = max(1, round(p / 100 * count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def summary(self, scale=1000.0):
+        """
+        Count, mean, percentiles and max, divided by scale (default: microseconds).
+        """
+        count = self.count
+        return {
+            "count": count,
+            "mean": (self.total / count / scale) if count else 0.0,
+            "p50": self.percentile(50) / scale,
+            "p90": self.percentile(90) / scale,
+            "p99": self.percentile(99) / scale,
+            "max": self.max / scale,
+        }
+
+
+# Slots of a span: the recv time, then when each stage closed (0 while open)
+_RECV, _PARSE, _SETPOINT, _FRAME = range(4)
+
+
+class Tracer:
+    def __init__(self, enabled=True):
+        """
+        Collects per-stage command latency histograms.
+
+        Args:
+            enabled (bool): Start with tracing on. Toggle at runtime through
+                            the 'trace on|off' socket command.
+        """
+        self.enabled = enabled
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._active = None                     # Span of the command running now
+        self._waiting = collections.deque()     # Spans whose setpoint has not reached the VESCs yet
+        self._pending = collections.deque(maxlen=MAX_PENDING)     # Finished spans, see flush()
+
+    def begin(self, recv_ns):
+        """
+        Start a span for a command as it starts running, which closes its
+        'parse' stage.
+
+        Args:
+            recv_ns (int): time.perf_counter_ns() when the command's bytes were received.
+
+        Returns:
+            list: The span to pass to end(), or None with tracing off.
+        """
+        if self.enabled:
+            span = self._active = [recv_ns, _now(), 0, 0]
+            return span
+        return None
+
+    def setpoint(self):
+        """
+        Called when the wheels' setpoints change. The first change closes the
+        active span's 'setpoint' stage, and the span waits for the next frame.
+        """
+        span = self._active
+        if span is not None and not span[_SETPOINT]:
+            span[_SETPOINT] = _now()
+            self._waiting.append(span)
+
+    def frame(self):
+        """
+        Called by the motor loop after a tick's frames are written.
+        """
+        waiting = self._waiting
+        if not waiting:
+            return
+        now = _now()
+        while waiting:
+            try:
+                span = waiting.popleft()
+            except IndexError:
+                break
+            span[_FRAME] = now
+            self._pending.append(span)
+
+    def end(self, span):
+        """
+        Detach a span begin() returned once the command has been handled. A span
+        that changed no setpoint is finished here; the others finish with their
+        frame.
+        """
+        if span is not None:
+            if self._active is span:
+                self._active = None
+            if not span[_SETPOINT]:
+                self._pending.append(span)
+
+    def flush(self):
+        """
+        Add the spans finished since the last call to the histograms. Each
+        stage is timed from the last stage closed before it.
+        """
+        pending = self._pending
+        histograms = [self.histograms[stage] for stage in STAGES]
+        while pending:
+            try:
+                span = pending.popleft()
+            except IndexError:
+                break
+            last = span[_RECV]
+            for slot in (_PARSE, _SETPOINT, _FRAME):
+                if span[slot]:
+                    histograms[slot - 1].record(span[slot] - last)
+                    last = span[slot]
+            if span[_FRAME]:
+                histograms[-1].record(span[_FRAME] - span[_RECV])
+
+    def reset(self):
+        self._pending.clear()
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._waiting.clear()
+
+    def stats(self):
+        """
+        Per-stage latency summaries in microseconds.
+        """
+        self.flush()
+        return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
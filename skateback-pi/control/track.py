@@ -0,0 +1,256 @@
+"""
+Compact GPS track of the ride, for drawing the board's path in the app.
+
+The only link to the app is a BLE characteristic carrying short text lines, so
+the track is kept small at every step:
+
+  - Simplification: a fix is only kept once the fixes since the last kept one
+    no longer fit within TOLERANCE of a straight line from it. This is the
+    streaming form of Douglas-Peucker (the "opening window"), run as each fix
+    arrives: every dropped fix is within TOLERANCE of the kept path, and a
+    straight run at constant speed stores two points however long it is.
+  - Encoding: positions are integers in 1e-7 degrees (the receiver's own
+    units, about 1 cm) and times in 0.1 s. Each point is stored as zigzag
+    varints of its difference from the previous one, so a few metres of
+    travel costs a byte or two per coordinate instead of 8.
+  - Storage: a fixed-size buffer of BLOCK byte blocks, each starting with an
+    absolute point. When it is full the oldest block is dropped, so the track
+    never grows and any block can be decoded on its own.
+
+Every kept point gets a sequence number. A client asks for the points since
+its cursor, the sequence number after the last point it has, and only new
+segments cross the link. A page is encoded the same way as a block: the
+first point absolute, the rest as differences (see encode() and decode()).
+"""
+import math
+import threading
+import gps_fix
+
+TOLERANCE = 2.0         # Largest distance of a dropped fix from the kept path (m)
+MAX_PENDING = 120       # Keep a point after this many dropped fixes in a row, to bound the work per fix
+CAPACITY = 65536        # Bytes of track storage, hours of riding
+BLOCK = 512             # Bytes per block, each starting with an absolute point
+PAGE_POINTS = 100       # Points per page
+UNITS = 1e7             # Integer position units per degree
+TIME_UNITS = 10         # Integer time units per second
+
+
+def _put(out, value):
+    """
+    Append a signed integer to a bytearray as a zigzag varint.
+    """
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get(data, position):
+    """
+    Read a zigzag varint from data at position.
+
+    Returns:
+        tuple: (value, position after it)
+    """
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), position
+
+
+def encode(points):
+    """
+    Encode integer points, the first absolute and the rest as differences.
+
+    Args:
+        points (list): (t, lat, lon) integer tuples, in TIME_UNITS and UNITS.
+
+    Returns:
+        bytes: Three zigzag varints per point.
+    """
+    out = bytearray()
+    previous = (0, 0, 0)
+    for point in points:
+        for value, last in zip(point, previous):
+            _put(out, value - last)
+        previous = point
+    return bytes(out)
+
+
+def decode(data):
+    """
+    Points from encode()d bytes.
+
+    Returns:
+        list: (t, lat, lon) integer tuples.
+    """
+    points = []
+    t = lat = lon = 0
+    position = 0
+    while position < len(data):
+        dt, position = _get(data, position)
+        dlat, position = _get(data, position)
+        dlon, position = _get(data, position)
+        t, lat, lon = t + dt, lat + dlat, lon + dlon
+        points.append((t, lat, lon))
+    return points
+
+
+class Track:
+    def __init__(self, capacity=CAPACITY, tolerance=TOLERANCE, block=BLOCK):
+        """
+        An empty track.
+
+        Args:
+            capacity (int): Bytes of storage; the oldest points are dropped beyond it.
+            tolerance (float): Largest distance of a dropped fix from the kept path (m).
+            block (int): Bytes per block.
+        """
+        self.tolerance = tolerance
+        self.block = block
+        self.buffer = bytearray(max(capacity // block, 2) * block)
+        self._blocks = [None] * (len(self.buffer) // block)    # (first seq, points, bytes used) per block
+        self._current = 0
+        self._last = None           # Last stored point, the base for the next difference
+        self.next_seq = 0           # Sequence number the next kept point gets
+        self.start = None           # Time of the first fix, times are stored relative to it
+        self.head = None            # Latest fix as (t, lat, lon) integers, kept or not
+        self.fixes = 0              # Fixes added, kept or not
+        self._anchor = None         # Last kept point...
+        self._pending = []          # ...and the fixes since, as integers
+        self._scale = 0.0           # Metres per unit of longitude at the track's latitude
+        self._lock = threading.Lock()
+
+    def add(self, lat, lon, t):
+        """
+        Add a fix. Cheap enough to call for every fix the receiver reports.
+
+        Args:
+            lat (float): Latitude in degrees.
+            lon (float): Longitude in degrees.
+            t (float): Time of the fix in seconds, from any fixed origin.
+        """
+        with self._lock:
+            if self.start is None:
+                self.start = t
+                self._scale = gps_fix.METERS_PER_DEG_LON * math.cos(math.radians(lat)) / UNITS
+            point = (round((t - self.start) * TIME_UNITS), round(lat * UNITS), round(lon * UNITS))
+            self.head = point
+            self.fixes += 1
+            if self._anchor is None:
+                self._anchor = point
+                self._store(point)
+                return
+            # Keep the previous fix once a straight line from the anchor to
+            # this one no longer passes within tolerance of every fix since
+            if self._pending and (len(self._pending) >= MAX_PENDING or not self._fits(point)):
+                self._anchor = self._pending[-1]
+                self._store(self._anchor)
+                self._pending = []
+            self._pending.append(point)
+
+    def _fits(self, end):
+        """
+        Whether every pending fix is within tolerance of the segment from the
+        anchor to end, in metres on the local tangent plane.
+        """
+        scale_x, scale_y = self._scale, gps_fix.METERS_PER_DEG_LAT / UNITS
+        _, lat0, lon0 = self._anchor
+        ex, ey = (end[2] - lon0) * scale_x, (end[1] - lat0) * scale_y
+        length2 = ex * ex + ey * ey
+        limit2 = self.tolerance * self.tolerance
+        for _, lat, lon in self._pending:
+            px, py = (lon - lon0) * scale_x, (lat - lat0) * scale_y
+            s = (px * ex + py * ey) / length2 if length2 else 0.0
+            s = 0.0 if s < 0.0 else 1.0 if s > 1.0 else s
+            dx, dy = px - s * ex, py - s * ey
+            if dx * dx + dy * dy > limit2:
+                return False
+        return True
+
+    def _store(self, point):
+        """
+        Append a kept point to the current block, starting the next block
+        (and dropping the oldest) when it does not fit.
+        """
+        encoded = bytearray()
+        block = self._blocks[self._current]
+        if block is not None:
+            for value, last in zip(point, self._last):
+                _put(encoded, value - last)
+            if block[2] + len(encoded) > self.block:
+                self._current = (self._current + 1) % len(self._blocks)
+                block = None
+        if block is None:
+            encoded = bytearray(encode([point]))
+            block = (self.next_seq, 0, 0)
+        first, count, used = block
+        offset = self._current * self.block + used
+        self.buffer[offset:offset + len(encoded)] = encoded
+        self._blocks[self._current] = (first, count + 1, used + len(encoded))
+        self._last = point
+        self.next_seq += 1
+
+    def since(self, cursor, limit=PAGE_POINTS):
+        """
+        Kept points from sequence number cursor on.
+
+        Args:
+            cursor (int): Sequence number of the first point wanted. Points
+                          that have been dropped to make room are skipped.
+            limit (int): Most points to return.
+
+        Returns:
+            tuple: (sequence number of the first point returned, list of
+            (t, lat, lon) integer tuples).
+        """
+        with self._lock:
+            start = self.block
+            copies = sorted((block[0], bytes(self.buffer[number * start:number * start + block[2]]))
+                            for number, block in enumerate(self._blocks)
+                            if block is not None and block[0] + block[1] > cursor)
+        points = []
+        first_seq = None
+        for first, data in copies:
+            for seq, point in enumerate(decode(data), first):
+                if seq < cursor:
+                    continue
+                if first_seq is None:
+                    first_seq = seq
+                points.append(point)
+                if len(points) >= limit:
+                    return first_seq, points
+        return (self.next_seq if first_seq is None else first_seq), points
+
+    def page(self, cursor, limit=PAGE_POINTS):
+        """
+        The points since cursor, encoded for the link.
+
+        Returns:
+            tuple: (sequence number of the first point, encode()d points, cursor for the next page)
+        """
+        first, points = self.since(cursor, limit)
+        return first, encode(points), first + len(points)
+
+    def position(self):
+        """
+        The latest fix, kept or not.
+
+        Returns:
+            list: [latitude, longitude] in degrees, or None before the first fix.
+        """
+        head = self.head
+        return None if head is None else [head[1] / UNITS, head[2] / UNITS]
+
+    def stored_bytes(self):
+        """
+        Bytes of the buffer in use.
+        """
+        with self._lock:
+            return sum(block[2] for block in self._blocks if block is not None)
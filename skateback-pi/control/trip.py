@@ -0,0 +1,187 @@
+"""
+Trip statistics and remaining range, kept up to date from VESC telemetry.
+
+The motor tick hands every new pair of GetValues replies to TripStats.add(),
+which updates running totals from the change in the VESC counters since the
+previous pair: distance from the tachometers, energy from the watt-hour
+counters, moving time, and peak speed from the ERPM. Each sample costs the
+same however long the trip, and stats() reads the totals without looking at
+any history.
+
+Remaining range comes from an online linear regression of pack voltage
+against energy used and input current,
+
+    v = a + b * Wh + c * amps
+
+kept as exponentially forgotten sums for the normal equations. The fitted b is
+how fast the pack's resting voltage falls per Wh, so the energy left is how
+many more Wh it takes to reach V_CUTOFF at the trip's typical current, and the
+range is that over the trip's Wh/km. Until the trip has used MIN_FIT_WH, or if
+the fit does not show the voltage falling, the energy left is read off the
+resting voltage on a linear charge curve instead.
+"""
+import odometry
+import telemetry
+
+# Pack, a 10s lithium ion pack like the one vesc_sim.py models
+V_FULL = 42.0               # Resting voltage when full
+V_CUTOFF = 33.0             # Resting voltage when empty, where the range ends
+PACK_WH = 360.0             # Usable energy of a full pack
+
+MOVING_SPEED = 0.2          # Slower than this does not count as moving (m/s)
+MIN_DISTANCE = 100.0        # Distance before Wh/km is trusted (m)
+MIN_FIT_WH = 2.0            # Energy used before the voltage regression is trusted
+FORGET = 0.9999             # Regression weight kept per sample, about 8 minutes of memory at 20 Hz
+
+
+def _net_wh(values):
+    return values.watt_hours - values.watt_hours_charged
+
+
+def _solve3(m, v):
+    """
+    Solve the 3x3 system m x = v by Cramer's rule.
+
+    Returns:
+        list: x, or None if m is singular.
+    """
+    def det(a):
+        return (a[0][0] * (a[1][1] * a[2][2] - a[1][2] * a[2][1])
+                - a[0][1] * (a[1][0] * a[2][2] - a[1][2] * a[2][0])
+                + a[0][2] * (a[1][0] * a[2][1] - a[1][1] * a[2][0]))
+
+    d = det(m)
+    scale = max(abs(m[i][j]) for i in range(3) for j in range(3)) ** 3
+    if scale == 0.0 or abs(d) < 1e-12 * scale:
+        return None
+    result = []
+    for column in range(3):
+        replaced = [[v[row] if j == column else m[row][j] for j in range(3)] for row in range(3)]
+        result.append(det(replaced) / d)
+    return result
+
+
+class TripStats:
+    def __init__(self):
+        """
+        Statistics for a trip starting now; reset() starts another.
+        """
+        self.reset()
+
+    def reset(self):
+        self.distance = 0.0         # m
+        self.moving_time = 0.0      # s
+        self.elapsed = 0.0          # s
+        self.peak_speed = 0.0       # m/s
+        self.wh_used = 0.0          # Net of regenerative braking
+        self.samples = 0
+        self._last = None           # (t, left tachometer, right tachometer, Wh counter total)
+        self._left = self._right = None
+        self._moving_amp_seconds = 0.0
+        self._voltage = None
+        self._current = 0.0
+        # Forgotten sums for the normal equations of v = a + b * Wh + c * amps
+        self._xx = [[0.0] * 3 for _ in range(3)]
+        self._xy = [0.0] * 3
+
+    def add(self, t, left, right):
+        """
+        Add a pair of telemetry replies. Replies already added are ignored, so
+        this can be called every tick with the latest values.
+
+        Args:
+            t (float): Time of the tick (s).
+            left (GetValues): Latest left VESC reply, or None.
+            right (GetValues): Latest right VESC reply, or None.
+        """
+        if left is None or right is None or (left is self._left and right is self._right):
+            return
+        self._left, self._right = left, right
+        wh = _net_wh(left) + _net_wh(right)
+        last = self._last
+        self._last = (t, left.tachometer, right.tachometer, wh)
+        # A VESC that rebooted counts from zero again; start over from its new counters
+        if last is None or wh < last[3] - 1e-6 or t <= last[0]:
+            return
+
+        dt = t - last[0]
+        self.samples += 1
+        self.elapsed += dt
+        self.distance += abs((left.tachometer - last[1]) + (right.tachometer - last[2])) / 2 * odometry.METERS_PER_TACHO
+        self.wh_used += wh - last[3]
+        current = left.avg_input_current + right.avg_input_current
+        speed = abs(left.rpm + right.rpm) / 2 * telemetry.SPEED_PER_ERPM
+        if speed > self.peak_speed:
+            self.peak_speed = speed
+        if speed >= MOVING_SPEED:
+            self.moving_time += dt
+            self._moving_amp_seconds += current * dt
+
+        voltage = (left.v_in + right.v_in) / 2
+        self._voltage, self._current = voltage, current
+        x = (1.0, self.wh_used, current)
+        xx, xy = self._xx, self._xy
+        for i in range(3):
+            xy[i] = xy[i] * FORGET + x[i] * voltage
+            row = xx[i]
+            for j in range(3):
+                row[j] = row[j] * FORGET + x[i] * x[j]
+
+    @property
+    def average_speed(self):
+        """
+        Distance over moving time (m/s), or None before moving.
+        """
+        return self.distance / self.moving_time if self.moving_time else None
+
+    @property
+    def wh_per_km(self):
+        """
+        Energy per distance, or None before MIN_DISTANCE.
+        """
+        if self.distance < MIN_DISTANCE:
+            return None
+        return self.wh_used / (self.distance / 1000.0)
+
+    def remaining_wh(self):
+        """
+        Energy left before the pack reaches V_CUTOFF.
+
+        Returns:
+            tuple: (Wh, method) where method is 'regression' or 'voltage';
+            (None, None) before any telemetry.
+        """
+        if self._voltage is None:
+            return None, None
+        typical = self._moving_amp_seconds / self.moving_time if self.moving_time else self._current
+        fit = _solve3(self._xx, self._xy) if self.wh_used >= MIN_FIT_WH else None
+        if fit is not None and fit[1] < 0.0:
+            a, b, c = fit
+            empty_at = (V_CUTOFF - a - c * typical) / b
+            return max(0.0, empty_at - self.wh_used), 'regression'
+        # No usable slope yet: resting voltage on a straight charge curve,
+        # taking out the sag the fit has seen if it has seen any
+        sag = fit[2] * self._current if fit is not None and fit[2] < 0.0 else 0.0
+        charge = (self._voltage - sag - V_CUTOFF) / (V_FULL - V_CUTOFF)
+        return max(0.0, min(1.0, charge)) * PACK_WH, 'voltage'
+
+    def stats(self):
+        """
+        Everything for the app's stats screen, JSON serializable.
+        """
+        remaining, method = self.remaining_wh()
+        wh_per_km = self.wh_per_km
+        return {
+            "distance_m": round(self.distance, 1),
+            "moving_time_s": round(self.moving_time, 1),
+            "elapsed_s": round(self.elapsed, 1),
+            "average_speed": None if self.average_speed is None else round(self.average_speed, 2),
+            "peak_speed": round(self.peak_speed, 2),
+            "wh_used": round(self.wh_used, 2),
+            "wh_per_km": None if wh_per_km is None else round(wh_per_km, 2),
+            "voltage": None if self._voltage is None else round(self._voltage, 2),
+            "remaining_wh": None if remaining is None else round(remaining, 1),
+            "range_km": (round(remaining / wh_per_km, 2)
+                         if remaining is not None and wh_per_km else None),
+            "range_method": method,
+        }
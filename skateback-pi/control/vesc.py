@@ -0,0 +1,409 @@
+"""
+Serial transport for the VESC motor controllers.
+
+Everything that talks to a VESC goes through VescTransport, so the controller
+does not care whether the other end is a real /dev/ttyACM* device or a
+simulated VESC sitting on a pty (see vesc_sim.py).
+
+Opening a USB CDC port costs far more than writing a frame, so ports are
+opened once and shared: connect() hands out the same transport to every
+subsystem that asks for a port, and the port is closed when the last of them
+calls release(). Writes from different threads are serialized per port.
+
+A device that disappears (a USB cable glitch) is noticed on the next failed
+read or write. The transport reopens the same path in the background with
+bounded exponential backoff and then calls its reconnect listeners, so other
+ports and their users carry on untouched.
+
+Telemetry can be polled without blocking the writers: start_reader() runs a
+thread that decodes everything the VESC sends and keeps the latest GetValues
+reply, and request_values() only writes the request.
+"""
+import collections
+import threading
+import time
+import serial
+import pyvesc
+from pyvesc.VESC.messages import GetValues
+import logs
+
+BAUD_RATE = 115200
+TIMEOUT = 0.05        # Read timeout in seconds, matches the old per-call serial.Serial
+OPEN_TIMEOUT = 2.0    # Longest a port may take to open in connect_all()
+RECONNECT_MIN = 0.01  # First retry after a device disappears (s), doubling each time...
+RECONNECT_MAX = 0.1   # ...up to this. Opening a missing path is cheap, so retry often
+
+log = logs.get('vesc')
+
+_connections = {}     # port -> shared VescTransport
+_connections_lock = threading.Lock()
+
+
+def connect(port, baudrate=BAUD_RATE, timeout=TIMEOUT):
+    """
+    Get the shared connection to a VESC, opening the port on first use.
+
+    Every call must be matched by a release() on the returned transport.
+
+    Args:
+        port (str): Device path, e.g. '/dev/ttyACM0'.
+        baudrate (int): Serial baud rate, only used when the port is opened.
+        timeout (float): Read timeout, only used when the port is opened.
+
+    Returns:
+        VescTransport: The open, shared transport for the port.
+    """
+    with _connections_lock:
+        transport = _connections.get(port)
+        if transport is not None and transport.is_open:
+            transport.users += 1
+            return transport
+
+    # Open outside the lock so ports can be opened in parallel (see connect_all)
+    opened = VescTransport(port, baudrate=baudrate, timeout=timeout)
+    with _connections_lock:
+        transport = _connections.get(port)
+        if transport is None or not transport.is_open:
+            transport = _connections[port] = opened
+        else:
+            opened.close()      # Someone else opened it first
+        transport.users += 1
+        return transport
+
+
+def connect_all(ports, timeout=OPEN_TIMEOUT):
+    """
+    Get shared connections to several VESCs, opening the ports in parallel.
+
+    A USB serial device that is re-enumerating can hang in open(), so each
+    port gets at most timeout seconds. If any port fails, the ones that did
+    open are released again.
+
+    Args:
+        ports (list): Device paths.
+        timeout (float): Seconds to wait for all ports to open.
+
+    Returns:
+        list: VescTransport for each port, in order.
+
+    Raises:
+        TimeoutError: If a port did not open in time.
+        serial.SerialException: If a port could not be opened.
+    """
+    transports = [None] * len(ports)
+    errors = [None] * len(ports)
+    lock = threading.Lock()
+    abandoned = False
+
+    def open_port(index, port):
+        try:
+            transport = connect(port)
+        except Exception as e:
+            errors[index] = e
+            return
+        with lock:
+            if abandoned:
+                transport.release()     # Opened after we gave up on it
+            else:
+                transports[index] = transport
+
+    threads = [threading.Thread(target=open_port, args=(index, port), name=f"open {port}", daemon=True)
+               for index, port in enumerate(ports)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    with lock:
+        abandoned = True
+        failed = [index for index, transport in enumerate(transports) if transport is None]
+        if not failed:
+            return transports
+        for transport in transports:
+            if transport is not None:
+                transport.release()
+    index = failed[0]
+    raise errors[index] or TimeoutError(f"Timed out opening {ports[index]} after {timeout} s")
+
+
+class VescDisconnected(serial.SerialException):
+    """
+    Raised when writing to a VESC whose device has gone away. The transport
+    is reopening it in the background.
+    """
+
+
+class VescTransport:
+    def __init__(self, port, baudrate=BAUD_RATE, timeout=TIMEOUT):
+        """
+        Open a serial connection to a single VESC.
+
+        Args:
+            port (str): Device path, e.g. '/dev/ttyACM0' or a simulated pty.
+            baudrate (int): Serial baud rate.
+            timeout (float): Read timeout in seconds.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.users = 0                  # Holders from connect(), see release()
+        self.lock = threading.Lock()    # One frame on the wire at a time
+        self.serial = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+
+        # Hot-plug state. A failed read or write marks the device lost and a
+        # background thread reopens it, see _lost() and _reconnect().
+        self.connected = True
+        self.closed = False
+        self.disconnects = 0
+        self.reconnect_times = collections.deque(maxlen=100)   # Seconds from loss to reopened
+        self._disconnected_at = None
+        self._connected_event = threading.Event()
+        self._connected_event.set()
+        self._listeners = []
+
+        # Latest GetValues reply, kept by the reader thread (see start_reader)
+        self.values = None
+        self.values_time = None         # time.monotonic() when it arrived
+        self.values_count = 0
+        self._values_cond = threading.Condition()
+        self._reader = None
+        self._values_listeners = []
+
+    def __enter__(self):
+        """
+        Enable use of the 'with' statement for resource management.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Ensure the serial connection is closed when exiting the 'with' block.
+        """
+        self.close()
+
+    @property
+    def is_open(self):
+        """
+        True until close(), including while the device is being reopened.
+        """
+        return not self.closed
+
+    def add_reconnect_listener(self, listener):
+        """
+        Call listener(transport) each time the device has been reopened, e.g.
+        to resend the current setpoint straight away.
+        """
+        self._listeners.append(listener)
+
+    def remove_reconnect_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def add_values_listener(self, listener):
+        """
+        Call listener(transport, values) on the reader thread for every
+        GetValues reply, e.g. to capture them (see session.py).
+        """
+        self._values_listeners.append(listener)
+
+    def remove_values_listener(self, listener):
+        if listener in self._values_listeners:
+            self._values_listeners.remove(listener)
+
+    def _write(self, data):
+        # Called with self.lock held
+        if not self.connected:
+            raise VescDisconnected(f"{self.port} is disconnected")
+        try:
+            self.serial.write(data)
+        except (serial.SerialException, OSError) as e:
+            self._lost(e)
+            raise VescDisconnected(f"{self.port} is disconnected: {e}") from e
+
+    def _lost(self, error):
+        """
+        Mark the device gone and start reopening it. Called with self.lock held.
+        """
+        if not self.connected or self.closed:
+            return
+        log.error("Lost VESC on %s: %s", self.port, error)
+        self.connected = False
+        self._connected_event.clear()
+        self.disconnects += 1
+        self._disconnected_at = time.monotonic()
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        threading.Thread(target=self._reconnect, name=f"vesc-reconnect {self.port}", daemon=True).start()
+
+    def _reconnect(self):
+        """
+        Reopen the device with exponential backoff until it is back or the
+        transport is closed, then tell the listeners.
+        """
+        delay = RECONNECT_MIN
+        while not self.closed:
+            time.sleep(delay)
+            try:
+                reopened = serial.Serial(self.port, baudrate=self.baudrate, timeout=self.timeout)
+            except (serial.SerialException, OSError):
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            with self.lock:
+                if self.closed:
+                    reopened.close()
+                    return
+                self.serial = reopened
+                self.connected = True
+                elapsed = time.monotonic() - self._disconnected_at
+                self.reconnect_times.append(elapsed)
+            self._connected_event.set()
+            log.info("Reconnected to VESC on %s after %.0f ms", self.port, elapsed * 1000)
+            for listener in list(self._listeners):
+                try:
+                    listener(self)
+                except Exception as e:
+                    log.error("Error in reconnect listener for %s: %s", self.port, e)
+            return
+
+    def send(self, message):
+        """
+        Encode a pyvesc message and write it to the VESC.
+
+        Args:
+            message: A pyvesc setter message, e.g. SetDutyCycle(0.1).
+
+        Raises:
+            VescDisconnected: If the device is gone; it is being reopened.
+        """
+        frame = pyvesc.encode(message)
+        with self.lock:
+            self._write(frame)
+
+    def start_reader(self):
+        """
+        Start the thread that reads replies from the VESC, if not already running.
+        From then on get_values() waits for the reader instead of reading the port itself.
+        """
+        with self._values_cond:
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_loop, name=f"vesc-reader {self.port}", daemon=True)
+                self._reader.start()
+
+    def _read_loop(self):
+        buffer = b''
+        while not self.closed:
+            if not self._connected_event.wait(RECONNECT_MAX):
+                continue
+            port = self.serial
+            try:
+                buffer += port.read(port.in_waiting or 1)
+            except Exception as e:
+                # Pulled out, or closed under us by close() or another thread noticing first
+                with self.lock:
+                    if self.serial is port:
+                        self._lost(e)
+                buffer = b''
+                continue
+            while buffer:
+                message, consumed = pyvesc.decode(buffer)
+                if not consumed:
+                    break
+                buffer = buffer[consumed:]
+                if isinstance(message, GetValues):
+                    with self._values_cond:
+                        self.values = message
+                        self.values_time = time.monotonic()
+                        self.values_count += 1
+                        self._values_cond.notify_all()
+                    for listener in list(self._values_listeners):
+                        try:
+                            listener(self, message)
+                        except Exception as e:
+                            log.error("Error in values listener for %s: %s", self.port, e)
+
+    def request_values(self):
+        """
+        Ask the VESC for its telemetry without waiting for the reply. The
+        reader thread stores it in self.values when it arrives.
+        """
+        with self.lock:
+            self._write(pyvesc.encode_request(GetValues))
+
+    def get_values(self):
+        """
+        Ask the VESC for its telemetry and wait for the reply.
+
+        Returns:
+            GetValues: The decoded reply, or None if nothing arrived within the
+            timeout or the device is disconnected.
+        """
+        if not self.connected:
+            return None
+        try:
+            if self._reader is not None:
+                with self._values_cond:
+                    seen = self.values_count
+                    self.request_values()
+                    if self._values_cond.wait_for(lambda: self.values_count > seen, self.timeout):
+                        return self.values
+                    return None
+
+            with self.lock:
+                self.serial.reset_input_buffer()
+                self._write(pyvesc.encode_request(GetValues))
+
+                buffer = b''
+                deadline = time.monotonic() + self.timeout
+                while time.monotonic() < deadline:
+                    try:
+                        buffer += self.serial.read(self.serial.in_waiting or 1)
+                    except (serial.SerialException, OSError) as e:
+                        self._lost(e)
+                        return None
+                    message, consumed = pyvesc.decode(buffer)
+                    buffer = buffer[consumed:]
+                    if isinstance(message, GetValues):
+                        return message
+                return None
+        except VescDisconnected:
+            return None
+
+    def link_stats(self):
+        """
+        Connection state and reconnect times in milliseconds, for the 'links' command.
+        """
+        times = [t * 1000 for t in self.reconnect_times]
+        return {
+            "connected": self.connected,
+            "disconnects": self.disconnects,
+            "last_reconnect_ms": times[-1] if times else None,
+            "mean_reconnect_ms": sum(times) / len(times) if times else None,
+            "max_reconnect_ms": max(times) if times else None,
+        }
+
+    def release(self):
+        """
+        Give back a connection obtained from connect(). The port is closed
+        once every holder has released it.
+        """
+        with _connections_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            if _connections.get(self.port) is self:
+                del _connections[self.port]
+        self.close()
+
+    def close(self):
+        """
+        Close the serial connection if it is still open, for every holder.
+        Stops any reconnect in progress.
+        """
+        with self.lock:
+            self.closed = True
+            self._connected_event.set()     # Let the reader see closed
+            if self.serial.is_open:
+                self.serial.close()
@@ -0,0 +1,428 @@
+"""
+Simulated VESC running on a pty pair.
+
+The controller opens the slave side of the pty exactly like it would open
+/dev/ttyACM0, so SkateBack, the benchmarks and the motor scripts run unchanged
+on an ordinary Linux machine. The simulator parses the pyvesc frames written to
+it, runs a small DC motor model and answers GetValues requests. Latency,
+dropped bytes and disconnects can be injected to exercise the error paths.
+
+Usage:
+    with SimulatedBoard() as board:
+        sk = SkateBack.SkateBack(*board.ports)
+"""
+import collections
+import math
+import os
+import random
+import select
+import shutil
+import tempfile
+import threading
+import time
+import tty
+import pyvesc
+from pyvesc.VESC.messages import GetValues, SetDutyCycle, SetCurrent, SetCurrentBrake, SetRPM
+
+# Motor model. Numbers are rough fits to the hub motors on the board, good enough
+# for the shape of the response rather than exact speeds.
+ERPM_PER_DUTY = 20000.0     # No-load ERPM at 100% duty
+ERPM_PER_AMP_S = 400.0      # ERPM/s of acceleration per amp of motor current
+DRAG = 0.5                  # Rolling and bearing drag, 1/s
+STARTUP_CURRENT = 3.0       # Current needed to break away from standstill (A)
+MOTOR_RESISTANCE = 0.5      # Phase resistance seen by the duty cycle (ohm)
+CURRENT_LIMIT = 30.0        # VESC motor current limit (A)
+SPIN_GAIN = 4.0             # A wheel that has lost grip spins up this much faster per amp over the grip
+REGRIP_RATE = 10.0          # How quickly a spinning wheel falls back to ground speed once under the grip (1/s)
+SCRUB = 20.0                # Drag on the wheels' ground speed difference in a pivot, where the tyres scrub sideways (1/s)
+
+# Battery model
+V_FULL = 42.0               # 10s pack, full
+V_EMPTY = 33.0              # 10s pack, empty
+CAPACITY_AH = 10.0
+BATTERY_RESISTANCE = 0.15
+
+VESC_TIMEOUT = 1.0          # VESC releases the motor if no command arrives for this long (s)
+PHYSICS_DT = 0.002          # Simulation step (s)
+
+Frame = collections.namedtuple('Frame', ['time', 'message'])
+
+
+class SimulatedVesc:
+    def __init__(self, latency=0.0, drop_rate=0.0, timeout=VESC_TIMEOUT, seed=None, frame_log=10000, load=0.0,
+                 grip=None):
+        """
+        Create a simulated VESC and start serving it on a fresh pty.
+
+        Args:
+            latency (float): Delay in seconds before received bytes are processed
+                             and before replies are written back.
+            drop_rate (float): Probability of dropping each received byte.
+            timeout (float): Seconds without a command before the motor is released.
+            seed (int): Seed for the byte-drop random generator.
+            frame_log (int): Number of decoded frames kept in self.frames.
+            load (float): Motor current (A) lost to a constant load against the
+                          direction of travel, e.g. a slope or more weight over
+                          this wheel. Can be changed while running.
+            grip (float): Drive current (A) the tyre can put down before it
+                          slips, e.g. on wet ground; None for unlimited.
+                          Can be changed while running.
+        """
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.timeout = timeout
+        self.load = load
+        self.grip = grip
+        self.random = random.Random(seed)
+        self.partner = None         # The other wheel on a SimulatedBoard...
+        self.scrub = 0.0            # ...and the scrub against it, see SCRUB
+
+        # Motor state
+        self.mode = 'off'           # 'off', 'duty', 'current', 'brake' or 'rpm'
+        self.setpoint = 0.0
+        self.erpm = 0.0
+        self.ground_erpm = 0.0      # Speed over the ground; differs from erpm while the wheel slips
+        self.motor_current = 0.0
+        self.duty_now = 0.0
+        self.tachometer = 0
+        self.tachometer_abs = 0
+        self._tach_fraction = 0.0
+        self.amp_hours = 0.0
+        self.watt_hours = 0.0
+        self.v_in = V_FULL
+        self.last_command = None
+
+        # Counters for benchmarks and tests
+        self.frames = collections.deque(maxlen=frame_log)
+        self.bytes_dropped = 0
+        self.bad_frames = 0
+        self.frame_count = 0
+        self.cond = threading.Condition()
+
+        self._dir = tempfile.mkdtemp(prefix='vesc-sim-')
+        self.port = os.path.join(self._dir, 'ttyACM')   # Stable path across reconnects
+        self.connected = False
+        self.running = True
+        self._open_pty()
+
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        """
+        Enable use of the 'with' statement for resource management.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop the simulator when exiting the 'with' block.
+        """
+        self.close()
+
+    def _open_pty(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        os.symlink(os.ttyname(self.slave_fd), self.port + '.tmp')
+        os.replace(self.port + '.tmp', self.port)
+        self._rx = b''
+        self._pending_in = collections.deque()
+        self._pending_out = collections.deque()
+        self.connected = True
+
+    def _close_pty(self):
+        self.connected = False
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        try:
+            os.unlink(self.port)
+        except FileNotFoundError:
+            pass
+
+    def disconnect(self):
+        """
+        Simulate the USB cable being pulled: the pty goes away and the device
+        path disappears, so writes on an open handle fail like a dead ttyACM.
+        """
+        with self.cond:
+            if self.connected:
+                self._close_pty()
+                self.mode = 'off'
+
+    def reconnect(self):
+        """
+        Simulate the device coming back on the same path.
+        """
+        with self.cond:
+            if not self.connected:
+                self._open_pty()
+
+    def close(self):
+        """
+        Stop the simulator thread and remove the pty.
+        """
+        self.running = False
+        self.thread.join(timeout=1)
+        with self.cond:
+            if self.connected:
+                self._close_pty()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def wait_for_frame(self, predicate, timeout=1.0):
+        """
+        Block until a decoded frame matches the predicate.
+
+        Args:
+            predicate (function): Called with each new Frame.
+            timeout (float): Seconds to wait.
+
+        Returns:
+            Frame: The first matching frame, or None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            seen = self.frame_count
+            while True:
+                new = self.frame_count - seen
+                if new:
+                    for frame in list(self.frames)[-min(new, len(self.frames)):]:
+                        if predicate(frame):
+                            return frame
+                    seen = self.frame_count
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def _serve(self):
+        last = time.monotonic()
+        while self.running:
+            if self.connected:
+                try:
+                    readable, _, _ = select.select([self.master_fd], [], [], PHYSICS_DT)
+                    if readable:
+                        self._receive(os.read(self.master_fd, 4096))
+                except OSError:
+                    pass
+            else:
+                time.sleep(PHYSICS_DT)
+
+            now = time.monotonic()
+            with self.cond:
+                while self._pending_in and self._pending_in[0][0] <= now:
+                    self._parse(self._pending_in.popleft()[1])
+                while self._pending_out and self._pending_out[0][0] <= now:
+                    self._write(self._pending_out.popleft()[1])
+                self._step(now - last, now)
+            last = now
+
+    def _receive(self, data):
+        if self.drop_rate:
+            kept = bytes(b for b in data if self.random.random() >= self.drop_rate)
+            self.bytes_dropped += len(data) - len(kept)
+            data = kept
+        with self.cond:
+            self._pending_in.append((time.monotonic() + self.latency, data))
+
+    def _write(self, data):
+        if not self.connected:
+            return
+        try:
+            os.write(self.master_fd, data)
+        except OSError:
+            pass
+
+    def _parse(self, data):
+        self._rx += data
+        while True:
+            start = self._rx.find(b'\x02')
+            if start < 0:
+                self._rx = b''
+                return
+            self._rx = self._rx[start:]
+            if len(self._rx) < 2:
+                return
+            end = 2 + self._rx[1] + 3
+            if len(self._rx) < end:
+                return
+            if self._rx[end - 1] != 0x03:
+                # Not a real frame start, probably a dropped byte; resync on the next 0x02
+                self.bad_frames += 1
+                self._rx = self._rx[1:]
+                continue
+            frame, self._rx = self._rx[:end], self._rx[end:]
+            self._handle(frame)
+
+    def _handle(self, frame):
+        if frame[2] == GetValues.id:
+            self._pending_out.append((time.monotonic() + self.latency, pyvesc.encode(self.values())))
+            return
+
+        try:
+            message, _ = pyvesc.decode(frame)
+        except Exception:
+            message = None
+        if message is None:
+            self.bad_frames += 1
+            return
+
+        now = time.monotonic()
+        if isinstance(message, SetDutyCycle):
+            self.mode, self.setpoint = 'duty', message.duty_cycle
+        elif isinstance(message, SetCurrent):
+            self.mode, self.setpoint = 'current', message.current
+        elif isinstance(message, SetCurrentBrake):
+            self.mode, self.setpoint = 'brake', message.current_brake
+        elif isinstance(message, SetRPM):
+            self.mode, self.setpoint = 'rpm', message.rpm
+        self.last_command = now
+
+        self.frames.append(Frame(time.perf_counter(), message))
+        self.frame_count += 1
+        self.cond.notify_all()
+
+    def _step(self, dt, now):
+        if dt <= 0:
+            return
+        if self.last_command is not None and now - self.last_command > self.timeout:
+            self.mode = 'off'
+
+        back_emf = self.erpm / ERPM_PER_DUTY
+        if self.mode == 'duty':
+            self.duty_now = self.setpoint
+            current = (self.setpoint - back_emf) * self.v_in / MOTOR_RESISTANCE
+        elif self.mode == 'current':
+            current = self.setpoint
+            self.duty_now = back_emf
+        elif self.mode == 'brake':
+            current = -abs(self.setpoint) if self.erpm > 0 else abs(self.setpoint)
+            self.duty_now = back_emf
+        elif self.mode == 'rpm':
+            # The VESC runs its own speed PID; model it as a stiff duty loop
+            self.duty_now = self.setpoint / ERPM_PER_DUTY
+            current = (self.duty_now - back_emf) * self.v_in / MOTOR_RESISTANCE
+        else:
+            current = 0.0
+            self.duty_now = 0.0
+        current = max(-CURRENT_LIMIT, min(CURRENT_LIMIT, current))
+
+        if self.erpm == 0.0 and abs(current) < STARTUP_CURRENT + self.load:
+            accel = 0.0     # Stiction: below breakaway current the wheel does not move
+        else:
+            load = math.copysign(self.load, self.erpm if self.erpm else current)
+            accel = (current - load) * ERPM_PER_AMP_S - DRAG * self.erpm
+        scrub = 0.0
+        if self.partner is not None and self.ground_erpm * self.partner.ground_erpm <= 0:
+            # Pivoting; rolling the same way, the trucks carry the board round a curve instead
+            scrub = self.scrub * (self.ground_erpm - self.partner.ground_erpm) / 2
+        previous = self.erpm
+        if self.grip is None:
+            if accel != 0.0:
+                self.erpm += (accel - scrub) * dt
+        else:
+            self._slip_step(current, accel, scrub, dt)
+        if self.mode in ('off', 'brake') and previous * self.erpm < 0:
+            self.erpm = 0.0     # Coasting and braking never reverse the wheel
+        if abs(self.erpm) < 1.0 and abs(current) < STARTUP_CURRENT:
+            self.erpm = 0.0
+        if self.grip is None or self.erpm == 0.0:
+            self.ground_erpm = self.erpm
+        self.motor_current = current
+
+        steps = self.erpm / 60.0 * 6 * dt + self._tach_fraction
+        whole = int(steps)
+        self._tach_fraction = steps - whole
+        self.tachometer += whole
+        self.tachometer_abs += abs(whole)
+
+        input_current = current * abs(self.duty_now)
+        self.amp_hours += abs(input_current) * dt / 3600.0
+        self.watt_hours += abs(input_current) * self.v_in * dt / 3600.0
+        soc = max(0.0, 1.0 - self.amp_hours / CAPACITY_AH)
+        self.v_in = V_EMPTY + (V_FULL - V_EMPTY) * soc - input_current * BATTERY_RESISTANCE
+
+    def _slip_step(self, current, accel, scrub, dt):
+        """
+        Advance the wheel and the ground speed separately: the ground only
+        takes up to grip amps of drive, and the rest spins the wheel up
+        against its own small inertia until the drive is back under the grip.
+        """
+        spin = self.erpm - self.ground_erpm
+        drive = 0.0 if accel == 0.0 else current - math.copysign(self.load, self.erpm if self.erpm else current)
+        traction = max(-self.grip, min(self.grip, drive))
+        if accel != 0.0:
+            self.ground_erpm += (traction * ERPM_PER_AMP_S - DRAG * self.ground_erpm - scrub) * dt
+        if drive != traction:
+            spin += (drive - traction) * ERPM_PER_AMP_S * SPIN_GAIN * dt
+        else:
+            spin -= spin * min(1.0, REGRIP_RATE * dt)
+        self.erpm = self.ground_erpm + spin
+
+    def values(self):
+        """
+        Build the GetValues reply for the current motor state.
+
+        Returns:
+            GetValues: Telemetry message as the real VESC would send it.
+        """
+        input_current = self.motor_current * abs(self.duty_now)
+        return GetValues(
+            25.0, 25.0,                         # temp_fet, temp_motor
+            self.motor_current, input_current,  # avg_motor_current, avg_input_current
+            0.0, self.motor_current,            # avg_id, avg_iq
+            self.duty_now, int(self.erpm), self.v_in,
+            self.amp_hours, 0.0, self.watt_hours, 0.0,
+            self.tachometer, self.tachometer_abs,
+            b'\x00', 0.0, b'\x00',              # mc_fault_code, pid_pos_now, app_controller_id
+            int(time.monotonic() * 1000) & 0x7fffffff,
+        )
+
+
+class SimulatedBoard:
+    def __init__(self, scrub=SCRUB, **kwargs):
+        """
+        A left and right simulated VESC. Keyword arguments are passed to both.
+
+        Args:
+            scrub (float): Drag on the wheels' ground speed difference while
+                           they turn opposite ways (1/s). A pivot drags the tyres
+                           sideways, so it settles at about 60 deg/s at TURN_DUTY
+                           and stops within a few degrees; 0 lets each wheel spin
+                           freely.
+        """
+        self.left = SimulatedVesc(**kwargs)
+        self.right = SimulatedVesc(**kwargs)
+        self.left.partner, self.right.partner = self.right, self.left
+        self.left.scrub = self.right.scrub = scrub
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def ports(self):
+        """
+        Device paths for the left and right VESC, in SkateBack argument order.
+        """
+        return self.left.port, self.right.port
+
+    def close(self):
+        self.left.close()
+        self.right.close()
+
+
+if __name__ == '__main__':
+    with SimulatedBoard() as board:
+        print(f"Simulated VESCs on L: {board.left.port}, R: {board.right.port}")
+        try:
+            while True:
+                time.sleep(1)
+                print(f"L: {board.left.erpm:.0f} ERPM; R: {board.right.erpm:.0f} ERPM")
+        except KeyboardInterrupt:
+            pass
@@ -1,8 +1,12 @@
-import pyvesc
+import os
+import sys
 from pyvesc.VESC.messages import GetValues, SetRPM, SetDutyCycle, SetCurrent, SetRotorPositionMode, GetRotorPosition
-import serial
 import time
 
+# Shared VESC connections live with the controller in control/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'control'))
+import vesc
+
 # Notes: 
 # Duty cycle ranges from 1e5 to -1e5
 # It seems that negative duty cycle moves the board forward
@@ -20,29 +24,33 @@ def spin_motor(wheel, duration=3, duty_cycle=0.1):
     elif wheel == "R":
         serialPort = '/dev/ttyACM1'
     else:
-        error("Please specify L or R for wheel")
+        raise ValueError("Please specify L or R for wheel")
         
     # Create timer
     timer = create_timer(duration)
     
-    with serial.Serial(serialPort, baudrate=115200, timeout=0.05) as ser:
-        try:
-            while timer():
-                # Use PyVESC to encode SetDutyCycle msg ...
-                # ... then write to a serial port
-                ser.write(pyvesc.encode(SetDutyCycle(duty_cycle)))
-                
-                # Sleep to avoid overwhelming VESC with commands
-                time.sleep(0.1)
-        except KeyboardInterrupt:
-            # Turn Off the VESC
-            ser.write(pyvesc.encode(SetCurrent(0)))
-        finally:
-            # Close serial connection
-            ser.close()
+    # Reuses the open port if the caller holds it (see __main__)
+    ser = vesc.connect(serialPort)
+    try:
+        while timer():
+            # Send a SetDutyCycle msg over the shared connection
+            ser.send(SetDutyCycle(duty_cycle))
+            
+            # Sleep to avoid overwhelming VESC with commands
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        # Turn Off the VESC
+        ser.send(SetCurrent(0))
+    finally:
+        # Give the connection back
+        ser.release()
 
 
 if __name__ == "__main__":
+    # Keep both ports open across the spin_motor calls below
+    left = vesc.connect('/dev/ttyACM0')
+    right = vesc.connect('/dev/ttyACM1')
+
     duty_cycle = 0.1
     while duty_cycle < 0.5:
         spin_motor("R", duration=0.1, duty_cycle=duty_cycle)
@@ -56,3 +64,6 @@ if __name__ == "__main__":
     spin_motor("R", 3, -0.3)
     time.sleep(2)
     spin_motor("R", 3, 0.3)
+
+    left.release()
+    right.release()
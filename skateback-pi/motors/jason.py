@@ -1,12 +1,19 @@
 # server.py
 
+import collections
+import os
 import socket
+import struct
+import sys
 import threading
-import pyvesc
 from pyvesc.VESC.messages import SetDutyCycle
 import serial
 import time
 
+# Shared VESC connections live with the controller in control/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'control'))
+import vesc
+
 # Initialize duty cycles and acceleration steps
 left_duty_cycle = 0.0
 right_duty_cycle = 0.0
@@ -18,63 +25,127 @@ braking_deceleration_step = 0.04  # Larger step for faster deceleration (braking
 left_serial_port = '/dev/ttyACM0'   # Adjust as necessary
 right_serial_port = '/dev/ttyACM1'  # Adjust as necessary
 
-# Key state dictionary
-key_states = {
-    'w': False,         # Left motor accelerate
-    's': False,         # Left motor brake
-    'up': False,        # Right motor accelerate
-    'down': False       # Right motor brake
+UDP_PORT = 5005
+
+# Key state bits
+KEY_W = 0x01            # Left motor accelerate
+KEY_S = 0x02            # Left motor brake
+KEY_UP = 0x04           # Right motor accelerate
+KEY_DOWN = 0x08         # Right motor brake
+KEY_EXIT = 0x80         # Stop the motors and shut down
+
+# Remote packet: magic, key bitmask, sequence number, sender timestamp (us).
+# One datagram carries the full key state, so a lost packet is repaired by the next one.
+KEY_PACKET = struct.Struct('!BBIQ')
+KEY_MAGIC = 0xB5
+STALE_AFTER = 0.25      # Drop packets delayed this much beyond the fastest seen (s)
+REORDER_WINDOW = 64     # A seq further back than this is a restarted remote, not a reordered packet
+RESYNC_AFTER = 5        # Accept the stream again after this many packets in a row are dropped
+KEY_TIMEOUT = 0.5       # Release every key if the remote sends nothing for this long (s)
+
+# Legacy text messages from the old remote, mapped to (bit, pressed)
+TEXT_MESSAGES = {
+    'w_down': (KEY_W, True), 'w_up': (KEY_W, False),
+    's_down': (KEY_S, True), 's_up': (KEY_S, False),
+    'up_down': (KEY_UP, True), 'up_up': (KEY_UP, False),
+    'down_down': (KEY_DOWN, True), 'down_up': (KEY_DOWN, False),
 }
 
-# Lock for thread-safe operations
-key_lock = threading.Lock()
+# Latest key state. The receiver thread replaces the whole tuple and the control
+# loop reads it once per tick; rebinding a global is atomic, so no lock is needed.
+# Remote packets are resent continuously, so their state expires after KEY_TIMEOUT;
+# legacy text messages are only sent when a key changes and never expire.
+KeyState = collections.namedtuple('KeyState', ['mask', 'seq', 'received', 'expires'])
+key_state = KeyState(0, None, 0.0, None)
+packets_received = 0
+packets_discarded = 0
+
+def encode_key_state(mask, seq, timestamp_us=None):
+    """Build a remote packet carrying the full key state."""
+    if timestamp_us is None:
+        timestamp_us = time.time_ns() // 1000
+    return KEY_PACKET.pack(KEY_MAGIC, mask, seq & 0xFFFFFFFF, timestamp_us)
+
+def seq_newer(seq, last):
+    """True if seq comes after last, allowing for 32-bit wraparound."""
+    return last is None or 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+def seq_restarted(seq, last):
+    """True if seq is too far behind last to be a reordered packet."""
+    return last is not None and ((last - seq) & 0xFFFFFFFF) > REORDER_WINDOW and not seq_newer(seq, last)
+
+def current_mask(now=None):
+    """Latest key mask, or no keys if the remote has gone quiet."""
+    state = key_state   # Single atomic read of the latest state
+    if state.expires is not None and (now if now is not None else time.time()) > state.expires:
+        return 0
+    return state.mask
 
 def set_motor_duty_cycle(serial_port, duty_cycle):
-    """Set the motor to the given duty cycle."""
+    """Set the motor to the given duty cycle over the port's persistent connection."""
     try:
-        with serial.Serial(serial_port, baudrate=115200, timeout=0.05) as ser:
-            ser.write(pyvesc.encode(SetDutyCycle(duty_cycle)))
+        transport = vesc.connect(serial_port)
+        try:
+            transport.send(SetDutyCycle(duty_cycle))
+        finally:
+            transport.release()
     except serial.SerialException as e:
         print(f"Error setting motor duty cycle on {serial_port}: {e}")
 
-def receive_key_states():
+def receive_key_states(port=UDP_PORT):
     """Thread function to receive key states from the client."""
-    global key_states
+    global key_state, packets_received, packets_discarded
     # Set up UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('0.0.0.0', 5005))  # Listen on all interfaces on port 5005
-    print("Server listening on port 5005...")
+    sock.bind(('0.0.0.0', port))  # Listen on all interfaces
+    print(f"Server listening on port {port}...")
+
+    buffer = bytearray(1024)
+    min_delay = None    # Smallest (receive - send) seen: clock offset plus best-case latency
+    rejected = 0        # Packets dropped in a row
 
     while True:
-        data, addr = sock.recvfrom(1024)  # Buffer size is 1024 bytes
-        message = data.decode('utf-8')
-        with key_lock:
-            if message == 'w_down':
-                key_states['w'] = True
-            elif message == 'w_up':
-                key_states['w'] = False
-            elif message == 's_down':
-                key_states['s'] = True
-            elif message == 's_up':
-                key_states['s'] = False
-            elif message == 'up_down':
-                key_states['up'] = True
-            elif message == 'up_up':
-                key_states['up'] = False
-            elif message == 'down_down':
-                key_states['down'] = True
-            elif message == 'down_up':
-                key_states['down'] = False
-            elif message == 'exit':
-                print("Exiting...")
-                # Stop motors before exiting
-                set_motor_duty_cycle(left_serial_port, 0)
-                set_motor_duty_cycle(right_serial_port, 0)
-                sock.close()
-                exit(0)
+        size, addr = sock.recvfrom_into(buffer)
+        now = time.time()
+        packets_received += 1
+
+        if size == KEY_PACKET.size and buffer[0] == KEY_MAGIC:
+            _, mask, seq, sent_us = KEY_PACKET.unpack_from(buffer)
+            delay = now - sent_us / 1e6
+            if min_delay is None or delay < min_delay:
+                min_delay = delay
+            if seq_restarted(seq, key_state.seq) or rejected >= RESYNC_AFTER:
+                # The remote restarted or its clock stepped: follow the new stream
+                print(f"Remote resynchronised at seq {seq}")
+                min_delay = delay
+            elif not seq_newer(seq, key_state.seq) or delay - min_delay > STALE_AFTER:
+                packets_discarded += 1  # Reordered, duplicated or late
+                rejected += 1
+                continue
+            rejected = 0
+            expires = now + KEY_TIMEOUT
+        else:
+            message = bytes(buffer[:size]).decode('utf-8', errors='replace')
+            if message == 'exit':
+                mask, seq, expires = KEY_EXIT, key_state.seq, None
+            elif message in TEXT_MESSAGES:
+                bit, pressed = TEXT_MESSAGES[message]
+                mask = (current_mask(now) | bit) if pressed else (current_mask(now) & ~bit)
+                seq, expires = key_state.seq, None
             else:
                 # Handle unknown messages
                 print(f"Unknown message received: {message}")
+                continue
+
+        key_state = KeyState(mask, seq, now, expires)
+
+        if mask & KEY_EXIT:
+            print("Exiting...")
+            # Stop motors before exiting
+            set_motor_duty_cycle(left_serial_port, 0)
+            set_motor_duty_cycle(right_serial_port, 0)
+            sock.close()
+            exit(0)
 
 def control_motors():
     """Main function to control the motors based on key_states."""
@@ -84,11 +155,10 @@ def control_motors():
 
     try:
         while True:
-            with key_lock:
-                keys = key_states.copy()
+            mask = current_mask()
 
             # Control Left Motor
-            if keys['w']:  # Accelerate left motor
+            if mask & KEY_W:  # Accelerate left motor
                 left_duty_cycle += acceleration_step
                 if left_duty_cycle > 1:
                     left_duty_cycle = 1
@@ -96,7 +166,7 @@ def control_motors():
                 left_braking = False
                 print(f"Left motor accelerating: {left_duty_cycle:.2f}", end='\r')
 
-            elif keys['s']:  # Decelerate left motor faster (braking)
+            elif mask & KEY_S:  # Decelerate left motor faster (braking)
                 left_braking = True
                 left_motor_active = False
                 print(f"Left motor braking: {left_duty_cycle:.2f}    ", end='\r')
@@ -105,7 +175,7 @@ def control_motors():
                 left_motor_active = False
 
             # Control Right Motor
-            if keys['up']:  # Accelerate right motor
+            if mask & KEY_UP:  # Accelerate right motor
                 right_duty_cycle += acceleration_step
                 if right_duty_cycle > 1:
                     right_duty_cycle = 1
@@ -113,7 +183,7 @@ def control_motors():
                 right_braking = False
                 print(f"Right motor accelerating: {right_duty_cycle:.2f}", end='\r')
 
-            elif keys['down']:  # Decelerate right motor faster (braking)
+            elif mask & KEY_DOWN:  # Decelerate right motor faster (braking)
                 right_braking = True
                 right_motor_active = False
                 print(f"Right motor braking: {right_duty_cycle:.2f}     ", end='\r')
@@ -171,6 +241,10 @@ def control_motors():
         time.sleep(1)
 
 if __name__ == "__main__":
+    # Hold both ports open for the life of the server so every tick reuses them
+    left_vesc = vesc.connect(left_serial_port)
+    right_vesc = vesc.connect(right_serial_port)
+
     # Start the key receiving thread
     key_thread = threading.Thread(target=receive_key_states)
     key_thread.daemon = True